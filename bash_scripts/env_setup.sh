@@ -94,6 +94,11 @@ FN_FILES=( "${SRC_FN_DIR}/analyze_segments.py" "../${LIB_DIR}/biosppy" "../${LIB
 #FN_FILES=( "${SRC_FN_DIR}/analysis-function" )
 create_fn_dir
 
+FN_NAME='reclaim_segments'
+SRC_FN_DIR="../../python_functions/${FN_NAME}"
+FN_FILES=( )
+create_fn_dir
+
 FN_NAME='reassemble_segments'
 SRC_FN_DIR="../../python_functions/${FN_NAME}"
 FN_FILES=( "${SRC_FN_DIR}/reassemble_segments.py" "../${LIB_DIR}/h5py" )
@@ -67,7 +67,18 @@ ibmcloud fn action $IC_CREATE_OR_UPDATE analyzeSegmentChange ./analyze_segment.z
 #ibmcloud fn action $IC_CREATE_OR_UPDATE analyzeSegmentChange --docker $IC_DOCKER ./analyze_segment.zip --memory 4096 --timeout 960000
 ibmcloud fn rule $IC_CREATE_OR_UPDATE analyzeSegmentRule analyzeSegmentTrigger analyzeSegmentChange
 
-# Step 3:  Reassemble segments to output data file following analysis
+# Step 2a:  Re-queue segments whose analysis lease expired, i.e., whose analyzeSegmentChange invocation crashed or timed
+#           out, every 5 minutes
+cd reclaim_segments/; zip -r ../reclaim_segments.zip *; cd ../
+IC_ALARM_FEED=''
+if [ "${IC_CREATE_OR_UPDATE}" = 'create' ]; then
+    IC_ALARM_FEED="--feed /whisk.system/alarms/interval --param minutes 5"
+fi
+ibmcloud fn trigger $IC_CREATE_OR_UPDATE reclaimSegmentsTrigger $IC_ALARM_FEED
+ibmcloud fn action $IC_CREATE_OR_UPDATE reclaimSegmentsAlarm ./reclaim_segments.zip --kind python:3.6 --memory 256 --timeout 300000
+ibmcloud fn rule $IC_CREATE_OR_UPDATE reclaimSegmentsRule reclaimSegmentsTrigger reclaimSegmentsAlarm
+
+# Step 3:  Reassemble segments to output data file once the final segment analysis marks the raw document 'analyzed'
 cd reassemble_segments/; zip -r ../reassemble_segments.zip *; cd ../
 ibmcloud fn trigger $IC_CREATE_OR_UPDATE reassembleSegmentsTrigger $IC_FEED --param dbname $IC_CLOUDANT_DB --param filter cloudant_filters/reassemble_segments
 ibmcloud fn action $IC_CREATE_OR_UPDATE reassembleSegmentsChange ./reassemble_segments.zip --kind python:3.6 --memory 4096 --timeout 1200000
@@ -0,0 +1,96 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+# Reports the cold-start import cost of each Function package by importing its __main__.py in a fresh interpreter,
+# using the same module search path layout as the zip files assembled by env_setup.sh, i.e., the Function's own
+# directory plus the directory containing ibm_fn_helper.py and ibm_creds.py.  The dependencies of each Function must be
+# installed in the current Python environment (or available on PYTHONPATH, e.g., ../build/lib).
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NWCHEM_DIR = os.path.join(REPO_DIR, 'transient_vs_nwchem')
+
+FUNCTION_PACKAGES = {
+    'create_segments': (os.path.join(REPO_DIR, 'python_functions', 'create_segments'), REPO_DIR),
+    'analyze_segment': (os.path.join(REPO_DIR, 'python_functions', 'analyze_segment'), REPO_DIR),
+    'reassemble_segments': (os.path.join(REPO_DIR, 'python_functions', 'reassemble_segments'), REPO_DIR),
+    'createPipeline': (os.path.join(NWCHEM_DIR, 'python_functions', 'create_pipeline'), NWCHEM_DIR),
+    'destroyPipeline': (os.path.join(NWCHEM_DIR, 'python_functions', 'destroy_pipeline'), NWCHEM_DIR)
+}
+
+# Executed in the child interpreter; prints the wall time, in seconds, of loading the Function's __main__.py
+_IMPORT_SCRIPT = '''
+import importlib.util, sys, time
+sys.path[:0] = [{fn_dir!r}, {helper_dir!r}]
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('fn_main', {main_path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+'''
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+_REPEAT_DESC = 'the number of fresh interpreters to start per Function package'
+_TOP_DESC = 'the number of most expensive top-level imports to list per package (requires Python 3.7+ for -X importtime)'
+
+
+def time_package_import(fn_dir, helper_dir, top=0):
+    script = _IMPORT_SCRIPT.format(fn_dir=fn_dir, helper_dir=helper_dir, main_path=os.path.join(fn_dir, '__main__.py'))
+    args = [sys.executable]
+    if top > 0:
+        args += ['-X', 'importtime']
+    args += ['-c', script]
+
+    exec_output = subprocess.run(args=args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+    if exec_output.returncode != 0:
+        raise RuntimeError(exec_output.stderr.strip().split('\n')[-1])
+
+    # Keep only the modules imported directly by the Function code, w/their cumulative cost in microseconds
+    top_imports = []
+    for line in exec_output.stderr.split('\n'):
+        match = _IMPORTTIME_RE.match(line)
+        if match and len(match.group(3)) <= 1:
+            top_imports.append((int(match.group(2)), match.group(4)))
+
+    return float(exec_output.stdout.strip().split('\n')[-1]), sorted(top_imports, reverse=True)[:top]
+
+
+# Start script execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('packages', nargs='*', help=f'Function packages to measure from {list(FUNCTION_PACKAGES)}, default is all')
+    parser.add_argument('-n', '--repeat', help=_REPEAT_DESC, type=int, default=5)
+    parser.add_argument('-t', '--top', help=_TOP_DESC, type=int, default=0)
+    args = parser.parse_args()
+
+    packages = args.packages if len(args.packages) > 0 else list(FUNCTION_PACKAGES)
+    for package in packages:
+        if package not in FUNCTION_PACKAGES:
+            sys.exit(f'Invalid input!  "{package}" is not one of {list(FUNCTION_PACKAGES)}.')
+
+    print(f'{"package":<22}{"min (ms)":>10}{"median (ms)":>13}{"max (ms)":>10}')
+    for package in packages:
+        fn_dir, helper_dir = FUNCTION_PACKAGES[package]
+        durations = []
+        top_imports = []
+
+        try:
+            for i in range(args.repeat):
+                if i == 0:
+                    duration, top_imports = time_package_import(fn_dir, helper_dir, args.top)
+                else:
+                    duration, _ = time_package_import(fn_dir, helper_dir)
+                durations.append(duration * 1000)
+        except RuntimeError as e:
+            print(f'{package:<22}  import failed!  {str(e)}')
+            continue
+
+        print(f'{package:<22}{min(durations):>10.1f}{statistics.median(durations):>13.1f}{max(durations):>10.1f}')
+        for cumulative_us, module in top_imports:
+            print(f'    {module:<40}{cumulative_us / 1000:>10.1f} ms')
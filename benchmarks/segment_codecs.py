@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ibm_fn_helper as ifh
+
+
+# Compares the segment codecs in ifh.SEGMENT_CODECS by encode and decode throughput, in MB/s of array data, against the
+# size of their encoded items relative to the array data.  Arrays are synthetic physiological-like signals, i.e., a
+# slowly varying quasi-periodic waveform plus noise, quantized to the dtype like an ADC sample.  The lz4 codecs are
+# skipped unless the lz4 package is installed.
+
+_ROWS_DESC = 'the number of rows in each synthetic segment'
+_CHANNELS_DESC = 'the number of channels, i.e., columns, in each synthetic segment'
+_DTYPE_DESC = 'the NumPy dtype of the synthetic samples'
+_REPEAT_DESC = 'the number of times each codec encodes and decodes the segment, of which the fastest is reported'
+
+
+# Returns a synthetic segment of rows x channels samples of the dtype
+def synthetic_segment(rows, channels, dtype, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(rows, dtype=np.float64)[:, None] / 250.0
+
+    signal = np.sin(2 * np.pi * 1.2 * t + rng.uniform(0, 2 * np.pi, channels)) + 0.3 * np.sin(2 * np.pi * 0.25 * t)
+    signal += 0.005 * rng.standard_normal((rows, channels))
+
+    if np.issubdtype(dtype, np.integer):
+        return np.round(signal * 0.25 * np.iinfo(dtype).max).astype(dtype)
+
+    return signal.astype(dtype)
+
+
+# Returns the fastest encode and decode times, in seconds, and the encoded size, in bytes, of the array w/the codec
+def time_codec(array, codec, repeat):
+    encode_times = []
+    decode_times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        item_bytes = ifh.encode_array(array, codec)
+        encode_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        decoded = ifh.decode_array(item_bytes, codec)
+        decode_times.append(time.perf_counter() - start)
+
+    if not np.array_equal(decoded, array):
+        raise RuntimeError(f'Codec "{codec}" did not round-trip the array!')
+
+    return min(encode_times), min(decode_times), len(item_bytes)
+
+
+# Start script execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('codecs', nargs='*', help=f'codecs to compare from {list(ifh.SEGMENT_CODECS)}, default is all')
+    parser.add_argument('-r', '--rows', help=_ROWS_DESC, type=int, default=ifh.DEFAULT_SEGMENT_SIZE)
+    parser.add_argument('-c', '--channels', help=_CHANNELS_DESC, type=int, default=1)
+    parser.add_argument('-t', '--dtype', help=_DTYPE_DESC, type=str, default='int16')
+    parser.add_argument('-n', '--repeat', help=_REPEAT_DESC, type=int, default=3)
+    args = parser.parse_args()
+
+    codecs = args.codecs if len(args.codecs) > 0 else list(ifh.SEGMENT_CODECS)
+    for codec in codecs:
+        if codec not in ifh.SEGMENT_CODECS:
+            sys.exit(f'Invalid input!  "{codec}" is not one of {list(ifh.SEGMENT_CODECS)}.')
+
+    array = synthetic_segment(args.rows, args.channels, np.dtype(args.dtype))
+    data_mb = array.nbytes / (1024 * 1024)
+
+    print(f'{args.rows} x {args.channels} {array.dtype} samples, {data_mb:.1f} MB')
+    print(f'{"codec":<16}{"ratio":>8}{"size (MB)":>11}{"encode (MB/s)":>15}{"decode (MB/s)":>15}')
+    for codec in codecs:
+        try:
+            encode_time, decode_time, item_size = time_codec(array, codec, args.repeat)
+        except ValueError as e:
+            print(f'{codec:<16}  skipped!  {str(e)}')
+            continue
+
+        print(f'{codec:<16}{array.nbytes / item_size:>8.2f}{item_size / (1024 * 1024):>11.2f}{data_mb / encode_time:>15.1f}{data_mb / decode_time:>15.1f}')
@@ -1,16 +1,21 @@
 from cloudant.adapters import Replay429Adapter
 from cloudant.client import Cloudant
-from ibm_s3transfer.aspera.manager import AsperaTransferManager
-from ibm_s3transfer.aspera.manager import AsperaConfig
-
-# https://stackoverflow.com/questions/40993553/unable-to-suppress-deprecation-warnings
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore", category=DeprecationWarning)
-    import ibm_boto3
-    from ibm_botocore.client import Config, ClientError
+from cloudant.document import Document
+from requests import HTTPError
 
+import atexit
+import collections
+import contextlib
+import io
+import itertools
+import json
 import logging
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+import zlib
 
 import ibm_creds
 
@@ -19,6 +24,27 @@ import ibm_creds
 OUTPUT_FILE_EXT = 'extension'  # e.g., tsv, h5, vcf
 SEGMENT_TYPE = 'analysis_type'  # e.g., preprocessing, classification, etc.
 DEFAULT_SEGMENT_SIZE = 864000
+# Memory, in MB, configured for the analyzeSegmentChange action (see functions_cli.sh), less an allowance for the
+# runtime and libraries, and the number of copies of its segments' data held at once by an invocation, i.e., the raw
+# segments, their stacked array and the analyzed output.  Used to size the batches of segments analyzed together.
+ANALYZE_ACTION_MEMORY_MB = 1024
+ANALYZE_RUNTIME_MEMORY_MB = 256
+ANALYZE_SEGMENT_COPIES = 3
+ANALYZE_BATCH_MAX = 32
+# Timeout, in seconds, configured for the analyzeSegmentChange action (see functions_cli.sh).  When a segment size is
+# not given, segments are planned to take about SEGMENT_PLAN_TARGET_SECONDS of analysis each, as estimated from the
+# segments of up to SEGMENT_PLAN_HISTORY recently completed jobs, and batches to take at most
+# SEGMENT_PLAN_TIMEOUT_FRACTION of the timeout.  W/o any history, DEFAULT_SEGMENT_SIZE is used, bounded by the action's
+# memory.
+ANALYZE_ACTION_TIMEOUT_S = 960
+SEGMENT_PLAN_TARGET_SECONDS = 60
+SEGMENT_PLAN_TIMEOUT_FRACTION = 0.5
+SEGMENT_PLAN_HISTORY = 20
+# Bounds on the models and lookup tables kept by cached_resource() for reuse by warm invocations of a Function
+RESOURCE_CACHE_MAX_ITEMS = 4
+RESOURCE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Number of top allocators, by line, listed in Function profiles; tracemalloc slows allocation, so it is off by default
+PROFILE_TRACEMALLOC_TOP = 0
 
 # Constants for IBM Cloudant
 # 429 Too Many Requests
@@ -26,48 +52,244 @@ CLOUDANT_429_RETRIES = 5
 CLOUDANT_INIT_BACKOFF = 0.75
 # 409 Document Conflict
 CLOUDANT_409_RETRIES = 10
-
-# Constants for IBM Cloud Object Storage
-COS_RESOURCE = ibm_boto3.resource('s3',
-    ibm_api_key_id=ibm_creds.COS_API_KEY_ID,
-    ibm_service_instance_id=ibm_creds.COS_RESOURCE_CRN,
-    ibm_auth_endpoint=ibm_creds.COS_AUTH_ENDPOINT,
-    config=Config(signature_version='oauth'),
-    endpoint_url=ibm_creds.COS_ENDPOINT
-)
-
-COS_CLIENT = ibm_boto3.client('s3',
-    ibm_api_key_id=ibm_creds.COS_API_KEY_ID,
-    ibm_service_instance_id=ibm_creds.COS_RESOURCE_CRN,
-    ibm_auth_endpoint=ibm_creds.COS_AUTH_ENDPOINT,
-    config=Config(signature_version='oauth'),
-    endpoint_url=ibm_creds.COS_ENDPOINT
-)
-
-transfer_manager = AsperaTransferManager(COS_CLIENT)
-
-ms_transfer_config = AsperaConfig(multi_session="all",
-                                  target_rate_mbps=2500,
-                                  multi_session_threshold_mb=100)
+# IAM tokens are valid for 60 minutes, so recycle a cached client before then as a precaution
+CLOUDANT_SESSION_MAX_AGE = 50 * 60
+# Number of documents written per _bulk_docs request, and per-document errors that are not worth retrying
+CLOUDANT_BULK_BATCH_SIZE = 500
+CLOUDANT_BULK_FATAL_ERRORS = ('conflict', 'forbidden', 'unauthorized')
+# Up to this many segments reported as incomplete by a view are re-read directly, since view results may lag writes
+CLOUDANT_VERIFY_LIMIT = 10
+# Global view shared by all jobs, keyed by [raw_id, complete_flag, segment_index] w/a _count reduce
+SEGMENT_DESIGN_DOC = '_design/cloudant_views'
+SEGMENT_STATUS_VIEW = 'segment_status'
+COMPLETE_VIEW = 'complete'
+# Complete jobs w/a list of segments, keyed by their last segment's compute_end, from which the most recent are sampled
+COMPLETE_BY_COMPUTE_END_VIEW = 'complete_by_compute_end'
+# Unanalyzed segments w/a lease, keyed by its expiry, from which reclaim_expired_segments() finds the expired leases
+EXPIRED_CLAIMS_VIEW = 'expired_claims'
+# Segments are claimed for analysis w/a lease outlasting the analyzeSegmentChange timeout (960 s), after which an
+# unfinished claim is released and its segments re-queued by the reclaimSegmentsAlarm Function
+SEGMENT_LEASE_SECONDS = 1000
+# Segments whose analysis failed, or whose lease expired, are re-queued until they have been claimed this many times
+SEGMENT_MAX_ATTEMPTS = 3
+# Maximum number of expired leases released by one reclaimSegmentsAlarm invocation
+RECLAIM_LIMIT = 1000
+# Jobs submitted w/"use_result_cache" memoize their analyzed segment outputs in COS under RESULT_CACHE_PREFIX, keyed by
+# a hash of the raw segment data, the version of the analytical code and the segment codec, w/an index document per
+# entry in Cloudant.  Each output analyzed, rather than copied from the cache, is then written to COS twice.  Entries
+# unused for RESULT_CACHE_TTL_DAYS are evicted, as are the least recently used entries while the cache exceeds
+# RESULT_CACHE_MAX_BYTES, up to RESULT_CACHE_EVICT_LIMIT entries per job, read from the RESULT_CACHE_VIEW keyed on
+# their last use.
+RESULT_CACHE_TYPE = SEGMENT_TYPE + '-cache'
+RESULT_CACHE_PREFIX = '_cache/' + SEGMENT_TYPE + '/'
+RESULT_CACHE_VIEW = 'result_cache_lru'
+RESULT_CACHE_TTL_DAYS = 30
+RESULT_CACHE_MAX_BYTES = 100 * 1024 * 1024 * 1024
+RESULT_CACHE_EVICT_LIMIT = 500
 
 # https://docs.python.org/3.6/howto/logging.html
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(filename)s:%(lineno)s  %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+# Cloudant client and database shared across warm invocations of the same Function container
+_cloudant_cache = {
+    'client': None,
+    'db': None,
+    'connected_at': None,
+    'connections': 0,
+    'reuses': 0
+}
+
+# Counts of segment leases taken, or not, by invocations in this Function container
+_lease_stats = {
+    'claimed': 0,
+    'reclaimed': 0,
+    'contended': 0,
+    'skipped': 0,
+    'duplicate': 0
+}
+
+# Resources loaded by cached_resource(), keyed by (version, name) in least to most recently used order, each w/its
+# estimated size in bytes
+_resource_cache = {
+    'items': collections.OrderedDict(),
+    'bytes': 0,
+    'hits': 0,
+    'misses': 0
+}
+_resource_lock = threading.Lock()
+
+# Multi-object delete requests accept at most 1000 keys
+COS_DELETE_BATCH_SIZE = 1000
+# Results of item existence checks are cached for this many seconds, i.e., shared across the checks of an invocation or
+# a client run, for at most this many items
+COS_EXISTS_CACHE_TTL = 60
+COS_EXISTS_CACHE_MAX_ITEMS = 10000
+# Ranged reads through CosRangeFile are made, and cached, in blocks of this size
+COS_RANGE_BLOCK_SIZE = 1024 * 1024
+COS_RANGE_CACHE_BLOCKS = 32
+# Every part of a multipart upload but the last must be at least 5 MB, and parts copied from other items at most 5 GB
+COS_MIN_PART_SIZE = 5 * 1024 * 1024
+COS_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+COS_MAX_PARTS = 10000
+# Number of parts of a composed item copied or uploaded concurrently
+COS_COMPOSE_CONCURRENCY = 8
+# CosMultipartWriter uploads parts of this size as they fill, w/at most this many parts uploaded concurrently
+COS_STREAM_PART_SIZE = 16 * 1024 * 1024
+COS_STREAM_MAX_IN_FLIGHT = 4
+# Bytes read from the start of a .npy item to parse its header, which numpy pads to a multiple of 64 bytes
+NPY_HEADER_PROBE_SIZE = 4096
+# Codec of the intermediate segment items in COS, unless set on the raw document as 'segment_codec', and the zlib level
+# used by the zlib codecs.  See SEGMENT_CODECS.
+DEFAULT_SEGMENT_CODEC = 'npy'
+SEGMENT_CODEC_ZLIB_LEVEL = 1
+
+# IBM Cloud Object Storage clients and the Aspera transfer manager are created on first use, rather than at import
+# time, so that Functions which never use them (or never use Aspera) do not pay for them during a cold start
+_cos_cache = {
+    'resource': None,
+    'client': None,
+    'aspera_manager': None,
+    'aspera_config': None
+}
+_cos_lock = threading.Lock()
+
+# Results of cos_item_exists() and cos_items_exist(), keyed by (bucket, item) in least to most recently checked order,
+# each w/its expiry.  Items uploaded, composed, copied or deleted by these helpers are updated in place.
+_cos_exists_cache = collections.OrderedDict()
+_cos_exists_lock = threading.Lock()
+
+
+def _ibm_boto3():
+    # https://stackoverflow.com/questions/40993553/unable-to-suppress-deprecation-warnings
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=DeprecationWarning)
+        import ibm_boto3
+        from ibm_botocore.client import Config
+
+    return ibm_boto3, Config
+
+
+def _cos_connection_args():
+    _, Config = _ibm_boto3()
+
+    return {
+        'ibm_api_key_id': ibm_creds.COS_API_KEY_ID,
+        'ibm_service_instance_id': ibm_creds.COS_RESOURCE_CRN,
+        'ibm_auth_endpoint': ibm_creds.COS_AUTH_ENDPOINT,
+        'config': Config(signature_version='oauth'),
+        'endpoint_url': ibm_creds.COS_ENDPOINT
+    }
+
+
+def cos_resource():
+    if _cos_cache['resource'] is None:
+        ibm_boto3, _ = _ibm_boto3()
+        _cos_cache['resource'] = ibm_boto3.resource('s3', **_cos_connection_args())
+
+    return _cos_cache['resource']
+
+
+# Unlike the resource, the low-level client is thread-safe and may be shared by worker threads
+def cos_client():
+    if _cos_cache['client'] is None:
+        with _cos_lock:
+            if _cos_cache['client'] is None:
+                ibm_boto3, _ = _ibm_boto3()
+                _cos_cache['client'] = ibm_boto3.client('s3', **_cos_connection_args())
+
+    return _cos_cache['client']
+
+
+# The ClientError raised by the COS clients, resolved on first use so that importing this module does not import
+# ibm_botocore.  Used as "except cos_client_error()", which is only evaluated once an exception is raised.
+def cos_client_error():
+    from ibm_botocore.exceptions import ClientError
+
+    return ClientError
+
+
+def aspera_transfer_config():
+    if _cos_cache['aspera_config'] is None:
+        from ibm_s3transfer.aspera.manager import AsperaConfig
+        _cos_cache['aspera_config'] = AsperaConfig(multi_session="all",
+                                                   target_rate_mbps=2500,
+                                                   multi_session_threshold_mb=100)
+
+    return _cos_cache['aspera_config']
+
+
+def aspera_transfer_manager():
+    if _cos_cache['aspera_manager'] is None:
+        from ibm_s3transfer.aspera.manager import AsperaTransferManager
+        _cos_cache['aspera_manager'] = AsperaTransferManager(cos_client())
+        atexit.register(_cos_cache['aspera_manager'].shutdown)
 
-def cloudant_cleanup(cloudant_obj, error=None, save=False):
+    return _cos_cache['aspera_manager']
+
+
+def cloudant_disconnect():
+    if _cloudant_cache['client'] is not None:
+        try:
+            _cloudant_cache['client'].disconnect()
+        except Exception as e:
+            logging.warning(f'Unable to disconnect Cloudant client!  {str(e)}')
+
+    _cloudant_cache['client'] = None
+    _cloudant_cache['db'] = None
+    _cloudant_cache['connected_at'] = None
+
+
+# Ensures that a usable Cloudant client is cached, returning True if the existing connection was reused.  The
+# database existence check is only made when a new connection is established, i.e., once per container.
+def cloudant_connect():
+    if _cloudant_cache['client'] is not None and time.time() - _cloudant_cache['connected_at'] < CLOUDANT_SESSION_MAX_AGE:
+        # Drop documents cached locally by the database object during previous invocations to force fresh reads
+        _cloudant_cache['db'].clear()
+        _cloudant_cache['reuses'] += 1
+        return True
+
+    cloudant_disconnect()
+
+    # auto_renew requests a new IAM token whenever Cloudant rejects an expired one
+    client = Cloudant.iam(ibm_creds.CLOUDANT_USERNAME, ibm_creds.CLOUDANT_API_KEY, auto_renew=True,
+                          adapter=Replay429Adapter(retries=CLOUDANT_429_RETRIES, initialBackoff=CLOUDANT_INIT_BACKOFF))
+    client.connect()
+
+    db = client[ibm_creds.CLOUDANT_DATABASE]
+    if db.exists() == False:
+        client.disconnect()
+        return False
+
+    _cloudant_cache['client'] = client
+    _cloudant_cache['db'] = db
+    _cloudant_cache['connected_at'] = time.time()
+    _cloudant_cache['connections'] += 1
+
+    return False
+
+
+def cloudant_stats():
+    return { 'connections': _cloudant_cache['connections'], 'reuses': _cloudant_cache['reuses'] }
+
+
+# The shared client is left connected for the next warm invocation unless disconnect is requested
+def cloudant_cleanup(cloudant_obj, error=None, save=False, disconnect=False):
     cloudant_obj['error'] = error
     if cloudant_obj['error'] is not None:
         cloudant_obj['error'] += f' ({cloudant_obj["id"]})'
         logging.error(cloudant_obj['error'])
 
-    if save == True and cloudant_obj['doc'] is not None:
+    if save == True and cloudant_obj.get('doc') is not None:
         cloudant_obj['doc'].save()
 
     cloudant_obj['doc'] = None
     cloudant_obj['db'] = None
-    cloudant_obj['client'].disconnect()
     cloudant_obj['client'] = None
 
+    if disconnect == True:
+        cloudant_disconnect()
+
     return cloudant_obj
 
 
@@ -75,44 +297,584 @@ def cloudant_init(doc_id):
     cloudant_obj = { }
     cloudant_obj['id'] = doc_id
     cloudant_obj['error'] = None
+    cloudant_obj['doc'] = None
 
-    cloudant_obj['client'] = Cloudant.iam(ibm_creds.CLOUDANT_USERNAME, ibm_creds.CLOUDANT_API_KEY,
-                                adapter=Replay429Adapter(retries=CLOUDANT_429_RETRIES, initialBackoff=CLOUDANT_INIT_BACKOFF))
-    cloudant_obj['client'].connect()
-
-    cloudant_obj['db'] = cloudant_obj['client'][ibm_creds.CLOUDANT_DATABASE]
-    if cloudant_obj['db'].exists() == False:
-        cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Database "{ibm_creds.CLOUDANT_DATABASE}" does not exist!')
-        return cloudant_obj
+    # A second attempt is made w/a new connection if the cached client's credentials are rejected
+    for attempt in range(2):
+        cloudant_obj['reused'] = cloudant_connect()
+        cloudant_obj['client'] = _cloudant_cache['client']
+        cloudant_obj['db'] = _cloudant_cache['db']
 
-    # Retrieve the Cloudant document, if specified
-    if cloudant_obj['id'] is not None:
-        if cloudant_obj['id'] in cloudant_obj['db']:
-            cloudant_obj['doc'] = cloudant_obj['db'][cloudant_obj['id']]
-        else:
-            cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Document does not exist!')
+        if cloudant_obj['db'] is None:
+            cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Database "{ibm_creds.CLOUDANT_DATABASE}" does not exist!')
             return cloudant_obj
 
+        # Retrieve the Cloudant document, if specified
+        try:
+            if cloudant_obj['id'] is not None:
+                if cloudant_obj['id'] in cloudant_obj['db']:
+                    cloudant_obj['doc'] = cloudant_obj['db'][cloudant_obj['id']]
+                else:
+                    cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Document does not exist!')
+                    return cloudant_obj
+        except HTTPError as err:
+            if attempt == 0 and err.response is not None and err.response.status_code in (401, 403):
+                logging.warning(f'Cloudant {err.response.status_code} HTTPError: reconnecting ({cloudant_obj["id"]})')
+                cloudant_disconnect()
+                continue
+            raise
+
+        break
+
+    logging.info(f'Cloudant connection reused={cloudant_obj["reused"]} {cloudant_stats()}')
+
     return cloudant_obj
 
 
-# https://www.peterbe.com/plog/fastest-way-to-find-out-if-a-file-exists-in-s3
-def cos_item_exists(bucket_name, item_name):
-    response = COS_CLIENT.list_objects_v2(Bucket=bucket_name, Prefix=item_name)
+# Writes the documents w/_bulk_docs in batches of batch_size, retrying w/backoff only the entries that failed.  Each
+# saved document's '_rev' is updated in place and the per-document results that still failed are returned.  A
+# 'conflict' means the document already exists at another revision, e.g., written by an earlier invocation, so it is
+# only reported as a failure if conflicts_ok is False.
+def cloudant_bulk_save(cloudant_db, docs, batch_size=CLOUDANT_BULK_BATCH_SIZE, conflicts_ok=True):
+    failures = []
+
+    for batch_start in range(0, len(docs), batch_size):
+        pending = docs[batch_start:batch_start + batch_size]
+        backoff = CLOUDANT_INIT_BACKOFF
+
+        for attempt in range(CLOUDANT_429_RETRIES + 1):
+            results = cloudant_db.bulk_docs(pending)
+
+            retry = []
+            for doc, result in zip(pending, results):
+                if 'error' not in result:
+                    doc['_rev'] = result['rev']
+                elif result['error'] == 'conflict' and conflicts_ok:
+                    continue
+                elif result['error'] in CLOUDANT_BULK_FATAL_ERRORS or attempt == CLOUDANT_429_RETRIES:
+                    logging.error(f'Bulk save failed ({result.get("id")}:{result["error"]}:{result.get("reason")})')
+                    failures.append(result)
+                else:
+                    retry.append(doc)
 
-    for item in response.get('Contents', []):
-        if item['Key'] == item_name:
+            if len(retry) == 0:
+                break
+
+            logging.warning(f'Bulk save retrying {len(retry)} of {len(pending)} document(s)')
+            pending = retry
+            time.sleep(backoff)
+            backoff *= 2
+
+    return failures
+
+
+# Returns the documents w/the given IDs, in order, as plain dicts, w/None for any that do not exist or were deleted
+def cloudant_get_docs(cloudant_db, doc_ids):
+    if len(doc_ids) == 0:
+        return []
+
+    result = cloudant_db.all_docs(keys=doc_ids, include_docs=True)
+
+    return [row.get('doc') for row in result['rows']]
+
+
+# Deletes the documents, each of which must include its current '_rev', by writing _bulk_docs tombstones in batches of
+# batch_size.  Returns the per-document results that failed, e.g., a 'conflict' if a document has since been updated.
+def cloudant_bulk_delete(cloudant_db, docs, batch_size=CLOUDANT_BULK_BATCH_SIZE):
+    tombstones = [ { '_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True } for doc in docs ]
+
+    return cloudant_bulk_save(cloudant_db, tombstones, batch_size=batch_size, conflicts_ok=False)
+
+
+# Returns the number of segments of segment_bytes each to be analyzed together by one analyzeSegmentChange invocation,
+# i.e., as many as fit in the action's memory, up to ANALYZE_BATCH_MAX
+def analyze_batch_size(segment_bytes):
+    available_bytes = (ANALYZE_ACTION_MEMORY_MB - ANALYZE_RUNTIME_MEMORY_MB) * 1024 * 1024
+
+    return int(max(1, min(ANALYZE_BATCH_MAX, available_bytes // max(1, segment_bytes * ANALYZE_SEGMENT_COPIES))))
+
+
+# Returns the mean analysis time, in seconds per row, of the segments of up to job_limit most recently completed jobs,
+# and the number of segments it was estimated from, or (None, 0) w/o any history.  Segments analyzed in the same batch
+# share their compute_start, so each batch's wall time, from then until its last segment's compute_end, is divided by
+# its total rows.  Segments copied from the result cache were not analyzed, so are skipped.
+def analysis_seconds_per_row(cloudant_db, job_limit=SEGMENT_PLAN_HISTORY):
+    from datetime import datetime
+
+    # Times are saved as str(datetime.now()), which omits the microseconds when they are 0
+    def parse_time(value):
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+    batches = { }
+    segment_count = 0
+
+    try:
+        rows = cloudant_db.get_view_result(SEGMENT_DESIGN_DOC, COMPLETE_BY_COMPUTE_END_VIEW, raw_result=True, descending=True, include_docs=True, limit=job_limit)['rows']
+    except HTTPError as err:
+        logging.exception(f'Complete view "{err.response.status_code}" error!', exc_info=err)
+        return None, 0
+
+    for row in rows:
+        # Jobs reassembled w/a tree-reduce keep only their segment count
+        segments = row.get('doc', { }).get(SEGMENT_TYPE, { }).get('segments')
+        if not isinstance(segments, list):
+            continue
+
+        for segment in segments:
+            if not isinstance(segment, dict) or segment.get('compute_start') is None or segment.get('compute_end') is None:
+                continue
+            if segment.get('cache') == 'hit':
+                continue
+
+            compute_start = parse_time(segment['compute_start'])
+            compute_end = parse_time(segment['compute_end'])
+
+            batch = batches.setdefault((row['id'], segment['compute_start']), [compute_start, compute_end, 0])
+            batch[1] = max(batch[1], compute_end)
+            batch[2] += segment['segment_end'] - segment['segment_start']
+            segment_count += 1
+
+    total_rows = sum(batch[2] for batch in batches.values())
+    if total_rows == 0:
+        return None, 0
+
+    total_seconds = sum((batch[1] - batch[0]).total_seconds() for batch in batches.values())
+
+    return total_seconds / total_rows, segment_count
+
+
+# Returns the plan for segmenting a dataset of data_length rows of row_bytes each, as a dict of the 'segment_size' and
+# 'analyze_batch_size' and the bounds they were chosen from.  Segments are sized to take about target_seconds of
+# analysis each at seconds_per_row, or are DEFAULT_SEGMENT_SIZE rows w/o an estimate, and to fit in the analysis
+# action's memory, then evened out so the last segment is not a small remainder.  Batches are bounded by both the
+# memory and the timeout of the action.
+def plan_segments(data_length, row_bytes, seconds_per_row=None, target_seconds=SEGMENT_PLAN_TARGET_SECONDS):
+    available_bytes = (ANALYZE_ACTION_MEMORY_MB - ANALYZE_RUNTIME_MEMORY_MB) * 1024 * 1024
+    rows_by_memory = max(1, available_bytes // max(1, row_bytes * ANALYZE_SEGMENT_COPIES))
+
+    rows_by_time = max(1, int(target_seconds / seconds_per_row)) if seconds_per_row else None
+
+    segment_size = max(1, min(rows_by_memory, rows_by_time or DEFAULT_SEGMENT_SIZE, data_length))
+
+    # Even out the segments, e.g., 10 rows in segments of at most 4 rows are split 4/3/3 rather than 4/4/2
+    segment_count = -(-data_length // segment_size)
+    if segment_count > 0:
+        segment_size = -(-data_length // segment_count)
+
+    batch_size = analyze_batch_size(segment_size * row_bytes)
+    if seconds_per_row:
+        batch_seconds = ANALYZE_ACTION_TIMEOUT_S * SEGMENT_PLAN_TIMEOUT_FRACTION
+        batch_size = max(1, min(batch_size, int(batch_seconds / (segment_size * seconds_per_row))))
+
+    return {
+        'segment_size': int(segment_size),
+        'analyze_batch_size': int(batch_size),
+        'data_length': int(data_length),
+        'row_bytes': int(row_bytes),
+        'rows_by_memory': int(rows_by_memory),
+        'rows_by_time': rows_by_time,
+        'seconds_per_row': seconds_per_row
+    }
+
+
+# Queries the global segment status view for the raw document's complete (or incomplete) segments, sorted by segment
+# index.  Keyword arguments are passed to the view, e.g., reduce=True to count the segments.
+def segment_status_query(cloudant_db, raw_id, complete, **kwargs):
+    complete_flag = 1 if complete else 0
+
+    return cloudant_db.get_view_result(SEGMENT_DESIGN_DOC, SEGMENT_STATUS_VIEW, raw_result=True,
+                                       startkey=[raw_id, complete_flag], endkey=[raw_id, complete_flag, { }], **kwargs)
+
+
+# Queries the global segment status view to determine if any segments of the raw document have not been analyzed.  A
+# small number of segments reported as incomplete are read directly, in case the view has not yet indexed their latest
+# revision.
+def is_analysis_complete(cloudant_db, raw_id):
+    try:
+        count_result = segment_status_query(cloudant_db, raw_id, False, reduce=True)
+        incomplete_count = count_result['rows'][0]['value'] if len(count_result['rows']) > 0 else 0
+        if incomplete_count == 0:
+            return True
+        elif incomplete_count > CLOUDANT_VERIFY_LIMIT:
+            return False
+
+        view_result = segment_status_query(cloudant_db, raw_id, False, reduce=False)
+        for row in view_result['rows']:
+            segment_doc = Document(cloudant_db, row['id'])
+            if segment_doc.exists():
+                segment_doc.fetch()
+                if 'compute_end' not in segment_doc:
+                    return False
+    except HTTPError as err:
+        logging.error(f'Segment status view "{err.response.status_code}" error! ({raw_id})')
+        return False
+
+    return True
+
+
+# Marks the raw document as 'analyzed' once it is fully segmented and every segment has been analyzed, which triggers
+# the reassembly Function through the reassemble_segments filter.  The raw document's _rev serves as a compare-and-swap,
+# so only one of any concurrent callers makes the change.  Returns True if this call marked the document.
+def mark_analysis_complete(cloudant_db, raw_id):
+    raw_doc = Document(cloudant_db, raw_id)
+
+    for _ in range(CLOUDANT_409_RETRIES):
+        raw_doc.fetch()
+
+        # Segment documents may still be being created, or another invocation has already marked the document
+        if SEGMENT_TYPE not in raw_doc or raw_doc[SEGMENT_TYPE].get('status') != 'segmented':
+            return False
+
+        if is_analysis_complete(cloudant_db, raw_id) == False:
+            return False
+
+        raw_doc[SEGMENT_TYPE]['status'] = 'analyzed'
+
+        try:
+            raw_doc.save()
+        except HTTPError as err:
+            if err.response.status_code == 409:
+                logging.warning(f'409 HTTPError: attempting to re-save ({raw_id})')
+            else:
+                raise
+        else:
             return True
 
     return False
 
 
+# Returns the owner ID for leases taken by this invocation, i.e., its activation ID when run as a Function
+def lease_owner():
+    return os.environ.get('__OW_ACTIVATION_ID') or uuid.uuid4().hex
+
+
+# Returns the seconds left before this invocation's deadline, i.e., its start plus the action's timeout, or None when
+# not run as a Function
+def invocation_seconds_left():
+    deadline = os.environ.get('__OW_DEADLINE')
+    if not deadline:
+        return None
+
+    return int(deadline) / 1000 - time.time()
+
+
+# Starts a non-blocking invocation of the segmentation Function for the raw document through its API, i.e., as done by
+# cloud_burst_input.py to start a job, or by segmentation itself to continue from its checkpoint.  Returns the response.
+def fn_api_invoke(doc_id):
+    import requests
+
+    head = {
+        "Content-Type": "application/json",
+        "X-IBM-Client-Id": ibm_creds.FN_API_KEY,
+        "X-Debug-Mode": "true"
+    }
+
+    return requests.post(ibm_creds.FN_API_ROUTE, headers=head, json={ 'id': doc_id })
+
+
+# Adds the lease counts of an invocation to the totals for this Function container
+def record_lease_counts(counts):
+    for key in _lease_stats:
+        _lease_stats[key] += counts.get(key, 0)
+
+
+def lease_stats():
+    return dict(_lease_stats)
+
+
+# Claims the segment documents for analysis by the owner, w/a lease expiring after lease_seconds, in a single bulk
+# request in which each document's _rev serves as a compare-and-swap.  Segments already analyzed, or held under another
+# owner's unexpired lease, are skipped, while expired leases are reclaimed.  Each claim counts as an attempt at the
+# segment's analysis.  Returns the documents claimed, w/their _rev updated, and counts of the segments 'claimed' (of
+# which 'reclaimed' after expiry), 'contended' by another owner and 'skipped' as already analyzed.
+def cloudant_claim_segments(cloudant_db, docs, owner, lease_seconds=SEGMENT_LEASE_SECONDS):
+    counts = { 'claimed': 0, 'reclaimed': 0, 'contended': 0, 'skipped': 0 }
+    now = time.time()
+
+    candidates = []
+    expired_ids = set()
+    for doc in docs:
+        claim = doc.get('claim')
+        if 'compute_end' in doc:
+            counts['skipped'] += 1
+            continue
+        elif claim is not None and claim.get('owner') != owner:
+            if claim.get('expires', 0) > now:
+                counts['contended'] += 1
+                continue
+            expired_ids.add(doc['_id'])
+
+        doc['claim'] = { 'owner': owner, 'expires': now + lease_seconds }
+        doc['attempts'] = doc.get('attempts', 0) + 1
+        candidates.append(doc)
+
+    failed_ids = set(failure.get('id') for failure in cloudant_bulk_save(cloudant_db, candidates, conflicts_ok=False))
+    claimed = [ doc for doc in candidates if doc['_id'] not in failed_ids ]
+
+    counts['claimed'] = len(claimed)
+    counts['reclaimed'] = len([ doc for doc in claimed if doc['_id'] in expired_ids ])
+    counts['contended'] += len(candidates) - len(claimed)
+
+    return claimed, counts
+
+
+# Releases the claims of segment documents that were not analyzed, e.g., after a download failure, or whose lease has
+# expired, and re-queues them as new analysis batches of up to batch_size segments of the same raw document.  The first
+# segment of each batch becomes its lead, so saving it w/o a claim passes the analyze_segment filter and triggers its
+# analysis again.  Leads are saved after the rest of their batches, as by create_segments.  Segments already claimed
+# SEGMENT_MAX_ATTEMPTS times are released but not re-queued, keeping the error for inspection.  Returns the number of
+# segments re-queued.
+def release_segments(cloudant_db, docs, batch_size=1, error=None):
+    lead_docs = []
+    other_docs = []
+    queued_ids = set()
+
+    docs = sorted(docs, key=lambda doc: (doc['raw_id'], int(doc['id'][1:])))
+    for raw_id, raw_docs in itertools.groupby(docs, key=lambda doc: doc['raw_id']):
+        queued_docs = []
+
+        for doc in raw_docs:
+            doc.pop('claim', None)
+            doc.pop('batch_ids', None)
+            doc['batch_lead'] = 'false'
+            if error is not None:
+                doc['last_error'] = error
+
+            if doc.get('attempts', 0) < SEGMENT_MAX_ATTEMPTS:
+                queued_docs.append(doc)
+                queued_ids.add(doc['_id'])
+            else:
+                logging.error(f'Segment not re-queued after {doc["attempts"]} attempts! ({doc["_id"]}:{doc.get("last_error")})')
+                other_docs.append(doc)
+
+        for batch_start in range(0, len(queued_docs), max(1, batch_size)):
+            batch = queued_docs[batch_start:batch_start + max(1, batch_size)]
+            batch[0]['batch_lead'] = 'true'
+            batch[0]['batch_ids'] = [ doc['_id'] for doc in batch ]
+            lead_docs.append(batch[0])
+            other_docs += batch[1:]
+
+    # A conflict means the segment has since been saved by another invocation, e.g., analyzed or already released
+    failed_ids = set(failure.get('id') for failure in cloudant_bulk_save(cloudant_db, other_docs, conflicts_ok=False))
+    failed_ids.update(failure.get('id') for failure in cloudant_bulk_save(cloudant_db, lead_docs, conflicts_ok=False))
+
+    return len(queued_ids - failed_ids)
+
+
+# Releases and re-queues the unanalyzed segments whose lease has expired, i.e., whose analyzing invocation crashed or
+# timed out w/o saving or releasing them, as found through the expired claims view.  A claim saved to a segment does
+# not pass the analyze_segment filter, so w/o this such segments would never be analyzed.  Run periodically by the
+# reclaimSegmentsAlarm Function.  Returns the number of segments re-queued.
+def reclaim_expired_segments(cloudant_db, limit=RECLAIM_LIMIT):
+    result = cloudant_db.get_view_result(SEGMENT_DESIGN_DOC, EXPIRED_CLAIMS_VIEW, raw_result=True, endkey=time.time(), include_docs=True, limit=limit)
+    docs = [ row['doc'] for row in result['rows'] if row.get('doc') is not None ]
+
+    requeued = 0
+    for raw_id, raw_docs in itertools.groupby(sorted(docs, key=lambda doc: doc['raw_id']), key=lambda doc: doc['raw_id']):
+        raw_doc = cloudant_get_docs(cloudant_db, [raw_id])[0]
+        batch_size = raw_doc[SEGMENT_TYPE].get('analyze_batch_size', 1) if raw_doc is not None and SEGMENT_TYPE in raw_doc else 1
+
+        requeued += release_segments(cloudant_db, list(raw_docs), batch_size, error='Lease expired')
+
+    return requeued
+
+
+# Returns the resident set size of this process in bytes, or None if it cannot be read
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Returns the resource, e.g., a model or lookup table, of the given name for the version of the analytical code, calling
+# loader() to create it only if it is not already cached by this Function container.  Resources are kept in an LRU
+# cache bounded by RESOURCE_CACHE_MAX_ITEMS and RESOURCE_CACHE_MAX_BYTES, w/the size of each estimated from the growth
+# in RSS while it was loaded unless given as size_bytes.  Other versions of the same resource are evicted on load.
+def cached_resource(version, name, loader, size_bytes=None):
+    key = (version, name)
+
+    with _resource_lock:
+        items = _resource_cache['items']
+        if key in items:
+            items.move_to_end(key)
+            _resource_cache['hits'] += 1
+            return items[key][0]
+
+        _resource_cache['misses'] += 1
+        for stale_key in [ item_key for item_key in items if item_key[1] == name ]:
+            _resource_cache['bytes'] -= items.pop(stale_key)[1]
+
+        rss_before = rss_bytes()
+        resource = loader()
+        if size_bytes is None:
+            rss_after = rss_bytes()
+            size_bytes = max(0, rss_after - rss_before) if rss_before is not None and rss_after is not None else 0
+
+        items[key] = (resource, size_bytes)
+        _resource_cache['bytes'] += size_bytes
+
+        while len(items) > 1 and (len(items) > RESOURCE_CACHE_MAX_ITEMS or _resource_cache['bytes'] > RESOURCE_CACHE_MAX_BYTES):
+            evicted_key, (_, evicted_bytes) = items.popitem(last=False)
+            _resource_cache['bytes'] -= evicted_bytes
+            logging.info(f'Evicted cached resource {evicted_key} ({evicted_bytes} bytes)')
+
+    return resource
+
+
+def resource_cache_stats():
+    return { 'items': len(_resource_cache['items']), 'bytes': _resource_cache['bytes'], 'hits': _resource_cache['hits'], 'misses': _resource_cache['misses'] }
+
+
+# Returns the peak resident set size of this process in bytes, since the last call to profile_start() where the kernel
+# allows the peak to be reset, or else since the process started
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Returns a new profile of an invocation of the named Function, recording the wall and CPU time of its phases w/
+# profile_phase().  The peak RSS is reset, and tracemalloc started if tracemalloc_top > 0.
+def profile_start(name, tracemalloc_top=PROFILE_TRACEMALLOC_TOP):
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+    if tracemalloc_top > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return { 'name': name, 'phases': collections.OrderedDict(), 'tracemalloc_top': tracemalloc_top }
+
+
+# Records the wall and CPU time, in seconds, spent in the w/block as the named phase of the profile.  CPU time includes
+# all threads of the process.  Repeated phases accumulate.
+@contextlib.contextmanager
+def profile_phase(profile, phase):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield
+    finally:
+        wall, cpu = profile['phases'].get(phase, (0.0, 0.0))
+        profile['phases'][phase] = (wall + time.perf_counter() - wall_start, cpu + time.process_time() - cpu_start)
+
+
+# Returns the compact form of the profile stored on documents, i.e., [wall, cpu] seconds per phase and the peak RSS
+def profile_summary(profile):
+    return {
+        'phases': { phase: [round(wall, 3), round(cpu, 3)] for phase, (wall, cpu) in profile['phases'].items() },
+        'peak_rss': peak_rss_bytes()
+    }
+
+
+# Emits the profile as a single JSON log line, w/any additional fields, e.g., the document ID, plus the top allocators
+# if tracemalloc is enabled, then stops tracemalloc.  Returns the compact profile.
+def profile_finish(profile, **fields):
+    summary = profile_summary(profile)
+    log_line = dict(fields, profile=profile['name'], **summary)
+
+    if profile['tracemalloc_top'] > 0 and tracemalloc.is_tracing():
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:profile['tracemalloc_top']]
+        log_line['tracemalloc'] = [ [f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', stat.size] for stat in statistics ]
+        tracemalloc.stop()
+
+    print(json.dumps(log_line))
+
+    return summary
+
+
+# Returns whether the item exists from the existence cache, or None if it is not cached or has expired
+def _cos_exists_cached(bucket_name, item_name):
+    with _cos_exists_lock:
+        entry = _cos_exists_cache.get((bucket_name, item_name))
+
+    if entry is None or entry[1] < time.monotonic():
+        return None
+
+    return entry[0]
+
+
+def _cos_exists_remember(bucket_name, item_names, exists):
+    expires = time.monotonic() + COS_EXISTS_CACHE_TTL
+
+    with _cos_exists_lock:
+        for item_name in item_names:
+            _cos_exists_cache[(bucket_name, item_name)] = (exists, expires)
+            _cos_exists_cache.move_to_end((bucket_name, item_name))
+
+        while len(_cos_exists_cache) > COS_EXISTS_CACHE_MAX_ITEMS:
+            _cos_exists_cache.popitem(last=False)
+
+
+# Checks for the item w/a HEAD request, rather than listing its prefix, which slows as the prefix fills.  Results are
+# cached for COS_EXISTS_CACHE_TTL seconds, so an item written or deleted by another process may be briefly stale.
+def cos_item_exists(bucket_name, item_name):
+    exists = _cos_exists_cached(bucket_name, item_name)
+    if exists is not None:
+        return exists
+
+    try:
+        cos_client().head_object(Bucket=bucket_name, Key=item_name)
+        exists = True
+    except cos_client_error() as ce:
+        if ce.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
+            raise
+        exists = False
+
+    _cos_exists_remember(bucket_name, [item_name], exists)
+
+    return exists
+
+
+# Returns whether each of the items exists, in order, answering the uncached items from a single listing of the prefix,
+# by default their longest common prefix.  Suits many items under the same prefix, e.g., the segments of a job, where
+# a listing of up to 1000 keys per request replaces a HEAD request per item.  A single uncached item is checked w/HEAD.
+def cos_items_exist(bucket_name, item_names, prefix=None):
+    results = { item_name: _cos_exists_cached(bucket_name, item_name) for item_name in item_names }
+    unknown = [ item_name for item_name, exists in results.items() if exists is None ]
+
+    if len(unknown) == 1:
+        results[unknown[0]] = cos_item_exists(bucket_name, unknown[0])
+    elif len(unknown) > 1:
+        if prefix is None:
+            prefix = os.path.commonprefix(unknown)
+        logging.info(f'{bucket_name}:{prefix}:{len(unknown)} items')
+
+        keys = set()
+        try:
+            for page in cos_client().get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                keys.update([ item['Key'] for item in page.get('Contents', []) ])
+        except cos_client_error() as ce:
+            logging.exception(f'ClientError occurred! ({bucket_name}:{prefix})', exc_info=ce)
+            raise
+
+        for item_name in unknown:
+            results[item_name] = item_name in keys
+        _cos_exists_remember(bucket_name, [ item_name for item_name in unknown if results[item_name] ], True)
+        _cos_exists_remember(bucket_name, [ item_name for item_name in unknown if not results[item_name] ], False)
+
+    return [ results[item_name] for item_name in item_names ]
+
+
 def cos_download_file(bucket_name, item_name, file_path):
     logging.info(f'{bucket_name}:{item_name}:{file_path}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).download_file(file_path)
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).download_file(file_path)
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=ce)
         raise
     except Exception as e:
@@ -126,9 +888,9 @@ def cos_get_item_contents(bucket_name, item_name):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        item = COS_RESOURCE.Object(bucket_name, item_name).get()
+        item = cos_client().get_object(Bucket=bucket_name, Key=item_name)
         item_contents = item['Body'].read()
-    except ClientError as ce:
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
@@ -142,17 +904,30 @@ def cos_create_text_file(bucket_name, item_name, file_text):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).put(Body=file_text)
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).put(Body=file_text)
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], True)
+
     return item_name
 
 
+def _cos_transfer_config():
+    from ibm_boto3.s3.transfer import TransferConfig
+
+    # set 15 MB threshold
+    threshold = 1024 * 1024 * 15
+    # set 5 MB chunk size
+    chunksize = 1024 * 1024 * 5
+
+    return TransferConfig(multipart_threshold=threshold, multipart_chunksize=chunksize)
+
+
 def cos_multi_part_upload(bucket_name, item_name, file_path, overwrite=False):
     logging.info(f'{bucket_name}:{item_name}:{file_path}')
 
@@ -160,23 +935,577 @@ def cos_multi_part_upload(bucket_name, item_name, file_path, overwrite=False):
     if overwrite == False and cos_item_exists(bucket_name, item_name):
         return item_name
 
-    # set 15 MB threshold
-    threshold = 1024 * 1024 * 15
-    # set 5 MB chunk size
-    chunksize = 1024 * 1024 * 5
-
     try:
         # upload_fileobj() will execute a multi-part upload in <chunksize> MB chunks for all files over <threshold> MB
-        transfer_config = ibm_boto3.s3.transfer.TransferConfig(multipart_threshold=threshold, multipart_chunksize=chunksize)
+        # Uses the thread-safe client so that segments may be uploaded concurrently
         with open(file_path, 'rb') as file_data:
-            COS_RESOURCE.Object(bucket_name, item_name).upload_fileobj(Fileobj=file_data, Config=transfer_config)
-    except ClientError as ce:
+            cos_client().upload_fileobj(Fileobj=file_data, Bucket=bucket_name, Key=item_name, Config=_cos_transfer_config())
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], True)
+
+    return item_name
+
+
+# Returns the bytes in [start, end) of the item w/a ranged GET
+def cos_get_range(bucket_name, item_name, start, end):
+    logging.info(f'{bucket_name}:{item_name}:{start}-{end}')
+
+    try:
+        item = cos_client().get_object(Bucket=bucket_name, Key=item_name, Range=f'bytes={start}-{end - 1}')
+        item_contents = item['Body'].read()
+    except cos_client_error() as ce:
+        logging.exception(f'ClientError occurred! ({bucket_name}:{item_name}:{start}-{end})', exc_info=ce)
+        raise
+    except Exception as e:
+        logging.exception(f'Exception occurred! ({bucket_name}:{item_name}:{start}-{end})', exc_info=e)
+        raise
+
+    return item_contents
+
+
+# Read-only, seekable file object over a COS item that fetches its contents on demand w/ranged GETs.  Small reads are
+# served from an LRU cache of blocks, which suits libraries such as h5py that make many small metadata reads, while
+# reads of at least a block are fetched directly.  Raises ClientError when created if the item does not exist.
+class CosRangeFile(io.RawIOBase):
+    def __init__(self, bucket_name, item_name, block_size=COS_RANGE_BLOCK_SIZE, cache_blocks=COS_RANGE_CACHE_BLOCKS):
+        self.bucket_name = bucket_name
+        self.item_name = item_name
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.size = cos_client().head_object(Bucket=bucket_name, Key=item_name)['ContentLength']
+        self._position = 0
+        self._blocks = collections.OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+
+        self._position = max(offset, 0)
+
+        return self._position
+
+    def _block(self, block_index):
+        if block_index in self._blocks:
+            self._blocks.move_to_end(block_index)
+            return self._blocks[block_index]
+
+        block_start = block_index * self.block_size
+        block = cos_get_range(self.bucket_name, self.item_name, block_start, min(block_start + self.block_size, self.size))
+
+        self._blocks[block_index] = block
+        if len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+
+        return block
+
+    def readinto(self, b):
+        b = memoryview(b).cast('B')
+        count = 0
+
+        while count < len(b) and self._position < self.size:
+            if len(b) - count >= self.block_size:
+                data = cos_get_range(self.bucket_name, self.item_name, self._position, min(self._position + len(b) - count, self.size))
+            else:
+                block_index, block_offset = divmod(self._position, self.block_size)
+                data = memoryview(self._block(block_index))[block_offset:]
+
+            n = min(len(b) - count, len(data))
+            b[count:count + n] = data[:n]
+            count += n
+            self._position += n
+
+        return count
+
+
+# File object writing an item to COS w/a multipart upload, each part being uploaded as soon as part_size bytes have been
+# written, so that the upload overlaps the writes.  At most max_in_flight parts are uploaded concurrently, w/write()
+# blocking until one completes, which bounds memory to about (max_in_flight + 1) * part_size.  The upload is completed
+# by close(), or aborted by abort() or by leaving a with block w/an exception, so no partial item is left in COS.
+class CosMultipartWriter(io.RawIOBase):
+    def __init__(self, bucket_name, item_name, part_size=COS_STREAM_PART_SIZE, max_in_flight=COS_STREAM_MAX_IN_FLIGHT):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.bucket_name = bucket_name
+        self.item_name = item_name
+        self.part_size = max(part_size, COS_MIN_PART_SIZE)
+        self._position = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._error = None
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError(f'Write to closed COS item! ({self.bucket_name}:{self.item_name})')
+
+        data = memoryview(b).cast('B')
+        self._buffer += data
+        self._position += len(data)
+
+        while len(self._buffer) >= self.part_size:
+            part_data = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload_part(part_data)
+
+        return len(data)
+
+    def _put_part(self, part_number, part_data):
+        try:
+            result = cos_client().upload_part(Bucket=self.bucket_name, Key=self.item_name, UploadId=self._upload_id, PartNumber=part_number, Body=part_data)
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._slots.release()
+
+        return result['ETag']
+
+    def _upload_part(self, part_data):
+        if self._upload_id is None:
+            self._upload_id = cos_client().create_multipart_upload(Bucket=self.bucket_name, Key=self.item_name)['UploadId']
+
+        if len(self._parts) == COS_MAX_PARTS:
+            raise ValueError(f'Writing {self.item_name} requires more than the maximum of {COS_MAX_PARTS} parts!')
+
+        self._slots.acquire()
+
+        # Fail on the first part that could not be uploaded, rather than continuing to write the rest of the item
+        if self._error is not None:
+            self._slots.release()
+            raise self._error
+
+        self._parts.append(self._executor.submit(self._put_part, len(self._parts) + 1, part_data))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            # Items smaller than a part are uploaded w/a single request
+            if self._upload_id is None:
+                cos_client().put_object(Bucket=self.bucket_name, Key=self.item_name, Body=bytes(self._buffer))
+            else:
+                if len(self._buffer) > 0:
+                    self._upload_part(bytes(self._buffer))
+
+                etags = [ part.result() for part in self._parts ]
+                cos_client().complete_multipart_upload(Bucket=self.bucket_name, Key=self.item_name, UploadId=self._upload_id,
+                                                       MultipartUpload={ 'Parts': [ { 'ETag': etag, 'PartNumber': part_number } for part_number, etag in enumerate(etags, 1) ] })
+        except Exception as e:
+            logging.exception(f'Exception occurred! ({self.bucket_name}:{self.item_name})', exc_info=e)
+            self.abort()
+            raise
+
+        _cos_exists_remember(self.bucket_name, [self.item_name], True)
+
+        self._buffer = bytearray()
+        self._executor.shutdown()
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+
+        self._buffer = bytearray()
+
+        # Attributes are missing if __init__ raised before setting them, e.g., on an invalid max_in_flight
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown()
+
+        if getattr(self, '_upload_id', None) is not None:
+            cos_client().abort_multipart_upload(Bucket=self.bucket_name, Key=self.item_name, UploadId=self._upload_id)
+            self._upload_id = None
+
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # An item left unclosed, e.g., by an exception outside of a with block, is aborted rather than completed
+    def __del__(self):
+        self.abort()
+
+
+# Returns the (shape, fortran_order, dtype) of the .npy header at the start of the file object, leaving the file
+# positioned at the start of the array data, or None if the .npy format version is not 1.0 or 2.0
+def _read_npy_header(npy_file):
+    import numpy as np
+
+    version = np.lib.format.read_magic(npy_file)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(npy_file)
+    elif version == (2, 0):
+        return np.lib.format.read_array_header_2_0(npy_file)
+
+    return None
+
+
+# Returns the NumPy array contained in the .npy file bytes.  The array is created w/np.frombuffer over the bytes rather
+# than copied out of them, so it is read-only if the bytes are immutable.
+def array_from_npy_bytes(npy_bytes):
+    import numpy as np
+
+    npy_file = io.BytesIO(npy_bytes)
+    header = _read_npy_header(npy_file)
+    if header is None:
+        return np.load(io.BytesIO(npy_bytes))
+
+    shape, fortran_order, dtype = header
+
+    count = 1
+    for dim in shape:
+        count *= dim
+
+    data = np.frombuffer(npy_bytes, dtype=dtype, count=count, offset=npy_file.tell())
+    if fortran_order:
+        return data.reshape(shape[::-1]).transpose()
+
+    return data.reshape(shape)
+
+
+# Presents the .npy header and the array's memory as a single readable stream, so that arrays are uploaded to COS
+# w/o first being copied into a file or an in-memory buffer
+class _NpyReader(io.RawIOBase):
+    def __init__(self, array):
+        import numpy as np
+
+        header_file = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header_file, np.lib.format.header_data_from_array_1_0(array))
+
+        # Fortran-ordered arrays are written in memory order, as recorded in the header
+        if array.flags.f_contiguous and not array.flags.c_contiguous:
+            array = array.T
+        self._parts = [ memoryview(header_file.getvalue()), memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8)) ]
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._parts) > 0 and self._position >= len(self._parts[0]):
+            self._parts.pop(0)
+            self._position = 0
+
+        if len(self._parts) == 0:
+            return 0
+
+        count = min(len(b), len(self._parts[0]) - self._position)
+        b[:count] = self._parts[0][self._position:self._position + count]
+        self._position += count
+
+        return count
+
+
+# Returns the bytes of the array as a .npy file
+def npy_bytes_from_array(array):
+    import numpy as np
+
+    npy_file = io.BytesIO()
+    np.save(npy_file, array)
+
+    return npy_file.getvalue()
+
+
+# Returns the .npy file bytes w/the bytes of the elements of its array data grouped by position, i.e., all first bytes,
+# then all second bytes, etc., which compresses better for numeric samples whose high-order bytes vary slowly.  The
+# .npy header is left in place, and is used to find the array data and its element size.  unshuffle reverses this.
+def _shuffle_npy_bytes(npy_bytes, unshuffle=False):
+    import numpy as np
+
+    npy_file = io.BytesIO(npy_bytes)
+    header = _read_npy_header(npy_file)
+    if header is None:
+        raise ValueError('Unsupported .npy format version for byte shuffling!')
+
+    _, _, dtype = header
+    data_start = npy_file.tell()
+
+    data = np.frombuffer(npy_bytes, dtype=np.uint8, offset=data_start)
+    if dtype.itemsize > 1 and len(data) % dtype.itemsize == 0:
+        data = data.reshape((dtype.itemsize, -1) if unshuffle else (-1, dtype.itemsize)).T
+
+    shuffled = bytearray(npy_bytes[:data_start])
+    shuffled += np.ascontiguousarray(data).tobytes()
+
+    return bytes(shuffled)
+
+
+def _lz4_frame():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ValueError('The lz4 segment codecs require the lz4 package!')
+
+    return lz4.frame
+
+
+# Segment codecs by name, each an (encode, decode) pair of functions between the bytes of a .npy file and the bytes of a
+# segment item in COS.  'npy' items are plain .npy files, which alone may be composed server-side or read w/ranged GETs.
+# Further codecs may be added w/register_segment_codec().
+SEGMENT_CODECS = {
+    'npy': (lambda npy_bytes: npy_bytes, lambda item_bytes: item_bytes),
+    'zlib': (lambda npy_bytes: zlib.compress(npy_bytes, SEGMENT_CODEC_ZLIB_LEVEL),
+             lambda item_bytes: zlib.decompress(item_bytes)),
+    'shuffle-zlib': (lambda npy_bytes: zlib.compress(_shuffle_npy_bytes(npy_bytes), SEGMENT_CODEC_ZLIB_LEVEL),
+                     lambda item_bytes: _shuffle_npy_bytes(zlib.decompress(item_bytes), unshuffle=True)),
+    'lz4': (lambda npy_bytes: _lz4_frame().compress(npy_bytes),
+            lambda item_bytes: _lz4_frame().decompress(item_bytes)),
+    'shuffle-lz4': (lambda npy_bytes: _lz4_frame().compress(_shuffle_npy_bytes(npy_bytes)),
+                    lambda item_bytes: _shuffle_npy_bytes(_lz4_frame().decompress(item_bytes), unshuffle=True))
+}
+
+
+def register_segment_codec(codec, encode, decode):
+    SEGMENT_CODECS[codec] = (encode, decode)
+
+
+def _segment_codec(codec):
+    if codec not in SEGMENT_CODECS:
+        raise ValueError(f'Unknown segment codec "{codec}"!  Must be one of {list(SEGMENT_CODECS)}.')
+
+    return SEGMENT_CODECS[codec]
+
+
+# Returns the bytes of the segment item encoding the NumPy array w/the codec
+def encode_array(array, codec=DEFAULT_SEGMENT_CODEC):
+    encode, _ = _segment_codec(codec)
+
+    return encode(npy_bytes_from_array(array))
+
+
+# Returns the NumPy array decoded from the bytes of the segment item encoded w/the codec
+def decode_array(item_bytes, codec=DEFAULT_SEGMENT_CODEC):
+    _, decode = _segment_codec(codec)
+
+    return array_from_npy_bytes(decode(item_bytes))
+
+
+# Downloads the segment item into memory and returns it as a (read-only) NumPy array, w/o writing it to the file system.
+# Items encoded w/a codec other than 'npy' are decoded in memory.
+def cos_get_array(bucket_name, item_name, codec=DEFAULT_SEGMENT_CODEC):
+    if codec == 'npy':
+        return array_from_npy_bytes(cos_get_item_contents(bucket_name, item_name))
+
+    return decode_array(cos_get_item_contents(bucket_name, item_name), codec)
+
+
+# Reads a virtual segment, i.e., one that was not copied out of the raw input file, directly from the raw HDF5 file in
+# COS.  If the segment document lists the byte ranges holding its data, only those ranges are fetched; otherwise, e.g.,
+# for compressed datasets, the segment is read w/h5py through ranged reads of the file.
+def cos_get_virtual_segment(bucket_name, segment_doc):
+    import numpy as np
+
+    row_shape = tuple(segment_doc['row_shape'])
+    dtype = np.lib.format.descr_to_dtype(segment_doc['dtype'])
+    byte_ranges = segment_doc.get('byte_ranges')
+
+    if byte_ranges is not None and len(byte_ranges) == 1:
+        segment_bytes = cos_get_range(bucket_name, segment_doc['raw_cos_path'], byte_ranges[0][0], byte_ranges[0][1])
+    elif byte_ranges is not None:
+        segment_bytes = bytearray(sum(byte_end - byte_start for byte_start, byte_end in byte_ranges))
+        position = 0
+        for byte_start, byte_end in byte_ranges:
+            segment_bytes[position:position + byte_end - byte_start] = cos_get_range(bucket_name, segment_doc['raw_cos_path'], byte_start, byte_end)
+            position += byte_end - byte_start
+    else:
+        import h5py
+        with h5py.File(CosRangeFile(bucket_name, segment_doc['raw_cos_path']), 'r') as h5_file:
+            segment_data = h5_file[segment_doc['h5_dataset']][segment_doc['segment_start']:segment_doc['segment_end']]
+
+        return segment_data.reshape((-1,) + row_shape)
+
+    return np.frombuffer(segment_bytes, dtype=dtype).reshape((-1,) + row_shape)
+
+
+# Returns the (shape, fortran_order, dtype, data_start, data_end) of the .npy item, where [data_start, data_end) is the
+# byte range holding its array data, from a ranged GET of the item's header
+def cos_get_npy_layout(bucket_name, item_name):
+    try:
+        item = cos_client().get_object(Bucket=bucket_name, Key=item_name, Range=f'bytes=0-{NPY_HEADER_PROBE_SIZE - 1}')
+        npy_file = io.BytesIO(item['Body'].read())
+        item_size = int(item['ContentRange'].split('/')[-1])
+    except cos_client_error() as ce:
+        logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
+        raise
+
+    header = _read_npy_header(npy_file)
+    if header is None:
+        raise ValueError(f'Unsupported .npy format version! ({bucket_name}:{item_name})')
+
+    shape, fortran_order, dtype = header
+
+    return shape, fortran_order, dtype, npy_file.tell(), item_size
+
+
+# Returns the parts of a multipart upload concatenating the prefix bytes and the byte ranges, each (item_name, start,
+# end), in order.  Each part is ('copy', [range]), copied server-side, or ('upload', [pieces]), for the prefix and
+# ranges too small to be parts themselves, which are downloaded and uploaded together.  Every part but the last is at
+# least min_part_size.
+def _plan_compose_parts(byte_ranges, prefix=b'', min_part_size=COS_MIN_PART_SIZE, max_part_size=COS_MAX_PART_SIZE):
+    parts = []
+    pending = [prefix] if len(prefix) > 0 else []
+    pending_size = len(prefix)
+
+    for item_name, start, end in byte_ranges:
+        position = start
+
+        # Complete a pending upload part, or start one if this range is too small to be copied
+        if pending_size > 0 or end - start < min_part_size:
+            take = min(min_part_size - pending_size, end - position)
+            pending.append((item_name, position, position + take))
+            pending_size += take
+            position += take
+
+            if pending_size >= min_part_size:
+                parts.append(('upload', pending))
+                pending = []
+                pending_size = 0
+
+        remaining = end - position
+        if remaining >= min_part_size:
+            copy_count = -(-remaining // max_part_size)
+            for i in range(copy_count):
+                parts.append(('copy', [(item_name, position + remaining * i // copy_count, position + remaining * (i + 1) // copy_count)]))
+        elif remaining > 0:
+            pending.append((item_name, position, end))
+            pending_size += remaining
+
+    if len(pending) > 0:
+        parts.append(('upload', pending))
+
+    return parts
+
+
+# Copies or uploads the numbered part of the multipart upload, returning its ETag
+def _compose_part(bucket_name, item_name, upload_id, part_number, part):
+    part_type, byte_ranges = part
+
+    if part_type == 'copy':
+        source_name, start, end = byte_ranges[0]
+        result = cos_client().upload_part_copy(Bucket=bucket_name, Key=item_name, UploadId=upload_id, PartNumber=part_number,
+                                               CopySource={ 'Bucket': bucket_name, 'Key': source_name }, CopySourceRange=f'bytes={start}-{end - 1}')
+        return result['CopyPartResult']['ETag']
+
+    part_data = b''.join([ piece if isinstance(piece, bytes) else cos_get_range(bucket_name, *piece) for piece in byte_ranges ])
+    result = cos_client().upload_part(Bucket=bucket_name, Key=item_name, UploadId=upload_id, PartNumber=part_number, Body=part_data)
+
+    return result['ETag']
+
+
+# Creates the item as the concatenation of the array data of the .npy source items, in order, w/o their headers, i.e.,
+# the same bytes as writing each array in turn to a binary file, or if npy_header is True, as a .npy item of the arrays
+# concatenated along their first axis.  The item is composed server-side w/a multipart upload of parts copied from the
+# source items, so the data does not pass through this process, except for ranges too small to be parts, which are
+# buffered locally.  The source items must share a dtype, and row shape for npy_header, and be in C order.  Returns the
+# number of bytes of array data in the item.
+def cos_compose_npy_items(bucket_name, item_name, source_items, npy_header=False):
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    logging.info(f'{bucket_name}:{item_name}:{len(source_items)}')
+
+    with ThreadPoolExecutor(max_workers=COS_COMPOSE_CONCURRENCY) as executor:
+        layouts = list(executor.map(lambda source_name: cos_get_npy_layout(bucket_name, source_name), source_items))
+
+    byte_ranges = []
+    for source_name, (shape, fortran_order, dtype, data_start, data_end) in zip(source_items, layouts):
+        if dtype != layouts[0][2]:
+            raise ValueError(f'Data type of {source_name} ({dtype}) does not match {source_items[0]} ({layouts[0][2]})!')
+        if fortran_order and len([ dim for dim in shape if dim > 1 ]) > 1:
+            raise ValueError(f'{source_name} is not stored in C order!')
+        if npy_header and tuple(shape[1:]) != tuple(layouts[0][0][1:]):
+            raise ValueError(f'Shape of {source_name} {shape} does not match {source_items[0]} {layouts[0][0]}!')
+        if data_end > data_start:
+            byte_ranges.append((source_name, data_start, data_end))
+
+    header = b''
+    if npy_header:
+        if len(layouts) == 0:
+            raise ValueError(f'No source items from which to compose {item_name}!')
+
+        header_file = io.BytesIO()
+        shape = (sum(layout[0][0] if len(layout[0]) > 0 else 1 for layout in layouts),) + tuple(layouts[0][0][1:])
+        np.lib.format.write_array_header_1_0(header_file, { 'descr': np.lib.format.dtype_to_descr(layouts[0][2]), 'fortran_order': False, 'shape': shape })
+        header = header_file.getvalue()
+
+    parts = _plan_compose_parts(byte_ranges, header)
+    if len(parts) > COS_MAX_PARTS:
+        raise ValueError(f'Composing {item_name} requires {len(parts)} parts, more than the maximum of {COS_MAX_PARTS}!')
+
+    client = cos_client()
+    if len(parts) == 0:
+        client.put_object(Bucket=bucket_name, Key=item_name, Body=b'')
+        _cos_exists_remember(bucket_name, [item_name], True)
+        return 0
+
+    upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=item_name)['UploadId']
+    try:
+        with ThreadPoolExecutor(max_workers=COS_COMPOSE_CONCURRENCY) as executor:
+            etags = list(executor.map(lambda numbered_part: _compose_part(bucket_name, item_name, upload_id, numbered_part[0], numbered_part[1]), enumerate(parts, 1)))
+
+        client.complete_multipart_upload(Bucket=bucket_name, Key=item_name, UploadId=upload_id,
+                                         MultipartUpload={ 'Parts': [ { 'ETag': etag, 'PartNumber': part_number } for part_number, etag in enumerate(etags, 1) ] })
+    except Exception as e:
+        logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
+        client.abort_multipart_upload(Bucket=bucket_name, Key=item_name, UploadId=upload_id)
+        raise
+
+    _cos_exists_remember(bucket_name, [item_name], True)
+
+    return sum(end - start for _, start, end in byte_ranges)
+
+
+# Uploads the NumPy array as a .npy item, streaming it from memory w/o writing it to the file system, or as a segment
+# item encoded w/another codec in memory
+def cos_put_array(bucket_name, item_name, array, overwrite=False, codec=DEFAULT_SEGMENT_CODEC):
+    logging.info(f'{bucket_name}:{item_name}:{codec}')
+
+    # If not overwriting existing files and the file exists, just return
+    if overwrite == False and cos_item_exists(bucket_name, item_name):
+        return item_name
+
+    # Items w/a codec other than 'npy' are encoded in memory before upload
+    item_file = _NpyReader(array) if codec == 'npy' else io.BytesIO(encode_array(array, codec))
+
+    try:
+        cos_client().upload_fileobj(Fileobj=item_file, Bucket=bucket_name, Key=item_name, Config=_cos_transfer_config())
+    except cos_client_error() as ce:
+        logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
+        raise
+    except Exception as e:
+        logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
+        raise
+
+    _cos_exists_remember(bucket_name, [item_name], True)
+
     return item_name
 
 
@@ -184,17 +1513,193 @@ def cos_delete_item(bucket_name, item_name):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).delete()
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).delete()
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], False)
+
+    return item_name
+
+
+# Deletes the items w/multi-object delete requests of up to COS_DELETE_BATCH_SIZE keys each.  Returns a dict that maps
+# each key that could not be deleted to its error, which is empty if all were deleted.  As with single deletes, a key
+# that does not exist is not an error.
+def cos_delete_items(bucket_name, item_names):
+    failures = { }
+
+    # Remove duplicates while preserving order
+    item_names = list(dict.fromkeys(item_names))
+
+    for batch_start in range(0, len(item_names), COS_DELETE_BATCH_SIZE):
+        batch = item_names[batch_start:batch_start + COS_DELETE_BATCH_SIZE]
+        logging.info(f'{bucket_name}:{batch[0]}:{len(batch)} items')
+
+        try:
+            response = cos_client().delete_objects(Bucket=bucket_name, Delete={ 'Objects': [ { 'Key': item_name } for item_name in batch ], 'Quiet': True })
+        except cos_client_error() as ce:
+            logging.exception(f'ClientError occurred! ({bucket_name}:{batch[0]}:{len(batch)} items)', exc_info=ce)
+            for item_name in batch:
+                failures[item_name] = str(ce)
+            continue
+
+        # Quiet mode only reports the keys that could not be deleted
+        for error in response.get('Errors', []):
+            failures[error['Key']] = f'{error.get("Code")}: {error.get("Message")}'
+
+    for item_name, error in failures.items():
+        logging.error(f'Unable to delete item! ({bucket_name}:{item_name}:{error})')
+
+    _cos_exists_remember(bucket_name, [ item_name for item_name in item_names if item_name not in failures ], False)
+
+    return failures
+
+
+# Copies the source item to the item server-side, w/o downloading it
+def cos_copy_item(source_bucket_name, source_name, bucket_name, item_name):
+    logging.info(f'{source_bucket_name}:{source_name}:{bucket_name}:{item_name}')
+
+    try:
+        cos_client().copy_object(Bucket=bucket_name, Key=item_name, CopySource={ 'Bucket': source_bucket_name, 'Key': source_name })
+    except cos_client_error() as ce:
+        logging.exception(f'ClientError occurred! ({source_bucket_name}:{source_name}:{bucket_name}:{item_name})', exc_info=ce)
+        raise
+    except Exception as e:
+        logging.exception(f'Exception occurred! ({source_bucket_name}:{source_name}:{bucket_name}:{item_name})', exc_info=e)
+        raise
+
+    _cos_exists_remember(bucket_name, [item_name], True)
+
     return item_name
 
 
+# Returns the result cache key of the raw segment data analyzed by the version of the analytical code, w/its output
+# encoded by the codec
+def result_cache_key(array, sw_version, codec=DEFAULT_SEGMENT_CODEC):
+    import hashlib
+    import numpy as np
+
+    digest = hashlib.sha256(f'{sw_version}\0{codec}\0{np.lib.format.dtype_to_descr(array.dtype)}\0{array.shape}\0'.encode())
+    digest.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+
+    return digest.hexdigest()
+
+
+def result_cache_id(key):
+    return RESULT_CACHE_TYPE + '.' + key
+
+
+# Returns the name of the cache item of the key, w/its extension naming the codec of any output not stored as plain .npy
+def result_cache_item(key, codec=DEFAULT_SEGMENT_CODEC):
+    return RESULT_CACHE_PREFIX + key + ('.npy' if codec == 'npy' else '.npy.' + codec)
+
+
+# Copies the cached output of each (key, item_name) entry found in the result cache to the item, and records the hits
+# on their index documents.  Returns a list of whether each entry was a hit.  An entry whose cached item is missing,
+# e.g., when evicted concurrently, is a miss.
+def result_cache_fetch(cloudant_db, bucket_name, entries):
+    from concurrent.futures import ThreadPoolExecutor
+
+    index_docs = cloudant_get_docs(cloudant_db, list(dict.fromkeys([ result_cache_id(key) for key, _ in entries ])))
+    index_docs = { index_doc['_id']: index_doc for index_doc in index_docs if index_doc is not None }
+
+    def fetch(entry):
+        index_doc = index_docs.get(result_cache_id(entry[0]))
+        if index_doc is None:
+            return False
+
+        try:
+            cos_copy_item(index_doc['cos_bucket'], index_doc['cos_file'], bucket_name, entry[1])
+        except cos_client_error():
+            return False
+
+        return True
+
+    with ThreadPoolExecutor(max_workers=COS_COMPOSE_CONCURRENCY) as executor:
+        hits = list(executor.map(fetch, entries))
+
+    # A concurrent hit on the same entry may conflict, losing only its hit count
+    now = time.time()
+    hit_docs = { }
+    for (key, _), hit in zip(entries, hits):
+        if hit:
+            index_doc = hit_docs.setdefault(key, index_docs[result_cache_id(key)])
+            index_doc['hits'] = index_doc.get('hits', 0) + 1
+            index_doc['last_used'] = now
+    cloudant_bulk_save(cloudant_db, list(hit_docs.values()))
+
+    return hits
+
+
+# Adds the analyzed output item, encoded w/the codec, of each (key, item_name) entry to the result cache, copying it
+# into the cache and creating its index document, which records the codec.  The cache item's name is derived from the
+# key, so an entry added concurrently by another invocation, or whose index document outlived its item, is simply
+# overwritten w/the same output.
+def result_cache_store(cloudant_db, bucket_name, entries, sw_version, codec=DEFAULT_SEGMENT_CODEC):
+    index_docs = { }
+
+    for key, item_name in entries:
+        cache_item = result_cache_item(key, codec)
+        try:
+            cos_copy_item(bucket_name, item_name, bucket_name, cache_item)
+            size = cos_client().head_object(Bucket=bucket_name, Key=cache_item)['ContentLength']
+        except cos_client_error():
+            continue
+
+        index_docs[key] = {
+            '_id': result_cache_id(key),
+            'type': RESULT_CACHE_TYPE,
+            'cos_bucket': bucket_name,
+            'cos_file': cache_item,
+            'sw_version': sw_version,
+            'codec': codec,
+            'size': size,
+            'hits': 0,
+            'created': time.time(),
+            'last_used': time.time()
+        }
+
+    cloudant_bulk_save(cloudant_db, list(index_docs.values()))
+
+    return len(index_docs)
+
+
+# Evicts the result cache entries unused for ttl_days, and the least recently used entries while the cache exceeds
+# max_bytes, deleting their index documents and then their cache items.  Only the limit least recently used entries are
+# read, w/the size of the cache summed by the view's reduce.  An entry hit while being evicted keeps its index
+# document, and its item is kept.  Returns the number of entries evicted.
+def evict_result_cache(cloudant_db, ttl_days=RESULT_CACHE_TTL_DAYS, max_bytes=RESULT_CACHE_MAX_BYTES, limit=RESULT_CACHE_EVICT_LIMIT):
+    rows = cloudant_db.get_view_result(SEGMENT_DESIGN_DOC, RESULT_CACHE_VIEW, raw_result=True, reduce=True)['rows']
+    cache_bytes = rows[0]['value'] if len(rows) > 0 else 0
+
+    rows = cloudant_db.get_view_result(SEGMENT_DESIGN_DOC, RESULT_CACHE_VIEW, raw_result=True, reduce=False, include_docs=True, limit=limit)['rows']
+
+    expiry = time.time() - ttl_days * 24 * 60 * 60
+    evicted_docs = []
+    for row in rows:
+        if row['key'] >= expiry and cache_bytes <= max_bytes:
+            break
+
+        if row.get('doc') is not None:
+            evicted_docs.append(row['doc'])
+            cache_bytes -= row['value']
+
+    failed_ids = set([ failure.get('id') for failure in cloudant_bulk_delete(cloudant_db, evicted_docs) ])
+    evicted_docs = [ index_doc for index_doc in evicted_docs if index_doc['_id'] not in failed_ids ]
+
+    evicted_items = collections.defaultdict(list)
+    for index_doc in evicted_docs:
+        evicted_items[index_doc['cos_bucket']].append(index_doc['cos_file'])
+    for bucket_name, item_names in evicted_items.items():
+        cos_delete_items(bucket_name, item_names)
+
+    return len(evicted_docs)
+
+
 def aspera_file_upload(bucket_name, item_name, file_path, overwrite=False):
     logging.info(f'{bucket_name}:{item_name}:{file_path}')
 
@@ -202,26 +1707,22 @@ def aspera_file_upload(bucket_name, item_name, file_path, overwrite=False):
     if overwrite == False and cos_item_exists(bucket_name, item_name):
         return item_name
 
-    # Create Transfer manager
-    with AsperaTransferManager(COS_CLIENT) as transfer_manager:
+    # Perform upload w/the shared Transfer manager
+    future = aspera_transfer_manager().upload(file_path, bucket_name, item_name)
 
-        # Perform upload
-        future = transfer_manager.upload(file_path, bucket_name, item_name)
+    # Wait for upload to complete
+    future.result()
 
-        # Wait for upload to complete
-        future.result()
+    _cos_exists_remember(bucket_name, [item_name], True)
 
     return item_name
 
 
 def aspera_file_download(bucket_name, item_name, file_path):
-    # Create Transfer manager
-    with AsperaTransferManager(COS_CLIENT) as transfer_manager:
-
-        # Get object with Aspera
-        future = transfer_manager.download(bucket_name, item_name, file_path)
+    # Get object with Aspera w/the shared Transfer manager
+    future = aspera_transfer_manager().download(bucket_name, item_name, file_path)
 
-        # Wait for download to complete
-        future.result()
+    # Wait for download to complete
+    future.result()
 
     return item_name
@@ -3,7 +3,6 @@ import ibm_fn_helper as ifh
 import argparse
 import os
 import re
-import requests
 import sys
 
 
@@ -11,7 +10,12 @@ import sys
 _INPUT_FILE_EXT = r'\.h(df?)?5$'
 _INPUT_FILE_DESC = 'a directory containing <input_file_type> files, or a list of one or more <input_file_type> files to be processed'
 
-_SEGMENT_SIZE_DESC = f'an integer representing the number of data points in a segment.'
+_SEGMENT_SIZE_DESC = f'an integer representing the number of data points in a segment.  DEFAULT - planned from the input data length, the analysis Function\'s memory and timeout, and the analysis time of completed jobs'
+_SEGMENT_MODE_DESC = 'a string, DEFAULT - "copy" = segments are copied out of the input file to COS before analysis, "virtual" = segments are read for analysis directly from the input file w/ranged reads, w/no copy'
+_SEGMENT_CODEC_DESC = f'a string, DEFAULT - "{ifh.DEFAULT_SEGMENT_CODEC}" = segments are saved to COS as .npy files, "zlib" or "lz4" = compressed .npy files, "shuffle-zlib" or "shuffle-lz4" = compressed after byte shuffling, which suits numeric samples.  Only "npy" segments may be composed w/"-a compose".'
+_REASSEMBLE_MODE_DESC = 'a string, DEFAULT - "download" = analyzed segments are downloaded and written to the output file, "compose" = the output is composed in COS from the analyzed segments, w/o downloading them, when it is their concatenated array contents'
+_REDUCE_FAN_IN_DESC = 'an integer, DEFAULT - 0 = analyzed segments are reassembled by a single Function invocation, N > 1 = jobs w/more than N segments are reassembled by a tree of invocations, each merging N segments or partial outputs'
+_RESULT_CACHE_DESC = 'analyzed segment outputs are memoized in, and copied from, a result cache shared by jobs using it, so that segments whose raw data was already analyzed by the same code are not analyzed again.  Each output analyzed is then written to COS twice.  DEFAULT - the result cache is not used'
 _SUFFIX_DESC = 'a string suffix to append to the file name (w/out extension) as the job ID.  The provided value will be appended following a "." character.'
 
 _INPUT_RETENTION_FLAG_ = 'a string, DEFAULT - "t" = input file remains in database, "f" = input file will is deleted database'
@@ -30,13 +34,18 @@ _INPUT_JSON_TEMPLATE = {
     },
     ifh.SEGMENT_TYPE: {
         'status': 'pending',
-        'segment_size': ifh.DEFAULT_SEGMENT_SIZE,
+        'segment_size': None,
+        'segment_mode': 'copy',
+        'segment_codec': ifh.DEFAULT_SEGMENT_CODEC,
+        'reassemble_mode': 'download',
+        'reduce_fan_in': 0,
+        'use_result_cache': False,
         'debug_retention_flag': ''
     }
 }
 
 
-def submit_input_file(input_file_path, segment_size, suffix, input_retention_flag, debug_retention_flag):
+def submit_input_file(input_file_path, segment_size, segment_mode, segment_codec, reassemble_mode, reduce_fan_in, use_result_cache, suffix, input_retention_flag, debug_retention_flag):
     # Building Cloudant document
     path, filename = os.path.split(input_file_path)
     doc_id, _ = os.path.splitext(filename)
@@ -48,6 +57,11 @@ def submit_input_file(input_file_path, segment_size, suffix, input_retention_fla
     doc['raw']['local_path'] = path
     doc['raw']['cos_path'] = cos_path
     doc[ifh.SEGMENT_TYPE]['segment_size'] = segment_size
+    doc[ifh.SEGMENT_TYPE]['segment_mode'] = segment_mode
+    doc[ifh.SEGMENT_TYPE]['segment_codec'] = segment_codec
+    doc[ifh.SEGMENT_TYPE]['reassemble_mode'] = reassemble_mode
+    doc[ifh.SEGMENT_TYPE]['reduce_fan_in'] = reduce_fan_in
+    doc[ifh.SEGMENT_TYPE]['use_result_cache'] = use_result_cache
     doc['raw']['input_retention_flag'] = input_retention_flag
 
     # Setting values of individual debug flags
@@ -75,12 +89,7 @@ def submit_input_file(input_file_path, segment_size, suffix, input_retention_fla
     upload_doc = cloudant_obj['db'].create_document(doc)
 
     if upload_doc.exists():
-        head = {
-            "Content-Type": "application/json",
-            "X-IBM-Client-Id": ifh.ibm_creds.FN_API_KEY,
-            "X-Debug-Mode": "true"
-        }
-        res = requests.post(ifh.ibm_creds.FN_API_ROUTE, headers=head, json={ 'id': doc['_id'] })
+        res = ifh.fn_api_invoke(doc['_id'])
 
         if res.status_code == 200:
             print("Successfully created job for", filename)
@@ -95,7 +104,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('files', nargs='+', help=_INPUT_FILE_DESC, type=str)
-    parser.add_argument('-z', '--segment_size', help=_SEGMENT_SIZE_DESC, type=int, default=ifh.DEFAULT_SEGMENT_SIZE)
+    parser.add_argument('-z', '--segment_size', help=_SEGMENT_SIZE_DESC, type=int, default=None)
+    parser.add_argument('-m', '--segment_mode', help=_SEGMENT_MODE_DESC, type=str, choices=['copy', 'virtual'], default='copy')
+    parser.add_argument('-c', '--segment_codec', help=_SEGMENT_CODEC_DESC, type=str, choices=list(ifh.SEGMENT_CODECS), default=ifh.DEFAULT_SEGMENT_CODEC)
+    parser.add_argument('-a', '--reassemble_mode', help=_REASSEMBLE_MODE_DESC, type=str, choices=['download', 'compose'], default='download')
+    parser.add_argument('-f', '--reduce_fan_in', help=_REDUCE_FAN_IN_DESC, type=int, default=0)
+    parser.add_argument('-k', '--use_result_cache', help=_RESULT_CACHE_DESC, action='store_true')
     parser.add_argument('-s', '--suffix', help=_SUFFIX_DESC, type=str, default='')
     parser.add_argument('-r', '--input_retention_flag', help=_INPUT_RETENTION_FLAG_, type=str, default='t')
     parser.add_argument('-d', '--debug_retention_flag', action='append', help=_DEBUG_RETENTION_FLAG_, default=[])
@@ -103,6 +117,11 @@ if __name__ == '__main__':
 
     input_files = args.files
     segment_size = args.segment_size
+    segment_mode = args.segment_mode
+    segment_codec = args.segment_codec
+    reassemble_mode = args.reassemble_mode
+    reduce_fan_in = args.reduce_fan_in
+    use_result_cache = args.use_result_cache
     input_retention_flag = args.input_retention_flag
     debug_retention_flag = args.debug_retention_flag
 
@@ -120,10 +139,10 @@ if __name__ == '__main__':
             for dir_input_file in os.listdir(input_file):
                 dir_input_file = os.path.join(input_file, dir_input_file)
                 if os.path.isfile(dir_input_file) and re.search(_INPUT_FILE_EXT, dir_input_file, flags=re.IGNORECASE):
-                    submit_input_file(dir_input_file, segment_size, suffix, input_retention_flag, debug_retention_flag)
+                    submit_input_file(dir_input_file, segment_size, segment_mode, segment_codec, reassemble_mode, reduce_fan_in, use_result_cache, suffix, input_retention_flag, debug_retention_flag)
         elif os.path.isfile(input_file):
             if re.search(_INPUT_FILE_EXT, input_file, flags=re.IGNORECASE):
-                submit_input_file(input_file, segment_size, suffix, input_retention_flag, debug_retention_flag)
+                submit_input_file(input_file, segment_size, segment_mode, segment_codec, reassemble_mode, reduce_fan_in, use_result_cache, suffix, input_retention_flag, debug_retention_flag)
             else:
                 print(f'Argument "{input_file}" is not a valid input file!  Ignoring.')
 
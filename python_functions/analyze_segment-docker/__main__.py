@@ -1,46 +1,91 @@
 import ibm_fn_helper as ifh
-from analyze_segment import analyze_segment
+from analyze_segment import analyze_segments, load_model
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from ibm_botocore.exceptions import ClientError
+import gc, sys
 import numpy as np
-import gc, os, subprocess, sys
-from requests import HTTPError
 
 
 COMPUTE_TARGET = 'fn:analyzeSegmentChange'
 SW_VERSION = 'analysis_code:v0.1'  # i.e., a description and version of the analytical code
 
+# Number of segments of a batch downloaded from, or uploaded to, COS concurrently
+SEGMENT_TRANSFER_CONCURRENCY = 4
 
-def save_segment(doc):
-    result = False
+# The container exits, rather than remaining warm for reuse, once its resident memory exceeds this watermark, leaving
+# headroom below the action's 4096 MB limit for the next invocation's segments
+RSS_RECYCLE_WATERMARK = 3072 * 1024 * 1024
 
-    for _ in range(ifh.CLOUDANT_409_RETRIES):
-        try:
-            doc.save()
-        except HTTPError as err:
-            if err.response.status_code == 409:
-                print(f'409 HTTPError: attempting to re-save (analyze_segment:{doc["_id"]})')
+
+# Returns the documents of the lead segment's batch, w/the lead document first
+def get_batch_docs(cloudant_db, lead_doc):
+    batch_docs = [lead_doc]
+
+    batch_ids = [batch_id for batch_id in lead_doc.get('batch_ids', []) if batch_id != lead_doc['_id']]
+    for doc in ifh.cloudant_get_docs(cloudant_db, batch_ids):
+        if doc is not None and doc.get('type') == ifh.SEGMENT_TYPE:
+            batch_docs.append(doc)
+
+    return batch_docs
+
+
+# Downloads the segment's raw data from COS into memory, either from its copy encoded w/the segment's codec or, for a
+# virtual segment, directly from the raw input file
+def get_segment_data(doc):
+    if 'cos_file_raw' in doc:
+        return ifh.cos_get_array(doc['raw_cos_bucket'], doc['cos_file_raw'], doc.get('codec', ifh.DEFAULT_SEGMENT_CODEC))
+
+    return ifh.cos_get_virtual_segment(doc['raw_cos_bucket'], doc)
+
+
+# Saves the segment's analyzed data to COS from memory, encoded w/the segment's codec
+def put_segment_output(doc, analyzed_segment):
+    ifh.cos_put_array(doc['raw_cos_bucket'], doc['cos_file_output'], analyzed_segment, codec=doc.get('codec', ifh.DEFAULT_SEGMENT_CODEC))
+    now = datetime.now()
+    doc['compute_end'] = str(now)
+
+
+# Copies the cached output of each segment whose raw data has already been analyzed by this version of the analytical
+# code, marking it analyzed w/o running the analysis again.  Returns the documents, raw data and result cache keys of
+# the remaining segments, which are to be analyzed, and the documents of those copied from the cache.
+def apply_result_cache(cloudant_db, raw_docs, raw_data):
+    cache_keys = [ ifh.result_cache_key(segment_data, SW_VERSION, doc.get('codec', ifh.DEFAULT_SEGMENT_CODEC)) for doc, segment_data in zip(raw_docs, raw_data) ]
+    hits = ifh.result_cache_fetch(cloudant_db, raw_docs[0]['raw_cos_bucket'], [ (key, doc['cos_file_output']) for doc, key in zip(raw_docs, cache_keys) ])
+
+    miss_docs, miss_data, miss_keys, hit_docs = [], [], [], []
+    for doc, segment_data, key, hit in zip(raw_docs, raw_data, cache_keys, hits):
+        doc['cache'] = 'hit' if hit else 'miss'
+        if hit:
+            now = datetime.now()
+            doc['compute_end'] = str(now)
+            hit_docs.append(doc)
         else:
-            result = True
-            break
+            miss_docs.append(doc)
+            miss_data.append(segment_data)
+            miss_keys.append(key)
 
-    return result
+    return miss_docs, miss_data, miss_keys, hit_docs
 
 
-def main(data):
+# Analyzes the batch of segments led by the document, returning the Function's result
+def analyze_batch(data):
     doc_id = data['id']
 
     # Added with recommendation from IBM in an attempt to prevent OOM errors on repeated Function invocations
     gc.collect()
 
-    cloudant_obj = ifh.cloudant_init(doc_id)
+    # Top allocators may be listed w/o redeploying by setting the action's tracemalloc_top parameter
+    profile = ifh.profile_start('analyze_segment', data.get('tracemalloc_top', ifh.PROFILE_TRACEMALLOC_TOP))
+
+    with ifh.profile_phase(profile, 'init'):
+        cloudant_obj = ifh.cloudant_init(doc_id)
     if cloudant_obj['error'] is not None:
         return { 'error': cloudant_obj['error'] }
 
     # Validate JSON document for COS information
-    if 'raw_cos_bucket' not in cloudant_obj['doc'] or 'cos_file_raw' not in cloudant_obj['doc']:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'"raw_cos_bucket" and/or "cos_file_raw" not in document!')
+    if 'raw_cos_bucket' not in cloudant_obj['doc'] or ('cos_file_raw' not in cloudant_obj['doc'] and 'raw_cos_path' not in cloudant_obj['doc']):
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'"raw_cos_bucket" and/or "cos_file_raw" or "raw_cos_path" not in document!')
         return { 'error': cloudant_obj['error'] }
 
     # Validate JSON document for segment type
@@ -53,74 +98,180 @@ def main(data):
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
         return { 'continue': f'Analysis already complete (analyze_segment:{doc_id})' }
 
-    # If a segment to analyze was identified
-    cloudant_obj['doc']['sw_version'] = SW_VERSION
-    cloudant_obj['doc']['compute_target'] = COMPUTE_TARGET
+    # This segment leads a batch of segments, all of which are analyzed by this invocation
+    errors = []
+
+    # Lease the batch's segments before downloading them, so duplicate deliveries and retries do not repeat the
+    # analysis.  Segments that fail are released for another attempt, while if this invocation crashes or times out, its
+    # leases are left to expire, after which the segments are re-queued by reclaimSegmentsAlarm.
+    with ifh.profile_phase(profile, 'claim'):
+        batch_docs = get_batch_docs(cloudant_obj['db'], cloudant_obj['doc'])
+        batch_docs, lease_counts = ifh.cloudant_claim_segments(cloudant_obj['db'], batch_docs, ifh.lease_owner())
+    lease_counts['duplicate'] = 0
+
+    if len(batch_docs) == 0:
+        ifh.record_lease_counts(lease_counts)
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+        return { 'continue': f'Segment(s) leased by another invocation (analyze_segment:{doc_id})', 'leases': lease_counts }
 
-    cloudant_obj['doc']['cos_file_output'] = cloudant_obj['doc']['raw_id'] + '/' + ifh.SEGMENT_TYPE + '/' + cloudant_obj['doc']['id'] + '.npy'
+    # The segments of a batch share its compute_start, from which the batch is timed by ifh.analysis_seconds_per_row()
     now = datetime.now()
-    cloudant_obj['doc']['compute_start'] = str(now)
+    for doc in batch_docs:
+        doc['sw_version'] = SW_VERSION
+        doc['compute_target'] = COMPUTE_TARGET
 
-    # Download segment file from COS
-    cos_bucket = cloudant_obj['doc']['raw_cos_bucket']
-    cos_file_path = cloudant_obj['doc']['cos_file_raw']
-    local_segment_path = '/tmp/' + cos_file_path
-    os.makedirs(os.path.dirname(local_segment_path), exist_ok=True)
+        doc['cos_file_output'] = doc['raw_id'] + '/' + ifh.SEGMENT_TYPE + '/' + doc['id'] + '.npy'
+        doc['compute_start'] = str(now)
 
-    try:
-        ifh.cos_download_file(cos_bucket, cos_file_path, local_segment_path)
-    except ClientError:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'COS file "{cos_file_path}" does not exist!')
-        return { 'error': cloudant_obj['error'] }
+    # Download segment files from COS into memory
+    with ifh.profile_phase(profile, 'download'), ThreadPoolExecutor(max_workers=SEGMENT_TRANSFER_CONCURRENCY) as executor:
+        futures = [ executor.submit(get_segment_data, doc) for doc in batch_docs ]
 
-    raw_data = np.load(local_segment_path)
+    raw_docs = []
+    raw_data = []
+    failed_docs = []
+    for doc, future in zip(batch_docs, futures):
+        try:
+            raw_data.append(future.result())
+            raw_docs.append(doc)
+        except ifh.cos_client_error():
+            errors.append(f'COS file "{doc.get("cos_file_raw", doc.get("raw_cos_path"))}" does not exist!')
+            failed_docs.append(doc)
+
+    # Release the claims of the segments that could not be downloaded, re-queueing them for another attempt
+    if len(failed_docs) > 0:
+        ifh.release_segments(cloudant_obj['db'], failed_docs, len(failed_docs), error='COS file download failed')
+
+    if len(raw_docs) == 0:
+        ifh.record_lease_counts(lease_counts)
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error='\n'.join(errors))
+        ifh.profile_finish(profile, id=doc_id, segments=0)
+        return { 'error': cloudant_obj['error'], 'leases': lease_counts }
+
+    # Segments of jobs using the result cache whose results are already cached are not analyzed again
+    use_result_cache = cloudant_obj['doc'].get('use_result_cache') == 'true'
+    hit_docs = []
+    cache_keys = [ None ] * len(raw_docs)
+    if use_result_cache:
+        with ifh.profile_phase(profile, 'cache'):
+            raw_docs, raw_data, cache_keys, hit_docs = apply_result_cache(cloudant_obj['db'], raw_docs, raw_data)
+
+    analyzed_segments = []
+    if len(raw_docs) > 0:
+        # Models are loaded once per version of the analytical code and reused by warm invocations of this container
+        with ifh.profile_phase(profile, 'load'):
+            resources = { 'model': ifh.cached_resource(SW_VERSION, 'model', load_model) }
+
+        #### TODO: Run analysis algorithms on the batch of raw data segments (stacked into a single NumPy array)
+        with ifh.profile_phase(profile, 'analyze'):
+            segment_lengths = [ len(segment_data) for segment_data in raw_data ]
+            stacked_data = np.concatenate(raw_data) if len(raw_data) > 1 else raw_data[0]
+            del raw_data
+
+            analyzed_segments = analyze_segments(stacked_data, segment_lengths, resources)
+            del stacked_data
+
+    # Save analyzed data to COS
+    with ifh.profile_phase(profile, 'upload'), ThreadPoolExecutor(max_workers=SEGMENT_TRANSFER_CONCURRENCY) as executor:
+        futures = [ executor.submit(put_segment_output, doc, analyzed_segment) for doc, analyzed_segment in zip(raw_docs, analyzed_segments) ]
+
+    analyzed_docs = []
+    cache_entries = []
+    failed_docs = []
+    for doc, key, future in zip(raw_docs, cache_keys, futures):
+        try:
+            future.result()
+            doc.pop('claim', None)
+            analyzed_docs.append(doc)
+            cache_entries.append((key, doc['cos_file_output']))
+        except Exception as e:
+            errors.append(f'Exception occurred in {doc["_id"]}!\n{str(e)}')
+            failed_docs.append(doc)
+
+    del analyzed_segments
+
+    # Release the claims of the segments whose output could not be uploaded, re-queueing them for another attempt
+    if len(failed_docs) > 0:
+        ifh.release_segments(cloudant_obj['db'], failed_docs, len(failed_docs), error='COS output upload failed')
+
+    # Add the newly analyzed outputs to the result cache
+    if use_result_cache and len(cache_entries) > 0:
+        with ifh.profile_phase(profile, 'cache'):
+            ifh.result_cache_store(cloudant_obj['db'], cloudant_obj['doc']['raw_cos_bucket'], cache_entries, SW_VERSION, cloudant_obj['doc'].get('codec', ifh.DEFAULT_SEGMENT_CODEC))
+
+    for doc in hit_docs:
+        doc.pop('claim', None)
+    analyzed_docs += hit_docs
+
+    # The profile of the batch, up to this point, is stored on each of its segments
+    segment_profile = ifh.profile_summary(profile)
+    for doc in analyzed_docs:
+        doc['profile'] = segment_profile
+
+    # Update full JSON snippets for the batch's segments in a single bulk request.  A conflict means the segment's lease
+    # expired and was reclaimed by another invocation, so this analysis was a duplicate.
+    failed_ids = set()
+    with ifh.profile_phase(profile, 'doc_save'):
+        failures = ifh.cloudant_bulk_save(cloudant_obj['db'], analyzed_docs, conflicts_ok=False)
+
+    for failure in failures:
+        failed_ids.add(failure.get('id'))
+        if failure['error'] == 'conflict':
+            lease_counts['duplicate'] += 1
+            print(f'Lease lost, discarding duplicate analysis (analyze_segment:{failure.get("id")})')
+        else:
+            errors.append(f'Unable to save document {failure.get("id")}!')
 
-    #### TODO: Run analysis algorithms on this raw data segment (represented as a NumPy array)
-    analyzed_segment = analyze_segment(raw_data)
+    ifh.record_lease_counts(lease_counts)
 
-    try:
-        # Save analyzed data to COS
-        np.save(local_segment_path, analyzed_segment)
-        ifh.cos_multi_part_upload(cos_bucket, cloudant_obj['doc']['cos_file_output'], local_segment_path)
-        now = datetime.now()
-        cloudant_obj['doc']['compute_end'] = str(now)
+    saved_docs = [ doc for doc in analyzed_docs if doc['_id'] not in failed_ids ]
 
-        # Delete local tmp file
-        os.remove(local_segment_path)
+    # Delete COS raw files, other than S0 and any virtual segments of the raw input file
+    raw_items = [ doc['cos_file_raw'] for doc in saved_docs if doc['id'] != 'S0' and 'cos_file_raw' in doc ]
+    if len(raw_items) > 0:
+        ifh.cos_delete_items(cloudant_obj['doc']['raw_cos_bucket'], raw_items)
 
-    except Exception as e:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Exception occurred in {doc_id}!\n{str(e)}')
-        return { 'error': cloudant_obj['error'] }
+    # If these were the final outstanding segments, mark the raw document to trigger reassembly
+    if len(saved_docs) > 0 and ifh.mark_analysis_complete(cloudant_obj['db'], cloudant_obj['doc']['raw_id']):
+        print(f'All segments analyzed (analyze_segment:{doc_id})')
 
-    # Update full JSON snippet for this segment
-    result = save_segment(cloudant_obj['doc'])
-    if result == False:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Unable to save document!')
-        return { 'error': cloudant_obj['error'] }
+    segment_profile = ifh.profile_finish(profile, id=doc_id, segments=len(saved_docs))
 
-    # Delete COS raw file
-    if cloudant_obj['doc']['id'] != 'S0':
-        ifh.cos_delete_item(cos_bucket, cos_file_path)
+    if len(errors) > 0:
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error='\n'.join(errors))
+        return { 'error': cloudant_obj['error'], 'leases': lease_counts, 'profile': segment_profile }
 
     cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
 
-    message = f'Segment analyzed (analyze_segment:{doc_id})'
-    print(message)
+    message = f'{len(saved_docs)} segment(s) analyzed (analyze_segment:{doc_id})'
+    print(f'{message} leases={lease_counts}')
 
-    # Remaining lines are an attempt to prevent container reuse by the IBM Cloud w/the idea that intermittent
-    # failures of this Function are due to a memory leak causing later invocations to exceed the maximum permitted
-    # memory allocation.  Suggested by Michael Behrendt of IBM Cloud.
+    return { 'change': message, 'leases': lease_counts, 'profile': segment_profile }
 
-    #### TODO: Set any larger data structures to 'None' here
 
-    # Capture output from Linux 'free' command for debugging
-    # https://docs.python.org/3.6/library/subprocess.html
-    exec_output = subprocess.run(args=['free'], check=True, stdout=subprocess.PIPE, encoding='utf-8')
-    cmd_output = exec_output.stdout
-    mem_list = cmd_output.split('\n')[1].split()
-    mem_str = f'total={mem_list[1]}, used={mem_list[2]}, free={mem_list[3]}'
+# Releases this invocation's data, then recycles the container only if its memory has actually grown past the
+# watermark, e.g., due to a leak in the analysis libraries, so that warm reuse keeps cached models loaded.  Returns the
+# resident set size in bytes.
+def recycle_container():
+    gc.collect()
+    rss = ifh.rss_bytes()
+
+    if rss is not None and rss > RSS_RECYCLE_WATERMARK:
+        # NOTE: This prevents normal return of this Function, but ensures the next invocation gets a new container
+        sys.exit(f'rss={rss}')
+
+    return rss
+
 
-     # NOTE: This will prevent normal return of this Function, but it will prevent the memory leak in the container
-    sys.exit(mem_str)
+# The watermark is checked after every invocation, whether it succeeds, returns an error or raises, so a container that
+# leaks memory while failing does not keep taking work
+def main(data):
+    try:
+        result = analyze_batch(data)
+    finally:
+        rss = recycle_container()
 
-    return { 'change': message, 'free': mem_str }
+    result['rss'] = rss
+    result['resources'] = ifh.resource_cache_stats()
+
+    return result
@@ -3,10 +3,47 @@ import ibm_fn_helper as ifh
 import numpy as np
 
 
+#### TODO: Set to False if analyze_segment() does not return one row per row of its raw data, e.g., if it aggregates
+#### or resamples, so that each segment of a batch is analyzed separately rather than as part of the stacked batch.
+#### Segments reassembled into an HDF5 output must still keep their number of rows.
+ROW_PRESERVING = True
+
+
+# Load the model(s) and/or lookup tables used by the analysis algorithms.  Called once per version of the analytical
+# code by a warm Function container, w/the result cached in memory and passed to each analysis as resources['model'].
+def load_model():
+
+    #### TODO: Load models here, e.g., w/tensorflow or scikit-learn, from COS or the Docker image
+    model = None
+
+    return model
+
+
 # Run analysis algorithms on this raw data segment (represented as a NumPy array)
-def analyze_segment(raw_data):
+def analyze_segment(raw_data, resources=None):
 
     #### TODO: Define analysis algorithms here.  Return type is assumed to be a NumPy array.
     analyzed_data = raw_data
 
     return analyzed_data
+
+
+# Run analysis algorithms on a batch of raw data segments, stacked along the first axis into a single NumPy array, where
+# segment_lengths lists the number of rows from each segment.  Returns the analyzed data for each segment, in order.
+def analyze_segments(stacked_data, segment_lengths, resources=None):
+
+    #### TODO: Define vectorized analysis algorithms here.  By default, the stacked data is analyzed as a whole if
+    #### ROW_PRESERVING, which assumes rows are analyzed independently; set it to False if results depend on segment
+    #### bounds, or if the number of rows changes.
+    split_points = np.cumsum(segment_lengths)[:-1]
+    if not ROW_PRESERVING:
+        return [ analyze_segment(segment_data, resources) for segment_data in np.split(stacked_data, split_points) ]
+
+    analyzed_data = analyze_segment(stacked_data, resources)
+
+    # The analyzed data can only be split back into segments if it has a row for each raw row
+    analyzed_rows = len(analyzed_data) if np.ndim(analyzed_data) > 0 else 0
+    if analyzed_rows != len(stacked_data):
+        raise ValueError(f'Analysis returned {analyzed_rows} row(s) for {len(stacked_data)} raw row(s), so cannot be split into segments!  Set ROW_PRESERVING = False.')
+
+    return np.split(analyzed_data, split_points)
@@ -1,9 +1,5 @@
 import ibm_fn_helper as ifh
-from create_segments import create_segments
-
-from cloudant.design_document import DesignDocument
-from ibm_botocore.exceptions import ClientError
-import os
+from create_segments import create_segments, create_virtual_segments
 
 
 def main(data):
@@ -23,34 +19,65 @@ def main(data):
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
         return { 'continue': 'Segmentation already complete for {0}'.format(doc_id) }
 
-    cos_bucket = cloudant_obj['doc']['cos_bucket']
-    raw_cos_path = cloudant_obj['doc']['raw']['cos_path']
+    # Validate the codec of the segment items in COS
+    segment_codec = cloudant_obj['doc'][ifh.SEGMENT_TYPE].get('segment_codec', ifh.DEFAULT_SEGMENT_CODEC)
+    if segment_codec not in ifh.SEGMENT_CODECS:
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Unknown segment codec "{segment_codec}"!')
+        return { 'error': cloudant_obj['error'] }
 
-    # Download file from COS to file system
-    local_file_path = '/tmp/' + raw_cos_path
-    os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+    raw_cos_path = cloudant_obj['doc']['raw']['cos_path']
 
+    # The raw input file is read in place from COS w/ranged reads, so it is never downloaded.  Virtual segments are
+    # read in place by the analysis step as well, so are not copied.
     try:
-        ifh.cos_download_file(cos_bucket, raw_cos_path, local_file_path)
-    except ClientError:
+        if cloudant_obj['doc'][ifh.SEGMENT_TYPE].get('segment_mode', 'copy') == 'virtual':
+            checkpoint = create_virtual_segments(cloudant_obj['db'], cloudant_obj['doc'])
+        else:
+            checkpoint = create_segments(cloudant_obj['db'], cloudant_obj['doc'])
+    except ifh.cos_client_error():
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'COS file "{raw_cos_path}" does not exist!')
         return { 'error': cloudant_obj['error'] }
 
-    # Create design document w/complete and incomplete clean views for this file's segments
-    design_doc = DesignDocument(cloudant_obj['db'], document_id='_design/' + ifh.SEGMENT_TYPE + '-' + doc_id)
-    design_doc.add_view(ifh.SEGMENT_TYPE + '-' + doc_id + '-incomplete', 'function(doc) { if (doc.type == "' + ifh.SEGMENT_TYPE + '" && doc.raw_id == "' + doc_id + '" && ! ("compute_end" in doc)) { emit(doc._id, doc.id); } }')
-    design_doc.add_view(ifh.SEGMENT_TYPE + '-' + doc_id + '-complete', 'function(doc) { if (doc.type == "' + ifh.SEGMENT_TYPE + '" && doc.raw_id == "' + doc_id + '" && "compute_end" in doc) { emit(doc._id, { id: doc.id, segment_start: doc.segment_start, segment_end: doc.segment_end, segment_size: doc.segment_size, sw_version: doc.sw_version, compute_target: doc.compute_target, cos_file_output: doc.cos_file_output, compute_start: doc.compute_start, compute_end: doc.compute_end, error: doc.error }); } }')
-    design_doc.save()
+    # Batches that could not be created are retried by a continuation invocation, which resumes from the saved
+    # checkpoint, until they have been retried ifh.SEGMENT_MAX_ATTEMPTS times, after which the job fails
+    if checkpoint.failed > 0:
+        error = f'{checkpoint.failed} analysis batch(es) not created, resume from segment {checkpoint.segments}!'
+
+        if checkpoint.retries >= ifh.SEGMENT_MAX_ATTEMPTS:
+            cloudant_obj['doc'][ifh.SEGMENT_TYPE]['status'] = 'error'
+            cloudant_obj['doc'][ifh.SEGMENT_TYPE]['error'] = error
+            cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=error, save=True)
+            return { 'error': cloudant_obj['error'] }
+
+        print(f'{error} (create_segments:{doc_id})')
+        checkpoint.retries += 1
+        checkpoint.save()
 
-    # Invoke segmentation on local raw input file
-    segment_count = create_segments(local_file_path, cloudant_obj['db'], cloudant_obj['doc'])
+    # Out of time, or retrying failed batches, so continue segmentation from the checkpoint in a new invocation
+    if not checkpoint.complete():
+        response = ifh.fn_api_invoke(doc_id)
+        if not response.ok:
+            cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Unable to continue segmentation from segment {checkpoint.segments} ({response.status_code})!')
+            return { 'error': cloudant_obj['error'] }
+
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+
+        message = f'Segmentation continued from segment {checkpoint.segments} for {doc_id}'
+        print(message)
+
+        return { 'change': message }
 
     # Retrieve and update the document with segment information
     cloudant_obj['doc'][ifh.SEGMENT_TYPE]['status'] = 'segmented'
-    cloudant_obj['doc'][ifh.SEGMENT_TYPE]['segments'] = segment_count
+    cloudant_obj['doc'][ifh.SEGMENT_TYPE]['segments'] = checkpoint.segment_total
+
+    # Save the JSON document
+    cloudant_obj['doc'].save()
+
+    # If every segment was analyzed before segmentation finished, no analysis invocation will hand off to reassembly
+    ifh.mark_analysis_complete(cloudant_obj['db'], doc_id)
 
-    # Save the JSON document and cleanup
-    cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, save=True)
+    cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
 
     message = 'Segmentation complete for {0}'.format(doc_id)
     print(message)
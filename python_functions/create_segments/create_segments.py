@@ -1,71 +1,385 @@
 import ibm_fn_helper as ifh
 
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import h5py
 import numpy as np
-import os
+import queue
 
 
-TMP_DIR = '/tmp/'
+# Name of the dataset w/in the raw HDF5 input file to segment; if None, the first dataset found in the file is used
+H5_DATASET_NAME = None
 
+# Number of segments uploaded concurrently.  At most this many segments are in flight while the next is sliced, which
+# bounds memory use to roughly (SEGMENT_UPLOAD_CONCURRENCY + 1) segments.
+SEGMENT_UPLOAD_CONCURRENCY = 4
 
-# Opens the raw input file and reads the contents.  The contents are then segmented and saved into NumPy arrays
-# and saved to the 'raw/' directory in COS.
-def create_segments(local_file_path, cloudant_db, cloudant_doc):
+# Segmentation stops at the next analysis batch boundary once fewer than this many seconds remain before the
+# invocation's deadline, leaving time to finish in-flight uploads and save its checkpoint, and hands off to a
+# continuation invocation
+SEGMENT_HANDOFF_SECONDS = 120
 
-    #### TODO: Open and read data from raw input file.  Determine data size.
-    local_file_data = None
-    local_file_size = None
 
+# Returns the dataset to be segmented from the open HDF5 file
+def find_dataset(h5_file):
+    if H5_DATASET_NAME is not None:
+        return h5_file[H5_DATASET_NAME]
+
+    datasets = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            datasets.append(obj)
+            return True
+
+    h5_file.visititems(visit)
+    if len(datasets) == 0:
+        raise ValueError(f'No dataset found in {h5_file.filename}!')
+
+    return datasets[0]
+
+
+# Yields (segment_start, segment_end, segment_data_ary, release) for each segment of the dataset along its first axis,
+# from segment first_segment on, w/1D datasets presented as (n, 1) arrays.  Each segment is read, chunk by chunk if the
+# dataset is chunked, into one of buffer_count reused buffers.  Calling release() returns the segment's buffer to the
+# pool, and the generator blocks until a buffer is free, so no more than buffer_count segments are held in memory.
+def iter_segments(dataset, segment_size, buffer_count=1, first_segment=0):
+    data_length = dataset.shape[0]
+    row_shape = dataset.shape[1:] if len(dataset.shape) > 1 else (1,)
+
+    free_buffers = queue.Queue()
+    for _ in range(buffer_count):
+        free_buffers.put(np.empty((min(segment_size, data_length),) + row_shape, dataset.dtype))
+
+    for segment_start in range(first_segment * segment_size, data_length, segment_size):
+        segment_end = min(segment_start + segment_size, data_length)
+        segment_buffer = free_buffers.get()
+        segment_data_ary = segment_buffer[:segment_end - segment_start]
+        dataset.read_direct(segment_data_ary.reshape((segment_end - segment_start,) + dataset.shape[1:]), source_sel=np.s_[segment_start:segment_end])
+        yield segment_start, segment_end, segment_data_ary, lambda segment_buffer=segment_buffer: free_buffers.put(segment_buffer)
+
+
+# Returns the list of [byte_start, byte_end) ranges w/in the HDF5 file holding rows [segment_start, segment_end) of the
+# dataset, in order, or None if the rows cannot be read directly from the file, i.e., when the dataset is compressed or
+# otherwise filtered, when its chunks do not span whole rows, or when any of its chunks has not been allocated
+def h5_byte_ranges(dataset, segment_start, segment_end):
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+
+    if dataset.chunks is None:
+        data_offset = dataset.id.get_offset()
+        if data_offset is None:
+            return None
+        return [[data_offset + segment_start * row_bytes, data_offset + segment_end * row_bytes]]
+
+    if dataset.id.get_create_plist().get_nfilters() > 0 or tuple(dataset.chunks[1:]) != tuple(dataset.shape[1:]):
+        return None
+
+    chunk_rows = dataset.chunks[0]
+    byte_ranges = []
+    for chunk_start in range(segment_start - segment_start % chunk_rows, segment_end, chunk_rows):
+        chunk_info = dataset.id.get_chunk_info_by_coord((chunk_start,) + (0,) * (len(dataset.shape) - 1))
+        if chunk_info.byte_offset is None:
+            return None
+
+        byte_start = chunk_info.byte_offset + (max(segment_start, chunk_start) - chunk_start) * row_bytes
+        byte_end = chunk_info.byte_offset + (min(segment_end, chunk_start + chunk_rows) - chunk_start) * row_bytes
+
+        # Merge chunks stored back to back into a single range
+        if len(byte_ranges) > 0 and byte_ranges[-1][1] == byte_start:
+            byte_ranges[-1][1] = byte_end
+        else:
+            byte_ranges.append([byte_start, byte_end])
+
+    return byte_ranges
+
+
+# Returns the Cloudant document for the segment of the raw input file w/the given index and bounds
+# Include redundant raw_cos_bucket field to cut down on Cloudant reads in analysis step
+# The final segment may have different properties, e.g., end position and size
+# The codec encodes the segment's raw and analyzed items in COS, and use_result_cache opts its analysis into the cache
+def segment_dict_for(cloudant_doc, count, segment_start, segment_end, data_length):
+    return {
+        '_id': cloudant_doc['_id'] + '.' + ifh.SEGMENT_TYPE + '.S' + str(count),
+        'raw_id': cloudant_doc['_id'],
+        'raw_cos_bucket': cloudant_doc['cos_bucket'],
+        'type': ifh.SEGMENT_TYPE,
+        'id': 'S' + str(count),
+        'segment_start': int(segment_start),
+        'segment_end': int(segment_end),
+        'segment_size': int(segment_end - segment_start),
+        'last_seg': 'true' if segment_end >= data_length else 'false',
+        'codec': cloudant_doc[ifh.SEGMENT_TYPE].get('segment_codec', ifh.DEFAULT_SEGMENT_CODEC),
+        'use_result_cache': 'true' if cloudant_doc[ifh.SEGMENT_TYPE].get('use_result_cache') == True else 'false'
+    }
+
+
+# Uploads the segment to COS as a .npy file streamed directly from the segment view, or encoded w/the segment's codec,
+# then releases its buffer
+def upload_segment(cos_bucket, segment_dict, segment_data_ary, release):
+    try:
+        ifh.cos_put_array(cos_bucket, segment_dict['cos_file_raw'], segment_data_ary, codec=segment_dict['codec'])
+    finally:
+        release()
+
+    return segment_dict
+
+
+# Returns the segment size for the dataset, from the raw document if set there by the user, or else planned by
+# ifh.plan_segments() from the dataset's length and row size and the analysis time of the segments of completed jobs,
+# which also sets the analysis batch size unless given.  The decision is recorded on the raw document as 'segment_plan'.
+def set_segment_size(cloudant_db, cloudant_doc, dataset):
+    segment_info = cloudant_doc[ifh.SEGMENT_TYPE]
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+
+    # A size planned by an earlier invocation is kept when resuming from its checkpoint
+    if segment_info.get('segment_size') and segment_info.get('segment_plan', { }).get('segment_size') == segment_info['segment_size']:
+        return segment_info['segment_size']
+
+    if segment_info.get('segment_size'):
+        segment_info['segment_plan'] = { 'source': 'user', 'segment_size': segment_info['segment_size'], 'data_length': int(dataset.shape[0]), 'row_bytes': row_bytes }
+        return segment_info['segment_size']
+
+    seconds_per_row, history_segments = ifh.analysis_seconds_per_row(cloudant_db)
+
+    segment_plan = ifh.plan_segments(dataset.shape[0], row_bytes, seconds_per_row)
+    segment_plan['source'] = 'history' if seconds_per_row else 'default'
+    segment_plan['history_segments'] = history_segments
+
+    segment_info['segment_size'] = segment_plan['segment_size']
+    segment_info.setdefault('analyze_batch_size', segment_plan['analyze_batch_size'])
+    segment_info['segment_plan'] = segment_plan
+    print(f'Planned segments of {segment_plan["segment_size"]} rows, {segment_info["analyze_batch_size"]} per batch, for {cloudant_doc["_id"]}')
+
+    return segment_info['segment_size']
+
+
+# Returns the number of segments to be analyzed together by each analysis invocation, from the raw document if set, or
+# else from the size of a segment of the dataset and the analysis action's memory, recording it on the raw document
+def set_analyze_batch_size(cloudant_doc, dataset):
+    segment_info = cloudant_doc[ifh.SEGMENT_TYPE]
+    if 'analyze_batch_size' not in segment_info:
+        row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:], dtype=np.int64))
+        segment_info['analyze_batch_size'] = ifh.analyze_batch_size(segment_info['segment_size'] * row_bytes)
+
+    return segment_info['analyze_batch_size']
+
+
+# Segmentation progress, checkpointed to the raw document as the number of segments, and the index of the last segment,
+# in the run of analysis batches from the start of the dataset whose documents have all been created.  A re-invocation
+# resumes from the next batch, while any batches created ahead of it are simply created again, as conflicts, and their
+# segment files are not uploaded again, as they already exist.  Retries counts the continuation invocations started to
+# create batches that failed.
+class SegmentCheckpoint:
+    def __init__(self, cloudant_doc, analyze_batch_size, segment_total):
+        self.cloudant_doc = cloudant_doc
+        self.analyze_batch_size = analyze_batch_size
+        self.segment_total = segment_total
+        self.segments = cloudant_doc[ifh.SEGMENT_TYPE].get('checkpoint', { }).get('segments', 0)
+        self.retries = cloudant_doc[ifh.SEGMENT_TYPE].get('checkpoint', { }).get('retries', 0)
+        self.next_batch = self.segments // analyze_batch_size
+        self.created = { }
+        self.failed = 0
+
+    def complete(self):
+        return self.segments >= self.segment_total
+
+    # Records the batches of the created segment documents, other than those that failed
+    def commit(self, segment_docs, failed_ids):
+        batch_counts = Counter([ int(doc['id'][1:]) // self.analyze_batch_size for doc in segment_docs ])
+        failed_batches = set([ int(doc['id'][1:]) // self.analyze_batch_size for doc in segment_docs if doc['_id'] in failed_ids ])
+
+        for batch_index, batch_count in batch_counts.items():
+            if batch_index in failed_batches:
+                self.failed += 1
+            else:
+                self.created[batch_index] = batch_count
+
+        while self.next_batch in self.created:
+            self.segments += self.created.pop(self.next_batch)
+            self.next_batch += 1
+
+    def fail(self):
+        self.failed += 1
+
+    def save(self):
+        self.cloudant_doc[ifh.SEGMENT_TYPE]['checkpoint'] = {
+            'last_segment': self.segments - 1,
+            'segments': self.segments,
+            'failed_batches': self.failed,
+            'retries': self.retries,
+            'updated': str(datetime.now())
+        }
+        self.cloudant_doc.save()
+
+
+# Returns True once segmentation should hand off to a continuation invocation, before the deadline of this one
+def out_of_time():
+    seconds_left = ifh.invocation_seconds_left()
+
+    return seconds_left is not None and seconds_left < SEGMENT_HANDOFF_SECONDS
+
+
+# Holds the segment document, or None if its segment could not be created, until every segment in its analysis batch is
+# accounted for.  The batch's documents are then buffered for creation, w/the first of them marked as the batch lead,
+# which alone triggers analysis and lists the IDs of the documents in its batch.  The lead is buffered last, so it is
+# never created before the rest of its batch.  A batch w/any segment that could not be created is dropped, to be
+# created in full by a re-invocation resuming from the checkpoint.
+def batch_segment_doc(batch_groups, segment_docs, batch_index, batch_count, segment_dict, checkpoint):
+    group = batch_groups.setdefault(batch_index, [])
+    group.append(segment_dict)
+    if len(group) < batch_count:
+        return
+
+    del batch_groups[batch_index]
+    if any(doc is None for doc in group):
+        print(f'Analysis batch {batch_index} not created, as not all of its segments could be!')
+        checkpoint.fail()
+        return
+
+    group_docs = sorted(group, key=lambda doc: doc['segment_start'])
+
+    for doc in group_docs:
+        doc['batch_lead'] = 'false'
+    group_docs[0]['batch_lead'] = 'true'
+    group_docs[0]['batch_ids'] = [doc['_id'] for doc in group_docs]
+
+    segment_docs.extend(group_docs[1:] + group_docs[:1])
+
+
+# Writes the buffered segment documents to Cloudant in a single _bulk_docs request, empties the buffer and saves the
+# checkpoint of the batches created
+def flush_segment_docs(cloudant_db, segment_docs, batch_size, checkpoint):
+    failures = ifh.cloudant_bulk_save(cloudant_db, segment_docs, batch_size=batch_size)
+    for failure in failures:
+        print(f'Unable to create segment document {failure.get("id")}!\n{failure["error"]}: {failure.get("reason")}')
+
+    checkpoint.commit(segment_docs, set([ failure.get('id') for failure in failures ]))
+    checkpoint.save()
+
+    segment_docs.clear()
+
+
+# Collects the finished segment uploads, buffering their Cloudant documents by analysis batch and creating them in
+# batches of batch_size
+def collect_uploads(cloudant_db, done, in_flight, batch_groups, segment_docs, batch_size, checkpoint):
+    for future in done:
+        segment_name, batch_index, batch_count = in_flight.pop(future)
+        try:
+            segment_dict = future.result()
+        except Exception as e:
+            print(f'Exception occurred in {segment_name}!\n{str(e)}')
+            segment_dict = None
+
+        batch_segment_doc(batch_groups, segment_docs, batch_index, batch_count, segment_dict, checkpoint)
+
+    if len(segment_docs) >= batch_size:
+        flush_segment_docs(cloudant_db, segment_docs, batch_size, checkpoint)
+
+
+# Opens the raw HDF5 input file in place in COS w/ranged reads, rather than downloading it to the memory-backed /tmp,
+# and streams the dataset contents.  The contents are segmented into NumPy arrays and saved to the 'raw/' directory in
+# COS.  Segments are uploaded by a pool of upload_concurrency threads while the next
+# segment is sliced, and segment documents are buffered and created in batches of batch_size as uploads finish.  Each
+# consecutive run of analyze_batch_size segments forms a batch analyzed by a single invocation.  Segmentation resumes
+# from the raw document's checkpoint, if any, and stops early if the invocation runs out of time.  Returns the
+# SegmentCheckpoint, which is complete() once every segment has been created.
+def create_segments(cloudant_db, cloudant_doc, batch_size=ifh.CLOUDANT_BULK_BATCH_SIZE, upload_concurrency=SEGMENT_UPLOAD_CONCURRENCY):
     doc_id = cloudant_doc['_id']
     cos_bucket = cloudant_doc['cos_bucket']
 
-    segment_size = cloudant_doc[ifh.SEGMENT_TYPE]['segment_size']
     path_prefix = doc_id + '/raw/'
-    os.makedirs(TMP_DIR + path_prefix, exist_ok=True)
-
-    count = 0
-    for segment_index in range(0, local_file_size, segment_size):
-        # Include redundant raw_cos_bucket field to cut down on Cloudant reads in analysis step
-        segment_dict = {
-            '_id': doc_id + '.' + ifh.SEGMENT_TYPE + '.S' + str(count),
-            'raw_id': doc_id,
-            'raw_cos_bucket': cos_bucket,
-            'type': ifh.SEGMENT_TYPE,
-            'id': 'S' + str(count),
-            'segment_start': int(segment_index),
-            'segment_end': int(segment_index + segment_size),
-            'segment_size': int(segment_size),
-            'cos_file_raw': path_prefix + 'S' + str(count) + '.npy',
-            'last_seg': 'false'
-        }
 
-        # Create empty NumPy array to hold segment data
-        segment_data_ary = np.zeros((segment_size, 1), local_file_data.dtype)
+    segment_docs = []
+    batch_groups = { }
+    in_flight = { }
 
-        # If final segment, may have different properties, e.g., end position and size
-        if (segment_index + segment_size) >= local_file_size:
-            last_segment_size = local_file_size - segment_index
-            segment_dict['segment_end'] = int(segment_index + last_segment_size)
-            segment_dict['segment_size'] = int(last_segment_size)
-            segment_data_ary = np.zeros((last_segment_size, 1), local_file_data.dtype)
-            segment_dict['last_seg'] = 'true'
+    with h5py.File(ifh.CosRangeFile(cos_bucket, cloudant_doc['raw']['cos_path']), 'r') as h5_file, ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+        dataset = find_dataset(h5_file)
+        local_file_size = dataset.shape[0]
 
-        try:
-            #### TODO: Populate segment_data_ary data from local_file_data here!
+        segment_size = set_segment_size(cloudant_db, cloudant_doc, dataset)
+        analyze_batch_size = set_analyze_batch_size(cloudant_doc, dataset)
+        segment_total = -(-local_file_size // segment_size)
 
-            # Save, upload, delete segment
-            tmp_file_path = TMP_DIR + segment_dict['cos_file_raw']
-            np.save(tmp_file_path, segment_data_ary)
-            ifh.cos_multi_part_upload(cos_bucket, segment_dict['cos_file_raw'], tmp_file_path)
-            os.remove(tmp_file_path)
+        checkpoint = SegmentCheckpoint(cloudant_doc, analyze_batch_size, segment_total)
+        count = checkpoint.segments
 
-            # Create Cloudant document from JSON snippet
-            cloudant_db.create_document(segment_dict)
+        # Answer the existence checks before each segment upload from a single listing of the job's raw prefix, rather
+        # than a HEAD request per segment
+        ifh.cos_items_exist(cos_bucket, [ path_prefix + 'S' + str(i) + '.npy' for i in range(count, min(segment_total, count + ifh.COS_EXISTS_CACHE_MAX_ITEMS)) ], prefix=path_prefix)
 
-        except Exception as e:
-            print(f'Exception occurred in {doc_id}, segment {count}!\n{str(e)}')
-        finally:
+        for segment_index, segment_end, segment_data_ary, release in iter_segments(dataset, segment_size, upload_concurrency + 1, count):
+            # Hand off between analysis batches if out of time, so no batch is left partially uploaded
+            if count % analyze_batch_size == 0 and out_of_time():
+                release()
+                break
+
+            segment_dict = segment_dict_for(cloudant_doc, count, segment_index, segment_end, local_file_size)
+            segment_dict['cos_file_raw'] = path_prefix + 'S' + str(count) + '.npy'
+            batch_index = count // analyze_batch_size
+            count += 1
+
+            future = executor.submit(upload_segment, cos_bucket, segment_dict, segment_data_ary, release)
+            in_flight[future] = (f'{doc_id}, segment {segment_dict["id"]}', batch_index, min(analyze_batch_size, segment_total - batch_index * analyze_batch_size))
+
+            # Apply backpressure, waiting for an upload to finish before slicing further segments
+            if len(in_flight) >= upload_concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect_uploads(cloudant_db, done, in_flight, batch_groups, segment_docs, batch_size, checkpoint)
+
+        done, _ = wait(in_flight)
+        collect_uploads(cloudant_db, done, in_flight, batch_groups, segment_docs, batch_size, checkpoint)
+
+    # Create any remaining Cloudant documents, and checkpoint them
+    flush_segment_docs(cloudant_db, segment_docs, batch_size, checkpoint)
+
+    return checkpoint
+
+
+# Opens the raw HDF5 input file in place in COS w/ranged reads and creates a virtual segment document for each segment
+# of the dataset, w/o copying any data.  Each document records the dataset and the byte ranges w/in the raw file that
+# hold the segment's rows, so the analysis step can fetch them directly.  Segment documents are created in batches of
+# batch_size, grouped into analysis batches, and checkpointed as in create_segments().
+def create_virtual_segments(cloudant_db, cloudant_doc, batch_size=ifh.CLOUDANT_BULK_BATCH_SIZE):
+    raw_cos_path = cloudant_doc['raw']['cos_path']
+
+    segment_docs = []
+    batch_groups = { }
+
+    with h5py.File(ifh.CosRangeFile(cloudant_doc['cos_bucket'], raw_cos_path), 'r') as h5_file:
+        dataset = find_dataset(h5_file)
+        data_length = dataset.shape[0]
+        row_shape = dataset.shape[1:] if len(dataset.shape) > 1 else (1,)
+        dtype_descr = np.lib.format.dtype_to_descr(dataset.dtype)
+
+        segment_size = set_segment_size(cloudant_db, cloudant_doc, dataset)
+        analyze_batch_size = set_analyze_batch_size(cloudant_doc, dataset)
+        segment_total = -(-data_length // segment_size)
+
+        checkpoint = SegmentCheckpoint(cloudant_doc, analyze_batch_size, segment_total)
+        count = checkpoint.segments
+
+        for segment_index in range(count * segment_size, data_length, segment_size):
+            if count % analyze_batch_size == 0 and out_of_time():
+                break
+
+            segment_end = min(segment_index + segment_size, data_length)
+
+            segment_dict = segment_dict_for(cloudant_doc, count, segment_index, segment_end, data_length)
+            segment_dict['raw_cos_path'] = raw_cos_path
+            segment_dict['h5_dataset'] = dataset.name
+            segment_dict['dtype'] = dtype_descr
+            segment_dict['row_shape'] = [int(dim) for dim in row_shape]
+            segment_dict['byte_ranges'] = h5_byte_ranges(dataset, segment_index, segment_end)
+            batch_index = count // analyze_batch_size
             count += 1
 
-    #### TODO: Close the input file if necessary!
+            batch_segment_doc(batch_groups, segment_docs, batch_index, min(analyze_batch_size, segment_total - batch_index * analyze_batch_size), segment_dict, checkpoint)
+            if len(segment_docs) >= batch_size:
+                flush_segment_docs(cloudant_db, segment_docs, batch_size, checkpoint)
+
+    # Create any remaining Cloudant documents, and checkpoint them
+    flush_segment_docs(cloudant_db, segment_docs, batch_size, checkpoint)
 
-    return count
+    return checkpoint
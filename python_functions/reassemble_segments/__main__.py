@@ -1,106 +1,290 @@
 import ibm_fn_helper as ifh
-from reassemble_segments import reassemble_segments
+from reassemble_segments import PARTIAL_TYPE, RawOutputWriter, compose_segments, output_writer_for, partial_doc_for, partial_docs_for, partial_id, partial_summary, reduce_partial, reassemble_segments
 
-import h5py
+from cloudant.document import Document
 import numpy as np
 import os
 from requests import HTTPError
-import time
 
 
-# Queries incomplete view for the parent doc to determine if any segments have not been analyzed
-def is_analysis_complete(cloudant_db, raw_id):
-    try:
-        view_result = cloudant_db.get_view_result('_design/' + ifh.SEGMENT_TYPE + '-' + raw_id, ifh.SEGMENT_TYPE + '-' + raw_id + '-incomplete', limit=1)
-        results = view_result.all()
-        if len(results) > 0:
-            return False
+# Update parent document analysis status from from_status to to_status, to prevent other functions from starting the
+# same post-analysis step.  If the status is not from_status after fetch(), then the step has already been started by
+# another function invocation, e.g., a duplicate trigger.  Returns True only if this invocation updated the status.
+def set_raw_status(raw_doc, from_status, to_status):
+    for _ in range(ifh.CLOUDANT_409_RETRIES):
+        try:
+            raw_doc.fetch()
+            if raw_doc[ifh.SEGMENT_TYPE]['status'] != from_status:
+                return False
+
+            raw_doc[ifh.SEGMENT_TYPE]['status'] = to_status
+            raw_doc.save()
+        except HTTPError as err:
+            if err.response.status_code == 409:
+                print(f'409 HTTPError: attempting to re-save (reassemble_segments:{raw_doc["_id"]}')
+            else:
+                raise
         else:
             return True
-    except HTTPError as err:
-        print(f'Incomplete view "{err.response.status_code}" error! (reassemble_segments:{raw_id})')
-        if err.response.status_code == 404:
-            return True
-        else:
-            return False
 
     return False
 
 
-def main(data):
-    doc_id = data['id']
+# Evicts expired and excess result cache entries once a job using the result cache is complete.  Failures are only
+# reported, as the job's output has already been written.
+def evict_result_cache(cloudant_db, raw_id):
+    try:
+        evicted = ifh.evict_result_cache(cloudant_db)
+    except Exception as e:
+        print(f'Unable to evict result cache entries! (reassemble_segments:{raw_id})\n{str(e)}')
+        return
 
-    cloudant_obj = ifh.cloudant_init(doc_id)
-    if cloudant_obj['error'] is not None:
-        return { 'error': cloudant_obj['error'] }
+    if evicted > 0:
+        print(f'{evicted} result cache entries evicted (reassemble_segments:{raw_id})')
 
-    # Validate JSON document for COS information
-    if 'raw_cos_bucket' in cloudant_obj['doc']:
-        cos_bucket = cloudant_obj['doc']['raw_cos_bucket']
-    else:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'"raw_cos_bucket" not in document!')
+
+# Marks the job as failed once its output could not be written, w/its analyzed segment documents and files left in
+# place so that the reassembly may be retried
+def fail_reassembly(cloudant_obj, raw_doc, error):
+    raw_doc.fetch()
+    raw_doc[ifh.SEGMENT_TYPE]['status'] = 'error'
+    raw_doc[ifh.SEGMENT_TYPE]['error'] = error
+    raw_doc.save()
+
+    return ifh.cloudant_cleanup(cloudant_obj, error=error)
+
+
+# Delete Cloudant analyzed segment documents in batches
+def delete_segment_docs(cloudant_db, raw_id, del_docs):
+    failures = ifh.cloudant_bulk_delete(cloudant_db, del_docs)
+    if len(failures) > 0:
+        print(f'Unable to delete {len(failures)} analyzed segment document(s)! (reassemble_segments:{raw_id})')
+
+
+# Writes the final output file from the segments, or from the last level of partial outputs of a tree-reduce
+# reassembly, then saves segments_summary to the raw document and marks it complete.  Nothing is deleted, so that an
+# exception raised before the job is complete leaves its inputs in place.  Returns the analyzed segment files for
+# delete_reassembly_items().
+def finish_reassembly(raw_doc, segments, segments_summary, sw_version, **reassemble_kwargs):
+    raw_id = raw_doc['_id']
+    cos_bucket = raw_doc['cos_bucket']
+
+    output_path = '/tmp/' + raw_id + '-' + ifh.SEGMENT_TYPE + '.' + ifh.OUTPUT_FILE_EXT
+    cos_file_output = raw_id + '/' + raw_id + '-' + ifh.SEGMENT_TYPE + '.' + ifh.OUTPUT_FILE_EXT
+
+    # If requested, and the output is just the concatenated segments, compose it in COS w/o downloading the segments
+    composed = False
+    if raw_doc[ifh.SEGMENT_TYPE].get('reassemble_mode') == 'compose' and output_writer_for(output_path) is RawOutputWriter:
+        try:
+            segment_items = compose_segments(cos_bucket, cos_file_output, segments)
+            composed = True
+        except Exception as e:
+            print(f'Unable to compose output, reassembling locally! (reassemble_segments:{raw_id})\n{str(e)}')
+
+    # Reconstruct the segments into the output file.  Raw output is streamed to COS as it is written, overlapping the
+    # upload w/the reassembly, while HDF5 output is written to the file system and then uploaded.
+    streamed = False
+    if not composed and output_writer_for(output_path) is RawOutputWriter:
+        with ifh.CosMultipartWriter(cos_bucket, cos_file_output) as output_file:
+            segment_items = reassemble_segments(cos_bucket, output_file, segments, writer_class=RawOutputWriter, **reassemble_kwargs)
+        streamed = True
+    elif not composed:
+        segment_items = reassemble_segments(cos_bucket, output_path, segments, **reassemble_kwargs)
+
+    # Upload re-stitched, analyzed output file
+    if not composed and not streamed:
+        ifh.cos_multi_part_upload(cos_bucket, cos_file_output, output_path)
+        os.remove(output_path)
+
+    # Save '-complete' view contents to raw_doc, add field for '-infer.h5' COS location
+    raw_doc.fetch()
+    raw_doc[ifh.SEGMENT_TYPE]['status'] = 'complete'
+    raw_doc[ifh.SEGMENT_TYPE]['segments'] = segments_summary
+    raw_doc[ifh.SEGMENT_TYPE]['sw_version'] = sw_version
+    raw_doc[ifh.SEGMENT_TYPE]['cos_file_output'] = cos_file_output
+    raw_doc.save()
+
+    return segment_items
+
+
+# Deletes the analyzed segment files of a complete job from COS, then its debug and input files per the raw document's
+# retention flags
+def delete_reassembly_items(raw_doc, segment_items):
+    raw_id = raw_doc['_id']
+    cos_bucket = raw_doc['cos_bucket']
+
+    # Delete all COS infer files w/multi-object delete requests
+    failures = ifh.cos_delete_items(cos_bucket, segment_items)
+    if len(failures) > 0:
+        print(f'Unable to delete {len(failures)} analyzed segment file(s) from COS! (reassemble_segments:{raw_id})')
+
+    # Deleting all SO debug files from COS not specified by -d flag
+    delete_items = []
+    if raw_doc[ifh.SEGMENT_TYPE]['debug_retention_flag'] != 't':
+        delete_items.append(raw_doc['_id'] + '/' + ifh.SEGMENT_TYPE + '/S0.npy')
+    if raw_doc['raw']['raw_debug_retention_flag'] != 't':
+        delete_items.append(raw_doc['_id'] + '/raw/S0.npy')
+
+    # Deletion of the 0 byte file with no extension left in COS
+    input_file_no_ext, _ = raw_doc['raw']['cos_path'].split('/')
+    delete_items.append(input_file_no_ext + '/')
+
+    ifh.cos_delete_items(cos_bucket, delete_items)
+
+    # Deletion of input file using retention_flag
+    if raw_doc['raw']['input_retention_flag'] == 'f':
+        ifh.cos_delete_item(raw_doc['cos_bucket'], raw_doc['raw']['cos_path'])
+
+
+# Reduces a partial output of a tree-reduce reassembly, merging its children into a single file.  The last of a run of
+# fan_in sibling partial outputs to be reduced then starts their parent at the next level or, at the top level, writes
+# the final output from them.
+def reduce_partial_doc(cloudant_obj):
+    partial_doc = cloudant_obj['doc']
+    doc_id = partial_doc['_id']
+
+    # Claim the partial output, w/its revision guarding against duplicate triggers
+    if partial_doc.get('status') != 'pending':
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+        return { 'continue': f'Partial output already reduced (reassemble_segments:{doc_id})' }
+
+    partial_doc['status'] = 'reducing'
+    try:
+        partial_doc.save()
+    except HTTPError as err:
+        if err.response.status_code == 409:
+            cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+            return { 'continue': f'Partial output already claimed (reassemble_segments:{doc_id})' }
+        raise
+
+    # A failed reduction is left pending, to be retried by the change of saving it, until it has failed
+    # ifh.SEGMENT_MAX_ATTEMPTS times, after which the whole job fails
+    try:
+        reduce_partial(partial_doc)
+    except Exception as e:
+        partial_doc['attempts'] = partial_doc.get('attempts', 0) + 1
+        partial_doc['error'] = str(e)
+
+        if partial_doc['attempts'] < ifh.SEGMENT_MAX_ATTEMPTS:
+            partial_doc['status'] = 'pending'
+            cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Exception occurred in {doc_id}, retrying!\n{str(e)}', save=True)
+            return { 'error': cloudant_obj['error'] }
+
+        partial_doc['status'] = 'error'
+        partial_doc.save()
+
+        cloudant_obj = fail_reassembly(cloudant_obj, Document(cloudant_obj['db'], partial_doc['raw_id']), f'Exception occurred in {doc_id}!\n{str(e)}')
         return { 'error': cloudant_obj['error'] }
 
-    # Validate JSON document for step type
-    if 'type' not in cloudant_obj['doc'] or cloudant_obj['doc']['type'] != ifh.SEGMENT_TYPE:
+    # Delete the documents of the partial outputs merged into this one, if any
+    child_docs = [ { '_id': child['doc_id'], '_rev': child['doc_rev'] } for child in partial_doc['children'] if 'doc_id' in child ]
+    failures = ifh.cloudant_bulk_delete(cloudant_obj['db'], child_docs)
+    if len(failures) > 0:
+        print(f'Unable to delete {len(failures)} partial output document(s)! (reassemble_segments:{doc_id})')
+
+    partial_doc['status'] = 'reduced'
+    partial_doc.save()
+
+    # Continue only once all of the siblings sharing this partial output's parent have been reduced
+    raw_id = partial_doc['raw_id']
+    level = partial_doc['level']
+    level_count = partial_doc['level_count']
+    fan_in = partial_doc['fan_in']
+
+    first_index = int(partial_doc['id'][1:]) // fan_in * fan_in
+    sibling_ids = [ partial_id(raw_id, level, index) for index in range(first_index, min(first_index + fan_in, level_count)) ]
+
+    siblings = ifh.cloudant_get_docs(cloudant_obj['db'], sibling_ids)
+    if any(sibling is None or sibling.get('status') != 'reduced' for sibling in siblings):
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
-        return { 'continue': f'Not analyzing (reassemble_segments:{doc_id})' }
+        return { 'change': f'Partial output reduced (reassemble_segments:{doc_id})' }
+
+    summaries = [ partial_summary(sibling) for sibling in siblings ]
+
+    # Merge the siblings into their parent at the next level, unless they make up the top level.  A duplicate parent
+    # created by a sibling reduced concurrently is a conflict, and ignored.
+    if level_count > fan_in:
+        parent_count = -(-level_count // fan_in)
+        parent_doc = partial_doc_for(raw_id, partial_doc['raw_cos_bucket'], level + 1, first_index // fan_in, parent_count, fan_in, summaries)
+        ifh.cloudant_bulk_save(cloudant_obj['db'], [parent_doc])
 
-    # Validate segment has been analyzed
-    if 'compute_end' not in cloudant_obj['doc']:
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
-        return { 'continue': f'Analysis not complete (reassemble_segments:{doc_id})' }
+        return { 'change': f'Partial output reduced, {parent_doc["_id"]} started (reassemble_segments:{doc_id})' }
 
-    # Retrieve the parent document to checking analysis status
-    if 'raw_id' in cloudant_obj['doc']:
-        raw_id = cloudant_obj['doc']['raw_id']
-    else:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'"raw_id" not in document!')
+    raw_doc = Document(cloudant_obj['db'], raw_id)
+    if set_raw_status(raw_doc, 'reducing', 'reassembling') == False:
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+        return { 'continue': f'Final reassembly already started (reassemble_segments:{raw_id})' }
+
+    # The top level's partial outputs are large, so are downloaded one at a time if reassembled locally.  Their files
+    # are deleted by the reassembly, other than that of P0.
+    sibling_docs = [ { '_id': summary['doc_id'], '_rev': summary['doc_rev'] } for summary in summaries ]
+    first_output = summaries[0]['cos_file_output']
+
+    try:
+        segment_items = finish_reassembly(raw_doc, summaries, raw_doc[ifh.SEGMENT_TYPE]['segments'], summaries[-1]['sw_version'], prefetch_window=1, download_concurrency=1)
+    except Exception as e:
+        cloudant_obj = fail_reassembly(cloudant_obj, raw_doc, f'Final reassembly failed!\n{str(e)}')
         return { 'error': cloudant_obj['error'] }
 
-    if raw_id in cloudant_obj['db']:
-        raw_doc = cloudant_obj['db'][raw_id]
+    delete_reassembly_items(raw_doc, segment_items)
+
+    ifh.cos_delete_items(raw_doc['cos_bucket'], [first_output])
+    failures = ifh.cloudant_bulk_delete(cloudant_obj['db'], sibling_docs)
+    if len(failures) > 0:
+        print(f'Unable to delete {len(failures)} partial output document(s)! (reassemble_segments:{raw_id})')
+
+    if raw_doc[ifh.SEGMENT_TYPE].get('use_result_cache') == True:
+        evict_result_cache(cloudant_obj['db'], raw_id)
+
+    cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+
+    return { 'change': "{0} analyzed fully".format(raw_id) }
+
+
+def main(data):
+    raw_id = data['id']
+
+    cloudant_obj = ifh.cloudant_init(raw_id)
+    if cloudant_obj['error'] is not None:
+        return { 'error': cloudant_obj['error'] }
+
+    # Partial outputs of a tree-reduce reassembly are each reduced by their own invocation
+    if cloudant_obj['doc'].get('type') == PARTIAL_TYPE:
+        return reduce_partial_doc(cloudant_obj)
+
+    raw_doc = cloudant_obj['doc']
+
+    # Validate JSON document for COS information
+    if 'cos_bucket' in raw_doc:
+        cos_bucket = raw_doc['cos_bucket']
     else:
-        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Raw document does not exist!')
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'"cos_bucket" not in document!')
         return { 'error': cloudant_obj['error'] }
 
-    # If analysis marked as complete, then post-analysis cleanup has already started
-    if ifh.SEGMENT_TYPE in raw_doc and 'status' in raw_doc[ifh.SEGMENT_TYPE] and raw_doc[ifh.SEGMENT_TYPE]['status'] == 'complete':
+    # Validate that the final segment analysis marked the raw document as analyzed
+    if ifh.SEGMENT_TYPE not in raw_doc or 'status' not in raw_doc[ifh.SEGMENT_TYPE] or raw_doc[ifh.SEGMENT_TYPE]['status'] != 'analyzed':
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
-        return { 'continue': f'Post-analysis cleanup already started 1 (reassemble_segments:{doc_id})' }
+        return { 'continue': f'Analysis not complete or post-analysis cleanup already started 1 (reassemble_segments:{raw_id})' }
 
     # Verify that all segments have been analyzed
-    if cloudant_obj['doc']['last_seg'] == 'true':
-        all_clean = False
-        while not all_clean:
-            time.sleep(30)
-            all_clean = is_analysis_complete(cloudant_obj['db'], raw_id)
-    else:
+    if ifh.is_analysis_complete(cloudant_obj['db'], raw_id) == False:
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
-        return { 'continue': f'Analysis not complete for the final segment (reassemble_segments:{doc_id})' }
+        return { 'continue': f'Analysis not complete (reassemble_segments:{raw_id})' }
 
-    # Update parent document analysis status to prevent other functions from starting post-analysis cleanup.
-    # If analysis marked as complete after fetch(), then post-analysis cleanup has already been started by another
-    # function invocation while this invocation was checking the incomplete view.  Exit here to prevent 409 Conflict error.
-    for _ in range(ifh.CLOUDANT_409_RETRIES):
-        try:
-            raw_doc.fetch()
-            if ifh.SEGMENT_TYPE in raw_doc and 'status' in raw_doc[ifh.SEGMENT_TYPE] and raw_doc[ifh.SEGMENT_TYPE]['status'] == 'complete':
-                cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
-                return { 'continue': f'Post-analysis cleanup already started 2 (reassemble_segments:{doc_id})' }
+    # Jobs w/more segments than the fan-in width are reassembled by a tree of reducer invocations
+    fan_in = raw_doc[ifh.SEGMENT_TYPE].get('reduce_fan_in', 0)
+    tree_reduce = fan_in > 1 and raw_doc[ifh.SEGMENT_TYPE].get('segments', 0) > fan_in
 
-            raw_doc[ifh.SEGMENT_TYPE]['status'] = 'complete'
-            raw_doc.save()
-        except HTTPError as err:
-            if err.response.status_code == 409:
-                print(f'409 HTTPError: attempting to re-save (reassemble_segments:{raw_doc["_id"]}')
-        else:
-            break
+    # Exit here if post-analysis cleanup has already been started, to prevent 409 Conflict error.  The job is only
+    # marked complete once its output has been written.
+    if set_raw_status(raw_doc, 'analyzed', 'reducing' if tree_reduce else 'reassembling') == False:
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+        return { 'continue': f'Post-analysis cleanup already started 2 (reassemble_segments:{raw_id})' }
 
-    # Query "complete" view for this raw ID to obtain all segment documents
-    view_result = cloudant_obj['db'].get_view_result('_design/' + ifh.SEGMENT_TYPE + '-' + raw_id, ifh.SEGMENT_TYPE + '-' + raw_id + '-complete', include_docs=True)
+    # Query global segment status view for this raw ID's complete segments to obtain all segment documents
     try:
-        results = view_result.all()
+        results = ifh.segment_status_query(cloudant_obj['db'], raw_id, True, include_docs=True, reduce=False)['rows']
     except HTTPError as err:
         cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Complete view "{err.response.status_code}" error!')
         return { 'error': cloudant_obj['error'] }
@@ -109,6 +293,7 @@ def main(data):
     segments = []
     segment_idx = None
     sw_version = None
+    del_docs = []
 
     for r in results:
         segment = r['value']
@@ -118,47 +303,58 @@ def main(data):
         segments[segment_idx] = segment
         sw_version = segment['sw_version']
 
-        # Delete Cloudant analyzed segment document
+        # Queue Cloudant analyzed segment document for deletion, using the revision returned w/the view results
         # Deleting S0 if debug flag is not t, else saving S0 for debugging
-        if segment_idx != 0 or raw_doc[ifh.SEGMENT_TYPE]['debug_retention_flag'] != 't':  
-            del_doc = cloudant_obj['db'][r['id']]
-            del_doc.delete()
+        if segment_idx != 0 or raw_doc[ifh.SEGMENT_TYPE]['debug_retention_flag'] != 't':
+            del_docs.append(r['doc'])
 
-    output_path = '/tmp/' + raw_id + '-' + ifh.SEGMENT_TYPE + '.' + ifh.OUTPUT_FILE_EXT
+    # Record the job's result cache hit rate, i.e., the segments whose analysis was reused from an earlier job
+    if raw_doc[ifh.SEGMENT_TYPE].get('use_result_cache') == True:
+        cache_hits = len([ segment for segment in segments if segment and segment.get('cache') == 'hit' ])
+        cache_misses = len([ segment for segment in segments if segment and segment.get('cache') == 'miss' ])
 
-    # Reconstruct the segments into the output file
-    reassemble_segments(cos_bucket, output_path, segments)
+        raw_doc.fetch()
+        raw_doc[ifh.SEGMENT_TYPE]['result_cache'] = {
+            'hits': cache_hits,
+            'misses': cache_misses,
+            'hit_rate': cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses > 0 else None
+        }
+        raw_doc.save()
 
-    # Deleting all SO debug files from COS not specified by -d flag
-    if raw_doc[ifh.SEGMENT_TYPE]['debug_retention_flag'] != 't':
-        ifh.cos_delete_item(cos_bucket, raw_doc['_id'] + '/' + ifh.SEGMENT_TYPE + '/S0.npy')
-    if raw_doc['raw']['raw_debug_retention_flag'] != 't':
-        ifh.cos_delete_item(cos_bucket, raw_doc['_id'] + '/raw/S0.npy')
+    # Start the first level of the tree-reduce, each partial output merging a run of fan_in consecutive segments.  The
+    # partial outputs are created 'held', and only released for reduction once all of them have been created, so that
+    # none merges, and deletes, the segment files of a job whose tree could not be started.  The partial outputs are
+    # summarized from the segments, so the segment documents are then deleted.
+    if tree_reduce:
+        partial_docs = partial_docs_for(raw_id, cos_bucket, [ segment for segment in segments if segment ], fan_in)
 
-    # Deletion of the 0 byte file with no extension left in COS
-    input_file_no_ext, _ = raw_doc['raw']['cos_path'].split('/')
-    ifh.cos_delete_item(cos_bucket, input_file_no_ext + '/')
+        for status in ('held', 'pending'):
+            for partial_doc in partial_docs:
+                partial_doc['status'] = status
 
-    # Upload re-stitched, analyzed output file
-    cos_file_output = raw_id + '/' + raw_id + '-' + ifh.SEGMENT_TYPE + '.' + ifh.OUTPUT_FILE_EXT
-    ifh.cos_multi_part_upload(cos_bucket, cos_file_output, output_path)
-    os.remove(output_path)
+            failures = ifh.cloudant_bulk_save(cloudant_obj['db'], partial_docs)
+            if len(failures) > 0:
+                cloudant_obj = fail_reassembly(cloudant_obj, raw_doc, f'Unable to create {len(failures)} partial output document(s)!')
+                return { 'error': cloudant_obj['error'] }
 
-    # Delete infer view design document
-    clean_view = cloudant_obj['db']['_design/' + ifh.SEGMENT_TYPE + '-' + raw_id]
-    clean_view.delete()
+        delete_segment_docs(cloudant_obj['db'], raw_id, del_docs)
 
-    # Save '-complete' view contents to raw_doc, add field for '-infer.h5' COS location
-    raw_doc.fetch()
-    raw_doc[ifh.SEGMENT_TYPE]['segments'] = segments
-    raw_doc[ifh.SEGMENT_TYPE]['sw_version'] = sw_version
-    raw_doc[ifh.SEGMENT_TYPE]['cos_file_output'] = cos_file_output
-    raw_doc.save()
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
 
-    # Deletion of input file using retention_flag
-    if raw_doc['raw']['input_retention_flag'] == 'f':
-        ifh.cos_delete_item(raw_doc['cos_bucket'], raw_doc['raw']['cos_path'])
+        return { 'change': f'{len(partial_docs)} partial output(s) started (reassemble_segments:{raw_id})' }
+
+    try:
+        segment_items = finish_reassembly(raw_doc, segments, segments, sw_version)
+    except Exception as e:
+        cloudant_obj = fail_reassembly(cloudant_obj, raw_doc, f'Reassembly failed!\n{str(e)}')
+        return { 'error': cloudant_obj['error'] }
+
+    delete_reassembly_items(raw_doc, segment_items)
+    delete_segment_docs(cloudant_obj['db'], raw_id, del_docs)
+
+    if raw_doc[ifh.SEGMENT_TYPE].get('use_result_cache') == True:
+        evict_result_cache(cloudant_obj['db'], raw_id)
 
     cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
 
-    return { 'change': "{0} analyzed fully".format(doc_id) }
+    return { 'change': "{0} analyzed fully".format(raw_id) }
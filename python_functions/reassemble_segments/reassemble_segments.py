@@ -1,41 +1,244 @@
 import ibm_fn_helper as ifh
 
+from concurrent.futures import ThreadPoolExecutor
+import h5py
 import numpy as np
 import os
 
 
-# Reconstruct the segments, as NumPy arrays, into the output file
-def reassemble_segments(cos_bucket, output_path, segments):
+# Number of analyzed segments downloaded concurrently, and the number of downloaded segments that may be held in memory
+# ahead of the writer, i.e., at most REASSEMBLE_PREFETCH_WINDOW + 1 decoded segments are in memory at once
+REASSEMBLE_DOWNLOAD_CONCURRENCY = 4
+REASSEMBLE_PREFETCH_WINDOW = 8
+
+# Layout of the HDF5 output dataset.  Chunks of H5_OUTPUT_CHUNK_ROWS rows, or of a size chosen by h5py if None, are
+# compressed w/H5_OUTPUT_COMPRESSION, i.e., 'gzip', 'lzf' or None, and H5_OUTPUT_COMPRESSION_OPTS, e.g., the gzip level.
+H5_OUTPUT_DATASET = 'data'
+H5_OUTPUT_CHUNK_ROWS = None
+H5_OUTPUT_COMPRESSION = 'gzip'
+H5_OUTPUT_COMPRESSION_OPTS = 4
+
+# Fields of the written segments, stored in the HDF5 output as a chunked, compound H5_SEGMENTS_TABLE dataset w/one row
+# per segment.  Attributes are not used, as their object header is limited to 64 KB, i.e., a few thousand segments.
+H5_SEGMENTS_TABLE = 'segments'
+H5_SEGMENT_FIELDS = (('id', str), ('segment_start', int), ('segment_end', int), ('sw_version', str), ('compute_start', str), ('compute_end', str))
+
+
+# Writes the analyzed segments, in order, to a binary file of their raw array contents.  The output may be a path, or a
+# writable file object, e.g., an ifh.CosMultipartWriter streaming the output to COS, which is left open for the caller.
+class RawOutputWriter:
+    def __init__(self, output, segments):
+        self.owns_file = isinstance(output, str)
+        self.file = open(output, 'wb') if self.owns_file else output
+
+    def write(self, segment, analyzed_segment_data):
+        self.file.write(np.ascontiguousarray(analyzed_segment_data).reshape(-1).view(np.uint8))
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+
+# Writes the analyzed segments to a single HDF5 dataset, preallocated from the total length of the segments, w/each
+# segment written into its slice as it arrives.  The dataset is created on the first write, when the dtype and row
+# shape of the analyzed data are known, and the H5_SEGMENT_FIELDS of the written segments are written to a table
+# alongside it on close.
+class H5OutputWriter:
+    def __init__(self, output_path, segments, chunk_rows=H5_OUTPUT_CHUNK_ROWS, compression=H5_OUTPUT_COMPRESSION, compression_opts=H5_OUTPUT_COMPRESSION_OPTS):
+        self.file = h5py.File(output_path, 'w')
+        self.data_length = max([ segment['segment_end'] for segment in segments if segment ], default=0)
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.dataset = None
+        self.written = []
+
+    def write(self, segment, analyzed_segment_data):
+        if analyzed_segment_data.ndim == 0 or len(analyzed_segment_data) != segment['segment_end'] - segment['segment_start']:
+            raise ValueError(f'Analyzed data for {segment["id"]} does not match its segment length!')
+
+        if self.dataset is None:
+            row_shape = analyzed_segment_data.shape[1:]
+            chunks = True if self.chunk_rows is None else (min(self.chunk_rows, max(self.data_length, 1)),) + row_shape
+            self.dataset = self.file.create_dataset(H5_OUTPUT_DATASET, shape=(self.data_length,) + row_shape, dtype=analyzed_segment_data.dtype,
+                                                    chunks=chunks, compression=self.compression, compression_opts=self.compression_opts)
+
+        self.dataset[segment['segment_start']:segment['segment_end']] = analyzed_segment_data
+        self.written.append(tuple(self.segment_field(segment.get(field), kind) for field, kind in H5_SEGMENT_FIELDS))
+
+    # Missing fields are written as '' or -1, as the table has no null values
+    @staticmethod
+    def segment_field(value, kind):
+        if value is None:
+            return '' if kind is str else -1
+
+        return kind(value)
+
+    def close(self):
+        try:
+            if len(self.written) > 0:
+                dtype = np.dtype([ (field, h5py.special_dtype(vlen=str) if kind is str else np.int64) for field, kind in H5_SEGMENT_FIELDS ])
+                self.file.create_dataset(H5_SEGMENTS_TABLE, data=np.array(self.written, dtype=dtype), chunks=True, maxshape=(None,))
+        finally:
+            self.file.close()
+
+
+# Output writers by output file extension; any other extension is written as raw array contents
+OUTPUT_WRITERS = {
+    'h5': H5OutputWriter,
+    'hdf5': H5OutputWriter
+}
+
+
+# Returns the output writer class for the output file, based on its extension
+def output_writer_for(output_path):
+    return OUTPUT_WRITERS.get(os.path.splitext(output_path)[1][1:].lower(), RawOutputWriter)
+
+
+# Downloads the analyzed segment's data from COS into memory, decoded w/the segment's codec
+def get_segment_output(cos_bucket, segment):
+    return ifh.cos_get_array(cos_bucket, segment['cos_file_output'], segment.get('codec') or ifh.DEFAULT_SEGMENT_CODEC)
+
+
+# Reconstruct the segments, as NumPy arrays, into the output file w/an instance of writer_class, by default chosen from
+# the output file extension.  The output may instead be a file object if writer_class supports one.  Segments are
+# downloaded by a pool of download_concurrency threads up to prefetch_window segments ahead of the writer, and written
+# in segment order.  Returns the analyzed segment files to delete from COS once the output has been uploaded.
+def reassemble_segments(cos_bucket, output, segments, prefetch_window=REASSEMBLE_PREFETCH_WINDOW, download_concurrency=REASSEMBLE_DOWNLOAD_CONCURRENCY, writer_class=None):
 
     #### TODO: Refine this general pattern to suit your specific case
 
-    # Reconstruct the segments into this file
-    with open(output_path, 'w') as f:
-        # Load from COS
-        for segment in segments:
-            segment_idx = int(segment['id'][1:])
-            cos_file_path = segment['cos_file_output']
-            filename = os.path.basename(cos_file_path)
-            local_segment_path = '/tmp/' + filename
+    # Analyzed segment files to delete from COS once the output file has been uploaded
+    delete_items = []
+
+    if writer_class is None:
+        writer_class = output_writer_for(output)
+    writer = writer_class(output, segments)
+
+    try:
+        # Reconstruct the segments into this file
+        with ThreadPoolExecutor(max_workers=download_concurrency) as executor:
+            # Load from COS, in order, keeping up to prefetch_window downloads ahead of the writer
+            prefetch = [ executor.submit(get_segment_output, cos_bucket, segment) for segment in segments[:prefetch_window] ]
+
+            for segment_position, segment in enumerate(segments):
+                segment_idx = int(segment['id'][1:])
+                cos_file_path = segment['cos_file_output']
+
+                future = prefetch[segment_position]
+                prefetch[segment_position] = None
+                if segment_position + prefetch_window < len(segments):
+                    prefetch.append(executor.submit(get_segment_output, cos_bucket, segments[segment_position + prefetch_window]))
+
+                try:
+                    # Load data from the segment file, downloaded into memory
+                    analyzed_segment_data = future.result()
+
+                    #### TODO: Output analyzed_segment_data here
+                    writer.write(segment, analyzed_segment_data)
+
+                    # Queue COS infer file for deletion
+                    if segment_idx != 0:
+                        delete_items.append(cos_file_path)
+
+                except Exception as e:
+                    segment['error'] = f'Exception occurred in {segment["id"]}!\n{str(e)}'
+                    continue
+
+                # Delete unnecessary keys from segment JSON
+                del segment['sw_version']
+                del segment['cos_file_output']
+    finally:
+        writer.close()
+
+    return delete_items
+
+
+# Reconstruct the segments into the COS output item server-side, composing it from the analyzed segment files w/o
+# downloading them.  Only suitable when the output is the concatenation of the segments' array contents, i.e., as
+# written by RawOutputWriter.  If the item cannot be composed, an exception is raised w/the segments left unchanged.
+# Returns the analyzed segment files to delete from COS, as for reassemble_segments().
+def compose_segments(cos_bucket, cos_file_output, segments):
+    if any((segment.get('codec') or 'npy') != 'npy' for segment in segments):
+        raise ValueError('Only segments encoded w/the "npy" codec may be composed!')
+
+    ifh.cos_compose_npy_items(cos_bucket, cos_file_output, [ segment['cos_file_output'] for segment in segments ])
+
+    # Analyzed segment files to delete from COS, now that the output item has been composed
+    delete_items = [ segment['cos_file_output'] for segment in segments if int(segment['id'][1:]) != 0 ]
+
+    # Delete unnecessary keys from segment JSON
+    for segment in segments:
+        del segment['sw_version']
+        del segment['cos_file_output']
+
+    return delete_items
+
+
+# Document type of the partial outputs of a tree-reduce reassembly, each merging a run of consecutive segments, or of
+# partial outputs from the level below, into a single .npy file in COS
+PARTIAL_TYPE = ifh.SEGMENT_TYPE + '-partial'
+
+
+# Returns the ID of the partial output document at the level and index
+def partial_id(raw_id, level, index):
+    return f'{raw_id}.{PARTIAL_TYPE}.L{level}.P{index}'
+
+
+# Returns the summary of the reduced partial output document kept by its parent, or used as a segment in the final
+# output
+def partial_summary(partial_doc):
+    return {
+        'id': partial_doc['id'],
+        'doc_id': partial_doc['_id'],
+        'doc_rev': partial_doc['_rev'],
+        'segment_start': partial_doc['segment_start'],
+        'segment_end': partial_doc['segment_end'],
+        'sw_version': partial_doc['sw_version'],
+        'cos_file_output': partial_doc['cos_file_output']
+    }
+
+
+# Returns the partial output document at the level and index, merging the children, i.e., segments or partial outputs
+# of the level below, summarized as in the reassembly segments list
+def partial_doc_for(raw_id, cos_bucket, level, index, level_count, fan_in, children):
+    return {
+        '_id': partial_id(raw_id, level, index),
+        'raw_id': raw_id,
+        'raw_cos_bucket': cos_bucket,
+        'type': PARTIAL_TYPE,
+        'id': 'P' + str(index),
+        'level': level,
+        'level_count': level_count,
+        'fan_in': fan_in,
+        'segment_start': children[0]['segment_start'],
+        'segment_end': children[-1]['segment_end'],
+        'sw_version': children[-1]['sw_version'],
+        'cos_file_output': raw_id + '/' + ifh.SEGMENT_TYPE + '/partial/L' + str(level) + '.P' + str(index) + '.npy',
+        'children': children,
+        'status': 'pending'
+    }
+
 
-            try:
-                ifh.cos_download_file(cos_bucket, cos_file_path, local_segment_path)
+# Returns the first level of partial output documents, each merging a run of fan_in consecutive segments
+def partial_docs_for(raw_id, cos_bucket, segments, fan_in):
+    level_count = -(-len(segments) // fan_in)
 
-                # Load data from the segment file
-                analyzed_segment_data = np.load(local_segment_path)
+    return [ partial_doc_for(raw_id, cos_bucket, 1, index, level_count, fan_in, segments[index * fan_in:(index + 1) * fan_in]) for index in range(level_count) ]
 
-                #### TODO: Output analyzed_segment_data here
-                f.write(analyzed_segment_data)
 
-                # Delete local tmp file and COS infer file
-                os.remove(local_segment_path)
-                if segment_idx != 0:
-                    ifh.cos_delete_item(cos_bucket, cos_file_path)
+# Merges the partial output's children into its .npy file in COS, server-side, then deletes the children's files, other
+# than that of segment S0, which is left for the final reassembly to retain or delete
+def reduce_partial(partial_doc):
+    cos_bucket = partial_doc['raw_cos_bucket']
+    children = partial_doc['children']
 
-            except Exception as e:
-                segment['error'] = f'Exception occurred in {segment["id"]}!\n{str(e)}'
-                continue
+    # Children encoded w/another codec are instead decoded and merged in memory, into a plain .npy file
+    if all((child.get('codec') or 'npy') == 'npy' for child in children):
+        ifh.cos_compose_npy_items(cos_bucket, partial_doc['cos_file_output'], [ child['cos_file_output'] for child in children ], npy_header=True)
+    else:
+        ifh.cos_put_array(cos_bucket, partial_doc['cos_file_output'], np.concatenate([ get_segment_output(cos_bucket, child) for child in children ]), overwrite=True)
 
-            # Delete unnecessary keys from segment JSON
-            del segment['sw_version']
-            del segment['cos_file_output']
+    failures = ifh.cos_delete_items(cos_bucket, [ child['cos_file_output'] for child in children if child['id'] != 'S0' ])
+    if len(failures) > 0:
+        print(f'Unable to delete {len(failures)} merged file(s) from COS! ({partial_doc["_id"]})')
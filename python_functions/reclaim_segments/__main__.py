@@ -0,0 +1,27 @@
+import ibm_fn_helper as ifh
+
+from requests import HTTPError
+
+
+# Run periodically by an alarm trigger, rather than on a Cloudant change, as a segment whose analyzing invocation
+# crashed or timed out makes no further change once its lease expires
+def main(data):
+    cloudant_obj = ifh.cloudant_init(None)
+    if cloudant_obj['error'] is not None:
+        return { 'error': cloudant_obj['error'] }
+
+    try:
+        requeued = ifh.reclaim_expired_segments(cloudant_obj['db'])
+    except HTTPError as e:
+        cloudant_obj = ifh.cloudant_cleanup(cloudant_obj, error=f'Expired claims view error!\n{str(e)}')
+        return { 'error': cloudant_obj['error'] }
+
+    cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)
+
+    if requeued == 0:
+        return { 'continue': 'No expired segment leases (reclaim_segments)' }
+
+    message = f'{requeued} segment(s) re-queued after their lease expired (reclaim_segments)'
+    print(message)
+
+    return { 'change': message }
@@ -0,0 +1,147 @@
+import gc
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ibm_fn_helper as ifh
+
+
+# Stand-in for the COS client, recording the multipart upload calls and the most parts uploaded at once
+class FakeCosClient:
+    def __init__(self, fail_part=None, delay=0):
+        self.fail_part = fail_part
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = []
+        self.parts = { }
+        self.active = 0
+        self.max_active = 0
+
+    def record(self, name, **kwargs):
+        with self.lock:
+            self.calls.append((name, kwargs))
+
+    def names(self):
+        return [ name for name, _ in self.calls ]
+
+    def put_object(self, Bucket, Key, Body):
+        self.record('put_object', Body=Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.record('create_multipart_upload')
+        return { 'UploadId': 'upload' }
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+        # Parts finish out of order
+        time.sleep(random.uniform(0, self.delay))
+
+        with self.lock:
+            self.active -= 1
+
+        self.record('upload_part', PartNumber=PartNumber)
+        if PartNumber == self.fail_part:
+            raise IOError(f'Part {PartNumber} failed')
+
+        self.parts[PartNumber] = Body
+        return { 'ETag': f'etag-{PartNumber}' }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.record('complete_multipart_upload', Parts=MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.record('abort_multipart_upload', UploadId=UploadId)
+
+
+class CosMultipartWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.unraisable = []
+        self.unraisablehook = sys.unraisablehook
+        sys.unraisablehook = self.unraisable.append
+
+        # Allow parts of a few bytes
+        patcher = mock.patch.object(ifh, 'COS_MIN_PART_SIZE', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        sys.unraisablehook = self.unraisablehook
+
+    def writer(self, client, **kwargs):
+        patcher = mock.patch.object(ifh, 'cos_client', lambda: client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        return ifh.CosMultipartWriter('bucket', 'item', **kwargs)
+
+    def test_small_item_is_put_in_one_request(self):
+        client = FakeCosClient()
+
+        with self.writer(client, part_size=8) as writer:
+            writer.write(b'abc')
+            writer.write(b'de')
+
+        self.assertEqual(client.names(), ['put_object'])
+        self.assertEqual(client.calls[0][1]['Body'], b'abcde')
+
+    def test_writes_are_split_into_parts(self):
+        client = FakeCosClient()
+
+        with self.writer(client, part_size=4) as writer:
+            for data in (b'abc', b'def', b'ghij'):
+                writer.write(data)
+            self.assertEqual(writer.tell(), 10)
+
+        self.assertEqual(client.parts, { 1: b'abcd', 2: b'efgh', 3: b'ij' })
+        self.assertEqual(client.names()[0], 'create_multipart_upload')
+        self.assertEqual(client.names()[-1], 'complete_multipart_upload')
+        self.assertNotIn('put_object', client.names())
+
+    def test_parts_are_completed_in_order_within_max_in_flight(self):
+        client = FakeCosClient(delay=0.01)
+
+        with self.writer(client, part_size=2, max_in_flight=3) as writer:
+            writer.write(bytes(range(40)))
+
+        self.assertLessEqual(client.max_active, 3)
+        self.assertEqual(client.calls[-1][1]['Parts'], [ { 'ETag': f'etag-{number}', 'PartNumber': number } for number in range(1, 21) ])
+        self.assertEqual(b''.join(client.parts[number] for number in range(1, 21)), bytes(range(40)))
+
+    def test_failed_part_aborts_upload(self):
+        client = FakeCosClient(fail_part=2)
+
+        with self.assertRaises(IOError):
+            with self.writer(client, part_size=4, max_in_flight=1) as writer:
+                for _ in range(4):
+                    writer.write(b'data')
+
+        self.assertIn('abort_multipart_upload', client.names())
+        self.assertNotIn('complete_multipart_upload', client.names())
+        self.assertTrue(writer.closed)
+
+    def test_failed_init_is_not_aborted_with_an_error(self):
+        # The semaphore rejects max_in_flight before the executor is created, and __del__ then aborts the writer
+        with self.assertRaises(ValueError):
+            ifh.CosMultipartWriter('bucket', 'item', max_in_flight=-1)
+        gc.collect()
+
+        self.assertEqual(self.unraisable, [])
+
+    def test_uninitialized_writer_aborts(self):
+        writer = ifh.CosMultipartWriter.__new__(ifh.CosMultipartWriter)
+
+        writer.abort()
+        self.assertTrue(writer.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
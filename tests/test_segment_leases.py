@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ibm_fn_helper as ifh
+
+
+# In-memory stand-in for a Cloudant database, w/_rev checks on bulk writes and the expired claims view
+class FakeDatabase:
+    def __init__(self, docs):
+        self.docs = { }
+        self.revs = 0
+        self.bulk_docs([ dict(doc) for doc in docs ])
+
+    def bulk_docs(self, docs):
+        results = []
+
+        for doc in docs:
+            current = self.docs.get(doc['_id'])
+            if current is not None and current['_rev'] != doc.get('_rev'):
+                results.append({ 'id': doc['_id'], 'error': 'conflict', 'reason': 'Document update conflict.' })
+                continue
+
+            self.revs += 1
+            saved = dict(doc)
+            saved['_rev'] = str(self.revs)
+            self.docs[doc['_id']] = saved
+            results.append({ 'id': doc['_id'], 'rev': saved['_rev'] })
+
+        return results
+
+    def all_docs(self, keys, include_docs=True):
+        return { 'rows': [ { 'doc': dict(self.docs[key]) if key in self.docs else None } for key in keys ] }
+
+    def get_view_result(self, design_doc, view_name, raw_result=True, endkey=None, include_docs=True, limit=None):
+        assert view_name == ifh.EXPIRED_CLAIMS_VIEW
+
+        rows = sorted([ (doc['claim']['expires'], doc) for doc in self.docs.values()
+                        if doc.get('type') == ifh.SEGMENT_TYPE and 'compute_end' not in doc and doc.get('claim') ], key=lambda row: row[0])
+
+        return { 'rows': [ { 'key': expires, 'id': doc['_id'], 'doc': dict(doc) } for expires, doc in rows if expires <= endkey ][:limit] }
+
+    # The analyze_segment filter of cloudant_filters.json
+    def passes_analyze_filter(self, doc_id):
+        doc = self.docs[doc_id]
+
+        return doc.get('type') == ifh.SEGMENT_TYPE and doc.get('batch_lead') != 'false' and 'compute_end' not in doc and 'claim' not in doc
+
+
+def segment_docs(raw_id, count, batch_size):
+    docs = [ { '_id': f'{raw_id}.{ifh.SEGMENT_TYPE}.S{i}', 'type': ifh.SEGMENT_TYPE, 'raw_id': raw_id, 'id': f'S{i}', 'batch_lead': 'false' } for i in range(count) ]
+
+    for batch_start in range(0, count, batch_size):
+        docs[batch_start]['batch_lead'] = 'true'
+        docs[batch_start]['batch_ids'] = [ doc['_id'] for doc in docs[batch_start:batch_start + batch_size] ]
+
+    return docs
+
+
+class SegmentLeaseTest(unittest.TestCase):
+    def setUp(self):
+        raw_doc = { '_id': 'job', ifh.SEGMENT_TYPE: { 'status': 'segmented', 'analyze_batch_size': 2 } }
+        self.db = FakeDatabase([raw_doc] + segment_docs('job', 4, 2))
+
+    def batch(self, lead_id):
+        return ifh.cloudant_get_docs(self.db, self.db.docs[lead_id]['batch_ids'])
+
+    def test_crashed_lease_holder_is_reclaimed(self):
+        lead_id = f'job.{ifh.SEGMENT_TYPE}.S0'
+
+        # The holder claims its batch, then crashes w/o saving or releasing it, which the filter does not see as work
+        claimed, counts = ifh.cloudant_claim_segments(self.db, self.batch(lead_id), 'crashed', lease_seconds=-1)
+        self.assertEqual(counts['claimed'], 2)
+        self.assertFalse(self.db.passes_analyze_filter(lead_id))
+
+        # Once the lease has expired, the sweep re-queues the batch w/a lead that passes the filter
+        self.assertEqual(ifh.reclaim_expired_segments(self.db), 2)
+        self.assertTrue(self.db.passes_analyze_filter(lead_id))
+        self.assertEqual(self.db.docs[lead_id]['batch_ids'], [ lead_id, f'job.{ifh.SEGMENT_TYPE}.S1' ])
+        self.assertEqual(self.db.docs[lead_id]['last_error'], 'Lease expired')
+
+        # The retry claims and analyzes both segments, after which nothing is left to reclaim
+        claimed, counts = ifh.cloudant_claim_segments(self.db, self.batch(lead_id), 'retry')
+        self.assertEqual(counts['claimed'], 2)
+        for doc in claimed:
+            doc.pop('claim')
+            doc['compute_end'] = str(time.time())
+        self.assertEqual(ifh.cloudant_bulk_save(self.db, claimed, conflicts_ok=False), [])
+        self.assertEqual(ifh.reclaim_expired_segments(self.db), 0)
+
+    def test_live_lease_is_not_reclaimed(self):
+        lead_id = f'job.{ifh.SEGMENT_TYPE}.S2'
+
+        ifh.cloudant_claim_segments(self.db, self.batch(lead_id), 'live')
+
+        self.assertEqual(ifh.reclaim_expired_segments(self.db), 0)
+        self.assertEqual(self.db.docs[lead_id]['claim']['owner'], 'live')
+
+    def test_released_segments_are_rebatched(self):
+        lead_id = f'job.{ifh.SEGMENT_TYPE}.S0'
+        claimed, _ = ifh.cloudant_claim_segments(self.db, self.batch(lead_id), 'failed')
+
+        # Only the second segment of the batch fails, so it becomes the lead of its own batch
+        self.assertEqual(ifh.release_segments(self.db, claimed[1:], 2, error='Download failed'), 1)
+
+        retry_id = f'job.{ifh.SEGMENT_TYPE}.S1'
+        self.assertTrue(self.db.passes_analyze_filter(retry_id))
+        self.assertEqual(self.db.docs[retry_id]['batch_ids'], [ retry_id ])
+        self.assertEqual(self.db.docs[lead_id]['claim']['owner'], 'failed')
+
+    def test_attempts_are_limited(self):
+        lead_id = f'job.{ifh.SEGMENT_TYPE}.S0'
+
+        for attempt in range(ifh.SEGMENT_MAX_ATTEMPTS):
+            claimed, counts = ifh.cloudant_claim_segments(self.db, self.batch(lead_id), f'crashed-{attempt}', lease_seconds=-1)
+            self.assertEqual(counts['claimed'], 2)
+            ifh.reclaim_expired_segments(self.db)
+
+        # The segments are released, but no longer re-queued, so a persistent failure does not loop
+        self.assertFalse(self.db.passes_analyze_filter(lead_id))
+        self.assertNotIn('claim', self.db.docs[lead_id])
+        self.assertEqual(self.db.docs[lead_id]['attempts'], ifh.SEGMENT_MAX_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
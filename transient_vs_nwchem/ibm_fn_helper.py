@@ -1,16 +1,12 @@
 from cloudant.adapters import Replay429Adapter
 from cloudant.client import Cloudant
-from ibm_s3transfer.aspera.manager import AsperaTransferManager
-from ibm_s3transfer.aspera.manager import AsperaConfig
-
-# https://stackoverflow.com/questions/40993553/unable-to-suppress-deprecation-warnings
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore", category=DeprecationWarning)
-    import ibm_boto3
-    from ibm_botocore.client import Config, ClientError
+from requests import HTTPError
 
+import atexit
+import collections
 import logging
+import os
+import threading
 import SoftLayer, secrets, string, time
 
 import ibm_creds
@@ -28,29 +24,8 @@ CLOUDANT_429_RETRIES = 5
 CLOUDANT_INIT_BACKOFF = 0.75
 # 409 Document Conflict
 CLOUDANT_409_RETRIES = 10
-
-# Constants for IBM Cloud Object Storage
-COS_RESOURCE = ibm_boto3.resource('s3',
-    ibm_api_key_id=ibm_creds.COS_API_KEY_ID,
-    ibm_service_instance_id=ibm_creds.COS_RESOURCE_CRN,
-    ibm_auth_endpoint=ibm_creds.COS_AUTH_ENDPOINT,
-    config=Config(signature_version='oauth'),
-    endpoint_url=ibm_creds.COS_ENDPOINT
-)
-
-COS_CLIENT = ibm_boto3.client('s3',
-    ibm_api_key_id=ibm_creds.COS_API_KEY_ID,
-    ibm_service_instance_id=ibm_creds.COS_RESOURCE_CRN,
-    ibm_auth_endpoint=ibm_creds.COS_AUTH_ENDPOINT,
-    config=Config(signature_version='oauth'),
-    endpoint_url=ibm_creds.COS_ENDPOINT
-)
-
-transfer_manager = AsperaTransferManager(COS_CLIENT)
-
-ms_transfer_config = AsperaConfig(multi_session="all",
-                                  target_rate_mbps=2500,
-                                  multi_session_threshold_mb=100)
+# IAM tokens are valid for 60 minutes, so recycle a cached client before then as a precaution
+CLOUDANT_SESSION_MAX_AGE = 50 * 60
 
 # Constants for SoftLayer
 SL_MASK_VG = 'id, primaryIpAddress, primaryBackendIpAddress'
@@ -70,21 +45,165 @@ SL_WEBHOOK_SECRET = ''.join(secrets.choice(SECRET_CHARACTERS) for i in range(32)
 # https://docs.python.org/3.6/howto/logging.html
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(filename)s:%(lineno)s  %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+# Cloudant client and database shared across warm invocations of the same Function container
+_cloudant_cache = {
+    'client': None,
+    'db': None,
+    'connected_at': None,
+    'connections': 0,
+    'reuses': 0
+}
+
+# Multi-object delete requests accept at most 1000 keys
+COS_DELETE_BATCH_SIZE = 1000
+# Results of item existence checks are cached for this many seconds, i.e., shared across the checks of an invocation or
+# a client run, for at most this many items
+COS_EXISTS_CACHE_TTL = 60
+COS_EXISTS_CACHE_MAX_ITEMS = 10000
+
+# IBM Cloud Object Storage clients and the Aspera transfer manager are created on first use, rather than at import
+# time, so that Functions which never use them (or never use Aspera) do not pay for them during a cold start
+_cos_cache = {
+    'resource': None,
+    'client': None,
+    'aspera_manager': None,
+    'aspera_config': None
+}
+
+# Results of cos_item_exists() and cos_items_exist(), keyed by (bucket, item) in least to most recently checked order,
+# each w/its expiry.  Items uploaded or deleted by these helpers are updated in place.
+_cos_exists_cache = collections.OrderedDict()
+_cos_exists_lock = threading.Lock()
+
+
+def _ibm_boto3():
+    # https://stackoverflow.com/questions/40993553/unable-to-suppress-deprecation-warnings
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=DeprecationWarning)
+        import ibm_boto3
+        from ibm_botocore.client import Config
+
+    return ibm_boto3, Config
+
+
+def _cos_connection_args():
+    _, Config = _ibm_boto3()
+
+    return {
+        'ibm_api_key_id': ibm_creds.COS_API_KEY_ID,
+        'ibm_service_instance_id': ibm_creds.COS_RESOURCE_CRN,
+        'ibm_auth_endpoint': ibm_creds.COS_AUTH_ENDPOINT,
+        'config': Config(signature_version='oauth'),
+        'endpoint_url': ibm_creds.COS_ENDPOINT
+    }
+
+
+def cos_resource():
+    if _cos_cache['resource'] is None:
+        ibm_boto3, _ = _ibm_boto3()
+        _cos_cache['resource'] = ibm_boto3.resource('s3', **_cos_connection_args())
+
+    return _cos_cache['resource']
+
+
+def cos_client():
+    if _cos_cache['client'] is None:
+        ibm_boto3, _ = _ibm_boto3()
+        _cos_cache['client'] = ibm_boto3.client('s3', **_cos_connection_args())
+
+    return _cos_cache['client']
+
+
+# The ClientError raised by the COS clients, resolved on first use so that importing this module does not import
+# ibm_botocore.  Used as "except cos_client_error()", which is only evaluated once an exception is raised.
+def cos_client_error():
+    from ibm_botocore.exceptions import ClientError
+
+    return ClientError
+
+
+def aspera_transfer_config():
+    if _cos_cache['aspera_config'] is None:
+        from ibm_s3transfer.aspera.manager import AsperaConfig
+        _cos_cache['aspera_config'] = AsperaConfig(multi_session="all",
+                                                   target_rate_mbps=2500,
+                                                   multi_session_threshold_mb=100)
+
+    return _cos_cache['aspera_config']
+
+
+def aspera_transfer_manager():
+    if _cos_cache['aspera_manager'] is None:
+        from ibm_s3transfer.aspera.manager import AsperaTransferManager
+        _cos_cache['aspera_manager'] = AsperaTransferManager(cos_client())
+        atexit.register(_cos_cache['aspera_manager'].shutdown)
+
+    return _cos_cache['aspera_manager']
+
+
+def cloudant_disconnect():
+    if _cloudant_cache['client'] is not None:
+        try:
+            _cloudant_cache['client'].disconnect()
+        except Exception as e:
+            logging.warning(f'Unable to disconnect Cloudant client!  {str(e)}')
+
+    _cloudant_cache['client'] = None
+    _cloudant_cache['db'] = None
+    _cloudant_cache['connected_at'] = None
+
+
+# Ensures that a usable Cloudant client is cached, returning True if the existing connection was reused.  The
+# database existence check is only made when a new connection is established, i.e., once per container.
+def cloudant_connect():
+    if _cloudant_cache['client'] is not None and time.time() - _cloudant_cache['connected_at'] < CLOUDANT_SESSION_MAX_AGE:
+        # Drop documents cached locally by the database object during previous invocations to force fresh reads
+        _cloudant_cache['db'].clear()
+        _cloudant_cache['reuses'] += 1
+        return True
+
+    cloudant_disconnect()
+
+    # auto_renew requests a new IAM token whenever Cloudant rejects an expired one
+    client = Cloudant.iam(ibm_creds.CLOUDANT_USERNAME, ibm_creds.CLOUDANT_API_KEY, auto_renew=True,
+                          adapter=Replay429Adapter(retries=CLOUDANT_429_RETRIES, initialBackoff=CLOUDANT_INIT_BACKOFF))
+    client.connect()
+
+    db = client[ibm_creds.CLOUDANT_DATABASE]
+    if db.exists() == False:
+        client.disconnect()
+        return False
+
+    _cloudant_cache['client'] = client
+    _cloudant_cache['db'] = db
+    _cloudant_cache['connected_at'] = time.time()
+    _cloudant_cache['connections'] += 1
+
+    return False
+
+
+def cloudant_stats():
+    return { 'connections': _cloudant_cache['connections'], 'reuses': _cloudant_cache['reuses'] }
+
 
-def cloudant_cleanup(cloudant_obj, error=None, save=False):
+# The shared client is left connected for the next warm invocation unless disconnect is requested
+def cloudant_cleanup(cloudant_obj, error=None, save=False, disconnect=False):
     cloudant_obj['error'] = error
     if cloudant_obj['error'] is not None:
         cloudant_obj['error'] += f' ({cloudant_obj["id"]})'
         logging.error(cloudant_obj['error'])
 
-    if save == True and cloudant_obj['doc'] is not None:
+    if save == True and cloudant_obj.get('doc') is not None:
         cloudant_obj['doc'].save()
 
     cloudant_obj['doc'] = None
     cloudant_obj['db'] = None
-    cloudant_obj['client'].disconnect()
     cloudant_obj['client'] = None
 
+    if disconnect == True:
+        cloudant_disconnect()
+
     return cloudant_obj
 
 
@@ -92,44 +211,119 @@ def cloudant_init(doc_id):
     cloudant_obj = { }
     cloudant_obj['id'] = doc_id
     cloudant_obj['error'] = None
+    cloudant_obj['doc'] = None
 
-    cloudant_obj['client'] = Cloudant.iam(ibm_creds.CLOUDANT_USERNAME, ibm_creds.CLOUDANT_API_KEY,
-                                adapter=Replay429Adapter(retries=CLOUDANT_429_RETRIES, initialBackoff=CLOUDANT_INIT_BACKOFF))
-    cloudant_obj['client'].connect()
-
-    cloudant_obj['db'] = cloudant_obj['client'][ibm_creds.CLOUDANT_DATABASE]
-    if cloudant_obj['db'].exists() == False:
-        cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Database "{ibm_creds.CLOUDANT_DATABASE}" does not exist!')
-        return cloudant_obj
-
-    # Retrieve the Cloudant document, if specified
-    if cloudant_obj['id'] is not None:
-        if cloudant_obj['id'] in cloudant_obj['db']:
-            cloudant_obj['doc'] = cloudant_obj['db'][cloudant_obj['id']]
-        else:
-            cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Document does not exist!')
+    # A second attempt is made w/a new connection if the cached client's credentials are rejected
+    for attempt in range(2):
+        cloudant_obj['reused'] = cloudant_connect()
+        cloudant_obj['client'] = _cloudant_cache['client']
+        cloudant_obj['db'] = _cloudant_cache['db']
+
+        if cloudant_obj['db'] is None:
+            cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Database "{ibm_creds.CLOUDANT_DATABASE}" does not exist!')
             return cloudant_obj
 
+        # Retrieve the Cloudant document, if specified
+        try:
+            if cloudant_obj['id'] is not None:
+                if cloudant_obj['id'] in cloudant_obj['db']:
+                    cloudant_obj['doc'] = cloudant_obj['db'][cloudant_obj['id']]
+                else:
+                    cloudant_obj = cloudant_cleanup(cloudant_obj, error=f'Document does not exist!')
+                    return cloudant_obj
+        except HTTPError as err:
+            if attempt == 0 and err.response is not None and err.response.status_code in (401, 403):
+                logging.warning(f'Cloudant {err.response.status_code} HTTPError: reconnecting ({cloudant_obj["id"]})')
+                cloudant_disconnect()
+                continue
+            raise
+
+        break
+
+    logging.info(f'Cloudant connection reused={cloudant_obj["reused"]} {cloudant_stats()}')
+
     return cloudant_obj
 
 
-# https://www.peterbe.com/plog/fastest-way-to-find-out-if-a-file-exists-in-s3
+# Returns whether the item exists from the existence cache, or None if it is not cached or has expired
+def _cos_exists_cached(bucket_name, item_name):
+    with _cos_exists_lock:
+        entry = _cos_exists_cache.get((bucket_name, item_name))
+
+    if entry is None or entry[1] < time.monotonic():
+        return None
+
+    return entry[0]
+
+
+def _cos_exists_remember(bucket_name, item_names, exists):
+    expires = time.monotonic() + COS_EXISTS_CACHE_TTL
+
+    with _cos_exists_lock:
+        for item_name in item_names:
+            _cos_exists_cache[(bucket_name, item_name)] = (exists, expires)
+            _cos_exists_cache.move_to_end((bucket_name, item_name))
+
+        while len(_cos_exists_cache) > COS_EXISTS_CACHE_MAX_ITEMS:
+            _cos_exists_cache.popitem(last=False)
+
+
+# Checks for the item w/a HEAD request, rather than listing its prefix, which slows as the prefix fills.  Results are
+# cached for COS_EXISTS_CACHE_TTL seconds, so an item written or deleted by another process may be briefly stale.
 def cos_item_exists(bucket_name, item_name):
-    response = COS_CLIENT.list_objects_v2(Bucket=bucket_name, Prefix=item_name)
+    exists = _cos_exists_cached(bucket_name, item_name)
+    if exists is not None:
+        return exists
 
-    for item in response.get('Contents', []):
-        if item['Key'] == item_name:
-            return True
+    try:
+        cos_client().head_object(Bucket=bucket_name, Key=item_name)
+        exists = True
+    except cos_client_error() as ce:
+        if ce.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
+            raise
+        exists = False
+
+    _cos_exists_remember(bucket_name, [item_name], exists)
+
+    return exists
 
-    return False
+
+# Returns whether each of the items exists, in order, answering the uncached items from a single listing of the prefix,
+# by default their longest common prefix, e.g., the files of a batch.  A single uncached item is checked w/HEAD.
+def cos_items_exist(bucket_name, item_names, prefix=None):
+    results = { item_name: _cos_exists_cached(bucket_name, item_name) for item_name in item_names }
+    unknown = [ item_name for item_name, exists in results.items() if exists is None ]
+
+    if len(unknown) == 1:
+        results[unknown[0]] = cos_item_exists(bucket_name, unknown[0])
+    elif len(unknown) > 1:
+        if prefix is None:
+            prefix = os.path.commonprefix(unknown)
+        logging.info(f'{bucket_name}:{prefix}:{len(unknown)} items')
+
+        keys = set()
+        try:
+            for page in cos_client().get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                keys.update([ item['Key'] for item in page.get('Contents', []) ])
+        except cos_client_error() as ce:
+            logging.exception(f'ClientError occurred! ({bucket_name}:{prefix})', exc_info=ce)
+            raise
+
+        for item_name in unknown:
+            results[item_name] = item_name in keys
+        _cos_exists_remember(bucket_name, [ item_name for item_name in unknown if results[item_name] ], True)
+        _cos_exists_remember(bucket_name, [ item_name for item_name in unknown if not results[item_name] ], False)
+
+    return [ results[item_name] for item_name in item_names ]
 
 
 def cos_download_file(bucket_name, item_name, file_path):
     logging.info(f'{bucket_name}:{item_name}:{file_path}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).download_file(file_path)
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).download_file(file_path)
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=ce)
         raise
     except Exception as e:
@@ -143,9 +337,9 @@ def cos_get_item_contents(bucket_name, item_name):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        item = COS_RESOURCE.Object(bucket_name, item_name).get()
+        item = cos_resource().Object(bucket_name, item_name).get()
         item_contents = item['Body'].read()
-    except ClientError as ce:
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
@@ -159,14 +353,16 @@ def cos_create_text_file(bucket_name, item_name, file_text):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).put(Body=file_text)
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).put(Body=file_text)
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], True)
+
     return item_name
 
 
@@ -184,16 +380,19 @@ def cos_multi_part_upload(bucket_name, item_name, file_path, overwrite=False):
 
     try:
         # upload_fileobj() will execute a multi-part upload in <chunksize> MB chunks for all files over <threshold> MB
-        transfer_config = ibm_boto3.s3.transfer.TransferConfig(multipart_threshold=threshold, multipart_chunksize=chunksize)
+        from ibm_boto3.s3.transfer import TransferConfig
+        transfer_config = TransferConfig(multipart_threshold=threshold, multipart_chunksize=chunksize)
         with open(file_path, 'rb') as file_data:
-            COS_RESOURCE.Object(bucket_name, item_name).upload_fileobj(Fileobj=file_data, Config=transfer_config)
-    except ClientError as ce:
+            cos_resource().Object(bucket_name, item_name).upload_fileobj(Fileobj=file_data, Config=transfer_config)
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name}:{file_path})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], True)
+
     return item_name
 
 
@@ -201,17 +400,52 @@ def cos_delete_item(bucket_name, item_name):
     logging.info(f'{bucket_name}:{item_name}')
 
     try:
-        COS_RESOURCE.Object(bucket_name, item_name).delete()
-    except ClientError as ce:
+        cos_resource().Object(bucket_name, item_name).delete()
+    except cos_client_error() as ce:
         logging.exception(f'ClientError occurred! ({bucket_name}:{item_name})', exc_info=ce)
         raise
     except Exception as e:
         logging.exception(f'Exception occurred! ({bucket_name}:{item_name})', exc_info=e)
         raise
 
+    _cos_exists_remember(bucket_name, [item_name], False)
+
     return item_name
 
 
+# Deletes the items w/multi-object delete requests of up to COS_DELETE_BATCH_SIZE keys each.  Returns a dict that maps
+# each key that could not be deleted to its error, which is empty if all were deleted.  As with single deletes, a key
+# that does not exist is not an error.
+def cos_delete_items(bucket_name, item_names):
+    failures = { }
+
+    # Remove duplicates while preserving order
+    item_names = list(dict.fromkeys(item_names))
+
+    for batch_start in range(0, len(item_names), COS_DELETE_BATCH_SIZE):
+        batch = item_names[batch_start:batch_start + COS_DELETE_BATCH_SIZE]
+        logging.info(f'{bucket_name}:{batch[0]}:{len(batch)} items')
+
+        try:
+            response = cos_client().delete_objects(Bucket=bucket_name, Delete={ 'Objects': [ { 'Key': item_name } for item_name in batch ], 'Quiet': True })
+        except cos_client_error() as ce:
+            logging.exception(f'ClientError occurred! ({bucket_name}:{batch[0]}:{len(batch)} items)', exc_info=ce)
+            for item_name in batch:
+                failures[item_name] = str(ce)
+            continue
+
+        # Quiet mode only reports the keys that could not be deleted
+        for error in response.get('Errors', []):
+            failures[error['Key']] = f'{error.get("Code")}: {error.get("Message")}'
+
+    for item_name, error in failures.items():
+        logging.error(f'Unable to delete item! ({bucket_name}:{item_name}:{error})')
+
+    _cos_exists_remember(bucket_name, [ item_name for item_name in item_names if item_name not in failures ], False)
+
+    return failures
+
+
 def aspera_file_upload(bucket_name, item_name, file_path, overwrite=False):
     logging.info(f'{bucket_name}:{item_name}:{file_path}')
 
@@ -219,27 +453,23 @@ def aspera_file_upload(bucket_name, item_name, file_path, overwrite=False):
     if overwrite == False and cos_item_exists(bucket_name, item_name):
         return item_name
 
-    # Create Transfer manager
-    with AsperaTransferManager(COS_CLIENT) as transfer_manager:
+    # Perform upload w/the shared Transfer manager
+    future = aspera_transfer_manager().upload(file_path, bucket_name, item_name)
 
-        # Perform upload
-        future = transfer_manager.upload(file_path, bucket_name, item_name)
+    # Wait for upload to complete
+    future.result()
 
-        # Wait for upload to complete
-        future.result()
+    _cos_exists_remember(bucket_name, [item_name], True)
 
     return item_name
 
 
 def aspera_file_download(bucket_name, item_name, file_path):
-    # Create Transfer manager
-    with AsperaTransferManager(COS_CLIENT) as transfer_manager:
-
-        # Get object with Aspera
-        future = transfer_manager.download(bucket_name, item_name, file_path)
+    # Get object with Aspera w/the shared Transfer manager
+    future = aspera_transfer_manager().download(bucket_name, item_name, file_path)
 
-        # Wait for download to complete
-        future.result()
+    # Wait for download to complete
+    future.result()
 
     return item_name
 
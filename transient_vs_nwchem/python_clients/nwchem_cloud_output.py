@@ -67,11 +67,14 @@ for r in results:
     with open(f'{output_dir}/{doc["_id"]}.json', 'w') as f:
         json.dump(doc, f, indent=4)
 
+    # Check for the batch's output files w/a single listing
+    outputs_exist = ifh.cos_items_exist(doc['cos_bucket'], [ i['cos_file_output'] for i in doc['inputs'] ])
+
     # For each input, create an output directory and download the input, output, and result files
-    for i in doc['inputs']:
+    for i, output_exists in zip(doc['inputs'], outputs_exist):
         cos_handle_file(doc['cos_bucket'], i['cos_file_input'], output_dir)
 
-        if ifh.cos_item_exists(doc['cos_bucket'], i['cos_file_output']):
+        if output_exists:
             cos_handle_file(doc['cos_bucket'], i['cos_file_output'], output_dir)
 
         if 'cos_results' in i:
@@ -6,6 +6,27 @@ from requests import HTTPError
 import SoftLayer
 import sys
 
+
+# Deletes the COS input, output, and result files for all inputs in the document w/multi-object delete requests
+def delete_cos_items(doc):
+    cos_items = []
+
+    for i in doc['inputs']:
+        cos_items.append(i['cos_file_input'])
+
+        if 'cos_file_output' in i:
+            cos_items.append(i['cos_file_output'])
+
+        if 'cos_results' in i:
+            cos_items.extend(i['cos_results'])
+
+    failures = ifh.cos_delete_items(doc['cos_bucket'], cos_items)
+    for cos_item, error in failures.items():
+        print(f'. . . unable to delete {cos_item} ({error})')
+
+    return len(failures) == 0
+
+
 # Connect to Cloudant
 cloudant_obj = ifh.cloudant_init(None)
 if cloudant_obj['error'] is not None:
@@ -59,20 +80,10 @@ for r in results:
     doc = r['doc']
     print(f'. . . {doc["_id"]}')
 
-    # For each input, create an output directory and download the input, output, and result files
-    for i in doc['inputs']:
-        ifh.cos_delete_item(doc['cos_bucket'], i['cos_file_input'])
-
-        if 'cos_file_output' in i and ifh.cos_item_exists(doc['cos_bucket'], i['cos_file_output']):
-            ifh.cos_delete_item(doc['cos_bucket'], i['cos_file_output'])
-
-        if 'cos_results' in i:
-            for c in i['cos_results']:
-                ifh.cos_delete_item(doc['cos_bucket'], c)
-
-    # Delete JSON document from Cloudant
-    del_doc = cloudant_obj['db'][r['id']]
-    del_doc.delete()
+    # Delete the input, output, and result files of all inputs, keeping the JSON document if any could not be deleted
+    if delete_cos_items(doc):
+        del_doc = cloudant_obj['db'][r['id']]
+        del_doc.delete()
 
 # Get Cloudant documents for orphaned and reclaimed VSIs, clean up associated COS documents, then delete Cloudant documents
 try:
@@ -91,19 +102,9 @@ for r in results:
 
     print(f'. . . {doc["_id"]}')
 
-    # For each input, create an output directory and download the input, output, and result files
-    for i in doc['inputs']:
-        ifh.cos_delete_item(doc['cos_bucket'], i['cos_file_input'])
-
-        if 'cos_file_output' in i and ifh.cos_item_exists(doc['cos_bucket'], i['cos_file_output']):
-            ifh.cos_delete_item(doc['cos_bucket'], i['cos_file_output'])
-
-        if 'cos_results' in i:
-            for c in i['cos_results']:
-                ifh.cos_delete_item(doc['cos_bucket'], c)
-
-    # Delete JSON document from Cloudant
-    del_doc = cloudant_obj['db'][r['id']]
-    del_doc.delete()
+    # Delete the input, output, and result files of all inputs, keeping the JSON document if any could not be deleted
+    if delete_cos_items(doc):
+        del_doc = cloudant_obj['db'][r['id']]
+        del_doc.delete()
 
 cloudant_obj = ifh.cloudant_cleanup(cloudant_obj)